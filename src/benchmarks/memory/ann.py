@@ -0,0 +1,87 @@
+"""
+Recall@k versus latency report of the IVF index of LocalCache.
+
+Builds an IVFIndex over synthetic clustered unit vectors (real embeddings are
+clustered, uniformly random vectors are the worst case for any coarse quantizer)
+and compares every nprobe setting with the exact search.
+
+Usage, from the src directory:
+
+    python -m benchmarks.memory.ann --rows 100000 --nprobe 1 4 16 64
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.memory.topk import build_matrix
+from benchmarks.memory.topk import random_unit_vectors
+from memories.ivf import IVFIndex
+from memories.local import EMBED_DIM
+from memories.local import EmbeddingMatrix
+from memories.search import top_k
+
+
+def clustered_unit_vectors(rng, means, n, spread=0.5, chunk=65536):
+    dim = means.shape[1]
+    matrix = EmbeddingMatrix(dim, capacity=n)
+    for start in range(0, n, chunk):
+        size = min(chunk, n - start)
+        vectors = means[rng.integers(len(means), size=size)]
+        vectors += spread * rng.standard_normal((size, dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        matrix.append(vectors)
+    return matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=EMBED_DIM)
+    parser.add_argument("--nlist", type=int, default=0)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--centers", type=int, default=1000)
+    parser.add_argument("--uniform", action="store_true", help="no cluster structure")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.uniform:
+        matrix = build_matrix(rng, args.rows, args.dim)
+        queries = random_unit_vectors(rng, args.queries, args.dim)
+    else:
+        means = rng.standard_normal((args.centers, args.dim), dtype=np.float32)
+        matrix = clustered_unit_vectors(rng, means, args.rows)
+        queries = clustered_unit_vectors(rng, means, args.queries).array
+
+    start = time.perf_counter()
+    exact, _ = top_k(matrix.dot(queries.T).T, args.k)
+    exact_ms = (time.perf_counter() - start) / args.queries * 1e3
+
+    with tempfile.TemporaryDirectory() as path:
+        index = IVFIndex(path, args.dim, nlist=args.nlist)
+        start = time.perf_counter()
+        index.train(matrix, seed=args.seed)
+        build = time.perf_counter() - start
+        print(
+            f"rows={args.rows} dim={args.dim} nlist={len(index.centroids)}"
+            f" k={args.k} build={build:.2f}s exact={exact_ms:.3f} ms/query"
+        )
+        print(f"{'nprobe':>8} {'recall@k':>9} {'ms/query':>9} {'speedup':>8}")
+        for nprobe in args.nprobe:
+            start = time.perf_counter()
+            found, _ = index.search(matrix, queries, args.k, nprobe=nprobe)
+            ms = (time.perf_counter() - start) / args.queries * 1e3
+            hits = sum(len(set(f) & set(e)) for f, e in zip(found, exact))
+            print(
+                f"{nprobe:>8} {hits / exact.size:>9.3f} {ms:>9.3f}"
+                f" {exact_ms / ms:>7.1f}x"
+            )
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
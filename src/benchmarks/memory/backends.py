@@ -0,0 +1,298 @@
+"""
+Add throughput, query latency, memory and disk use of the memory backends.
+
+Fills every backend with synthetic memories, embedded offline by
+OfflineEmbedder, and queries it. Every (backend, size) case runs in a fresh
+process, so the peak RSS of a case is its own and no provider state is shared.
+The time spent in the offline embedder is left out of the add throughput, it
+stands in for the embedding API whose latency is not the backend's.
+
+Redis needs RediSearch, run a throwaway Redis Stack as the stand-in, the
+benchmark clears its database:
+
+    docker run --rm -p 6379:6379 redis/redis-stack-server
+
+Usage, from the src directory:
+
+    python -m benchmarks.memory.backends --backends local sqlite redis \\
+        --items 1000 10000 100000 1000000 --output memory-benchmark.json
+
+The report is JSON with sorted keys, one result per case, so the reports of two
+releases can be diffed. Pinecone is only benchmarked when asked for, it needs
+PINECONE_API_KEY and stores the memories in a paid index.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+
+from benchmarks.memory.embedder import OfflineEmbedder
+from memories.base import get_embedding_provider
+
+# backend -> its provider class
+PROVIDERS = {
+    "local": "LocalCache",
+    "sqlite": "SQLiteMemory",
+    "redis": "RedisMemory",
+    "pinecone": "PineconeMemory",
+}
+BACKENDS = tuple(PROVIDERS)
+COMMANDS = ("google", "browse_website", "write_to_file", "execute_python_file")
+
+
+def vocabulary(rng, size=5000):
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    return ["".join(rng.choice(letters, rng.integers(3, 10))) for _ in range(size)]
+
+
+def memory_texts(rng, words, start, count, length=40):
+    """
+    Returns: count memories like the ones of the agent loop, numbered from
+        start so that none is a duplicate.
+    """
+    picks = rng.integers(len(words), size=(count, length))
+    commands = rng.integers(len(COMMANDS), size=count)
+    return [
+        f"Command {COMMANDS[command]} returned: #{start + i} "
+        + " ".join(words[j] for j in row)
+        for i, (command, row) in enumerate(zip(commands, picks))
+    ]
+
+
+def tree_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+    return size
+
+
+def peak_rss():
+    """Returns: The peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def memory_config(**settings):
+    """
+    Returns: The memory settings of the config, at their defaults, with
+        settings replaced. The benchmarks do not read the .env file.
+    """
+    cfg = SimpleNamespace(
+        embedding_provider="openai",
+        embedding_dimension=0,
+        embedding_cache_path="",
+        embedding_cache_entries=4096,
+        embedding_cache_size_mb=256,
+        memory_backend="local",
+        memory_index="memory-benchmark",
+        memory_ann_index="none",
+        memory_ann_nlist=0,
+        memory_ann_nprobe=16,
+        memory_ann_min_rows=20000,
+        memory_search_workers=0,
+        memory_shard_min_rows=100000,
+        memory_dedup="bump",
+        memory_dedup_distance=3,
+        memory_max_entries=0,
+        memory_eviction="lru",
+        memory_importance_half_life=24,
+        memory_search_mode="hybrid",
+        memory_recency_half_life=168,
+        memory_mmr_lambda=0.7,
+        memory_write_behind=False,
+        memory_write_batch=64,
+        memory_hot_entries=0,
+        memory_hot_min_score=0.9,
+        memory_hot_watermark_seconds=10,
+        redis_host="localhost",
+        redis_port="6379",
+        redis_password="",
+        redis_search="auto",
+        redis_vector_algorithm="HNSW",
+        redis_vector_type="FLOAT32",
+        redis_hnsw_m=16,
+        redis_hnsw_ef_construction=200,
+        redis_hnsw_ef_runtime=10,
+        wipe_redis_on_start=False,
+        pinecone_api_key=os.getenv("PINECONE_API_KEY"),
+        pinecone_region=os.getenv("PINECONE_ENV"),
+        pinecone_upsert_batch=100,
+        pinecone_flush_seconds=1,
+        pinecone_query_workers=4,
+    )
+    for name, value in settings.items():
+        if not hasattr(cfg, name):
+            raise AttributeError(f"Unknown memory setting {name!r}")
+        setattr(cfg, name, value)
+    return cfg
+
+
+def open_backend(backend, args):
+    from memories import get_memory
+
+    cfg = memory_config(
+        memory_backend=backend,
+        memory_index=args.index,
+        memory_search_mode=args.mode,
+    )
+    if args.redis_host:
+        cfg.redis_host = args.redis_host
+    if args.redis_port:
+        cfg.redis_port = args.redis_port
+    memory = get_memory(cfg)
+    if type(memory).__name__ != PROVIDERS[backend]:
+        # get_memory falls back to the local backend
+        raise RuntimeError(f"the {backend} memory backend is not available")
+    if backend == "redis":
+        prefix = args.index.encode()
+        for key in memory.redis.scan_iter(count=1000):
+            if not key.startswith(prefix):
+                raise RuntimeError(
+                    f"Redis at {cfg.redis_host}:{cfg.redis_port} holds other keys,"
+                    " point --redis-host at a throwaway Redis Stack"
+                )
+    memory.clear()
+    return memory
+
+
+def run_case(backend, items, args):
+    """
+    Benchmarks one backend at one size, in a process of its own.
+
+    Returns: The result of the case.
+    """
+    rng = np.random.default_rng(args.seed)
+    words = vocabulary(rng)
+    result = {"backend": backend, "items": items}
+    with tempfile.TemporaryDirectory() as path:
+        os.chdir(path)
+        memory = open_backend(backend, args)
+        embedder = OfflineEmbedder(args.seed, get_embedding_provider().dimension)
+        embedder.install()
+
+        add_seconds = 0.0
+        for start in range(0, items, args.batch_size):
+            texts = memory_texts(rng, words, start, min(args.batch_size, items - start))
+            began = time.perf_counter()
+            memory.add_many(texts)
+            add_seconds += time.perf_counter() - began
+        add_seconds -= embedder.seconds
+        result["embed_seconds"] = round(embedder.seconds, 3)
+        result["add_items_per_second"] = round(items / max(add_seconds, 1e-9), 1)
+
+        latencies = []
+        for _ in range(args.queries):
+            query = " ".join(rng.choice(words, 8))
+            embedded = embedder.seconds
+            began = time.perf_counter()
+            memory.get_relevant(query, args.k)
+            latencies.append(
+                time.perf_counter() - began - (embedder.seconds - embedded)
+            )
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+        result["query_p50_ms"] = round(float(p50), 3)
+        result["query_p99_ms"] = round(float(p99), 3)
+        result["peak_rss_mb"] = round(peak_rss() / 2**20, 1)
+        if backend in ("local", "sqlite"):
+            memory.close()
+            result["disk_mb"] = round(tree_size(path) / 2**20, 1)
+        elif backend == "redis":
+            used = memory.redis.info("memory")["used_memory"]
+            result["server_memory_mb"] = round(used / 2**20, 1)
+            memory.clear()
+        else:
+            memory.clear()
+        os.chdir(args.cwd)
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--backends", nargs="+", choices=BACKENDS, default=["local", "sqlite", "redis"]
+    )
+    parser.add_argument(
+        "--items", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6]
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument(
+        "--mode", choices=("vector", "lexical", "hybrid"), default="vector"
+    )
+    parser.add_argument("--index", default="memory-benchmark")
+    parser.add_argument("--redis-host")
+    parser.add_argument("--redis-port")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="memory-benchmark.json")
+    args = parser.parse_args()
+    args.cwd = os.getcwd()
+
+    settings = {
+        name: getattr(args, name)
+        for name in ("batch_size", "queries", "k", "mode", "seed")
+    }
+    results = []
+    print(
+        f"{'backend':>8} {'items':>9} {'adds/s':>10} {'p50 ms':>8} {'p99 ms':>8}"
+        f" {'rss MB':>8} {'disk MB':>8}"
+    )
+    for items in args.items:
+        for backend in args.backends:
+            # spawn, a forked process would share the parent's pages and state
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                try:
+                    result = pool.submit(run_case, backend, items, args).result()
+                except Exception as error:
+                    result = {"backend": backend, "items": items, "error": str(error)}
+            results.append(result)
+            if "error" in result:
+                print(f"{backend:>8} {items:>9} failed: {result['error']}")
+                continue
+            print(
+                f"{backend:>8} {items:>9} {result['add_items_per_second']:>10.0f}"
+                f" {result['query_p50_ms']:>8.3f} {result['query_p99_ms']:>8.3f}"
+                f" {result['peak_rss_mb']:>8.1f} {result.get('disk_mb', '-'):>8}"
+            )
+    report = {
+        "benchmark": "memory-backends",
+        "environment": environment(),
+        "results": results,
+        "settings": settings,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
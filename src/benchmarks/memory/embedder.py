@@ -0,0 +1,49 @@
+"""
+A deterministic offline stand-in for the embedding API.
+
+Every text is embedded as a pseudo-random unit vector seeded by the text and a
+global seed, so the same text always gets the same embedding, runs are
+reproducible and nothing is sent over the network. The vectors carry no
+meaning, they only have the size and the cost profile of real embeddings for
+the memory backends.
+"""
+import time
+import zlib
+from typing import List
+
+import numpy as np
+
+from memories.base import set_embedding_provider
+from memories.embedders import EmbeddingProvider
+from memories.local import EMBED_DIM
+
+
+class OfflineEmbedder(EmbeddingProvider):
+    # not cached, every benchmarked text is embedded
+    model = None
+
+    def __init__(self, seed: int = 0, dimension: int = EMBED_DIM) -> None:
+        self.seed = seed
+        self.dimension = dimension
+        # time spent embedding, to leave out of the measurements
+        self.seconds = 0.0
+
+    def embed_text(self, text: str) -> np.ndarray:
+        rng = np.random.default_rng([self.seed, zlib.crc32(text.encode())])
+        vector = rng.standard_normal(self.dimension, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        start = time.perf_counter()
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            vectors[row] = self.embed_text(text)
+        self.seconds += time.perf_counter() - start
+        return vectors
+
+    def install(self) -> None:
+        """
+        Makes this the embedding provider of the memories. get_memory replaces
+        the provider with the configured one, install after opening a memory.
+        """
+        set_embedding_provider(self)
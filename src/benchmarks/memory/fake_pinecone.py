@@ -0,0 +1,197 @@
+"""
+An in-process stand-in for the Pinecone client.
+
+FakePinecone implements the part of the pinecone module PineconeMemory uses:
+init, list_indexes, create_index and Index, whose indexes keep their vectors in
+memory and score queries exactly. Every request sleeps for a simulated round
+trip and is counted, along with the most requests in flight at once, so that
+batching and parallel queries can be tested and measured without the service.
+"""
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import numpy as np
+
+OPERATORS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$gt": lambda value, operand: value > operand,
+    "$gte": lambda value, operand: value >= operand,
+    "$lt": lambda value, operand: value < operand,
+    "$lte": lambda value, operand: value <= operand,
+}
+
+
+class Match(SimpleNamespace):
+    """A query match, read by key or by attribute like the client's."""
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+def matches(metadata, query_filter):
+    for name, condition in (query_filter or {}).items():
+        if name not in metadata:
+            return False
+        for operator, operand in condition.items():
+            try:
+                if not OPERATORS[operator](metadata[name], operand):
+                    return False
+            except TypeError:
+                return False
+    return True
+
+
+class FakeIndex:
+    def __init__(self, client, dimension):
+        self.client = client
+        self.dimension = dimension
+        # id -> (embedding, metadata)
+        self.vectors = {}
+        self._lock = threading.Lock()
+
+    def upsert(self, vectors):
+        with self.client.request("upsert"):
+            with self._lock:
+                for memory_id, values, metadata in vectors:
+                    values = np.asarray(values, dtype=np.float32)
+                    if values.shape != (self.dimension,):
+                        raise ValueError(
+                            f"Vector dimension {len(values)} does not match the"
+                            f" dimension of the index {self.dimension}"
+                        )
+                    self.vectors[memory_id] = (values, dict(metadata))
+        return SimpleNamespace(upserted_count=len(vectors))
+
+    def update(self, id, set_metadata=None):
+        with self.client.request("update"):
+            with self._lock:
+                if id not in self.vectors:
+                    raise KeyError(f"Vector {id} not found")
+                self.vectors[id][1].update(set_metadata or {})
+
+    def delete(self, ids=None, deleteAll=False):
+        with self.client.request("delete"):
+            with self._lock:
+                if deleteAll:
+                    self.vectors.clear()
+                for memory_id in ids or []:
+                    self.vectors.pop(memory_id, None)
+
+    def fetch(self, ids):
+        with self.client.request("fetch"):
+            with self._lock:
+                found = {
+                    memory_id: {
+                        "id": memory_id,
+                        "values": self.vectors[memory_id][0].tolist(),
+                        "metadata": dict(self.vectors[memory_id][1]),
+                    }
+                    for memory_id in ids
+                    if memory_id in self.vectors
+                }
+        return SimpleNamespace(vectors=found)
+
+    def query(
+        self,
+        vector,
+        top_k=10,
+        include_metadata=False,
+        include_values=False,
+        filter=None,
+    ):
+        with self.client.request("query"):
+            with self._lock:
+                items = [
+                    (memory_id, values, metadata)
+                    for memory_id, (values, metadata) in self.vectors.items()
+                    if matches(metadata, filter)
+                ]
+            if not items:
+                return SimpleNamespace(matches=[])
+            query = np.asarray(vector, dtype=np.float32)
+            matrix = np.array([values for _, values, _ in items])
+            norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query)
+            scores = matrix @ query / np.where(norms > 0, norms, 1)
+            best = np.argsort(-scores, kind="stable")[:top_k]
+            return SimpleNamespace(
+                matches=[
+                    Match(
+                        id=items[i][0],
+                        score=float(scores[i]),
+                        values=items[i][1].tolist() if include_values else [],
+                        metadata=dict(items[i][2]) if include_metadata else {},
+                    )
+                    for i in best
+                ]
+            )
+
+    def describe_index_stats(self):
+        with self.client.request("describe_index_stats"):
+            stats = {
+                "dimension": self.dimension,
+                "total_vector_count": len(self.vectors),
+            }
+        return SimpleNamespace(to_dict=lambda: stats)
+
+
+class FakePinecone:
+    def __init__(self, latency: float = 0.0) -> None:
+        """
+        Args:
+            latency: The simulated round trip of every request, in seconds.
+        """
+        self.latency = latency
+        self.indexes = {}
+        # request name -> number of requests
+        self.requests = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def request(self, name):
+        with self._lock:
+            self.requests[name] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def init(self, api_key=None, environment=None):
+        pass
+
+    def list_indexes(self):
+        with self.request("list_indexes"):
+            return list(self.indexes)
+
+    def create_index(self, name, dimension, metric="cosine", pod_type="p1"):
+        with self.request("create_index"):
+            if name in self.indexes:
+                raise ValueError(f"Index {name} already exists")
+            self.indexes[name] = FakeIndex(self, dimension)
+
+    def Index(self, name):
+        return self.indexes[name]
+
+    def install(self) -> None:
+        """
+        Stands in for the pinecone module, in memories.pinecone too if it is
+        imported already, and forgets the indexes it listed.
+        """
+        sys.modules["pinecone"] = self
+        module = sys.modules.get("memories.pinecone")
+        if module is not None:
+            module.pinecone = self
+            module._indexes = None
@@ -0,0 +1,100 @@
+"""
+Add and query throughput of PineconeMemory against a simulated service.
+
+Runs PineconeMemory on FakePinecone, whose requests sleep for a simulated round
+trip, with every upsert batch size and every number of query threads. The
+round trip dominates the cost of the real service, so the report shows what
+batching upserts and sending queries in parallel save, without an API key.
+Embeddings come from OfflineEmbedder.
+
+Usage, from the src directory:
+
+    python -m benchmarks.memory.pinecone_client --latency-ms 20 \\
+        --batch-sizes 1 10 100 --workers 1 4 16
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.memory.backends import memory_config
+from benchmarks.memory.backends import memory_texts
+from benchmarks.memory.backends import vocabulary
+from benchmarks.memory.embedder import OfflineEmbedder
+from benchmarks.memory.fake_pinecone import FakePinecone
+from memories.base import get_embedding_provider
+
+
+def open_memory(batch_size, workers):
+    from configs import Singleton
+    from memories.pinecone import PineconeMemory
+
+    cfg = memory_config(
+        pinecone_api_key="",
+        pinecone_region="",
+        pinecone_upsert_batch=batch_size,
+        pinecone_flush_seconds=60,
+        pinecone_query_workers=workers,
+        memory_dedup="off",
+        memory_mmr_lambda=1.0,
+        memory_recency_half_life=0,
+    )
+    Singleton._instances.pop(PineconeMemory, None)
+    return PineconeMemory(cfg)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=64)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    fake = FakePinecone()
+    fake.install()
+    rng = np.random.default_rng(args.seed)
+    words = vocabulary(rng)
+    texts = memory_texts(rng, words, 0, args.items)
+    queries = [" ".join(rng.choice(words, 8)) for _ in range(args.queries)]
+    embedder = OfflineEmbedder(args.seed, get_embedding_provider().dimension)
+    print(f"items={args.items} queries={args.queries} latency={args.latency_ms:g} ms")
+
+    print(f"{'batch':>6} {'upserts':>8} {'adds/s':>10}")
+    for batch_size in args.batch_sizes:
+        fake.latency = 0
+        memory = open_memory(batch_size, 1)
+        memory.clear()
+        embedder.install()
+        fake.latency = args.latency_ms / 1e3
+        fake.requests.clear()
+        embedded = embedder.seconds
+        start = time.perf_counter()
+        for text in texts:
+            memory.add(text)
+        memory.flush()
+        seconds = time.perf_counter() - start - (embedder.seconds - embedded)
+        print(
+            f"{batch_size:>6} {fake.requests['upsert']:>8}"
+            f" {args.items / seconds:>10.0f}"
+        )
+        memory.close()
+
+    print(f"{'workers':>7} {'in flight':>9} {'queries/s':>10}")
+    for workers in args.workers:
+        memory = open_memory(max(args.batch_sizes), workers)
+        embedder.install()
+        fake.max_in_flight = 0
+        embedded = embedder.seconds
+        start = time.perf_counter()
+        memory.get_relevant_batch(queries, args.k)
+        seconds = time.perf_counter() - start - (embedder.seconds - embedded)
+        print(f"{workers:>7} {fake.max_in_flight:>9} {args.queries / seconds:>10.1f}")
+        memory.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Memory, build time, recall@k and latency of the Redis vector index settings.
+
+Loads the same synthetic clustered unit vectors (see benchmarks.memory.ann) into
+one RediSearch index per setting, then queries every HNSW index with every
+EF_RUNTIME and compares the results with an exact NumPy search. FLAT indexes
+are exact, their recall only shows what FLOAT16 rounding costs.
+
+Needs RediSearch, FLOAT16 needs RediSearch 2.10. Run a throwaway Redis Stack as
+the stand-in, the benchmark refuses a Redis that holds other keys:
+
+    docker run --rm -p 6379:6379 redis/redis-stack-server
+
+Usage, from the src directory:
+
+    python -m benchmarks.memory.redis_index --rows 100000 \\
+        --settings FLAT:FLOAT32 HNSW:FLOAT32 HNSW:FLOAT16 --ef-runtime 10 50 200
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import redis
+from redis.commands.search.indexDefinition import IndexDefinition
+from redis.commands.search.indexDefinition import IndexType
+from redis.commands.search.query import Query
+
+from benchmarks.memory.ann import clustered_unit_vectors
+from memories.local import EMBED_DIM
+from memories.redismem import PIPELINE_CHUNK
+from memories.redismem import schema
+from memories.redismem import VECTOR_ALGORITHMS
+from memories.redismem import VECTOR_TYPES
+from memories.search import top_k
+
+
+def parse_setting(setting):
+    algorithm, _, vector_type = setting.upper().partition(":")
+    vector_type = vector_type or "FLOAT32"
+    if algorithm not in VECTOR_ALGORITHMS or vector_type not in VECTOR_TYPES:
+        raise argparse.ArgumentTypeError(
+            f"Invalid setting {setting!r}, expected ALGORITHM:TYPE with an"
+            f" algorithm of {VECTOR_ALGORITHMS} and a type of {tuple(VECTOR_TYPES)}"
+        )
+    return algorithm, vector_type
+
+
+def build(client, name, algorithm, vector_type, vectors, args):
+    """
+    Creates an index and loads the vectors into it.
+
+    Returns: The seconds until every vector is indexed, and the bytes per
+        vector of the vector index and of the whole server.
+    """
+    used = client.info("memory")["used_memory"]
+    index = client.ft(name)
+    start = time.perf_counter()
+    index.create_index(
+        fields=schema(
+            vectors.shape[1],
+            algorithm,
+            vector_type,
+            args.m,
+            args.ef_construction,
+        ),
+        definition=IndexDefinition(prefix=[f"{name}:"], index_type=IndexType.HASH),
+    )
+    blobs = vectors.astype(VECTOR_TYPES[vector_type])
+    pipe = client.pipeline(transaction=False)
+    for row, blob in enumerate(blobs):
+        pipe.hset(f"{name}:{row}", "embedding", blob.tobytes())
+        if len(pipe) >= PIPELINE_CHUNK:
+            pipe.execute()
+    pipe.execute()
+    while True:
+        info = index.info()
+        if float(info["percent_indexed"]) >= 1 and not int(info["indexing"]):
+            break
+        time.sleep(0.05)
+    seconds = time.perf_counter() - start
+    index_bytes = float(info["vector_index_sz_mb"]) * 2**20
+    server_bytes = client.info("memory")["used_memory"] - used
+    return seconds, index_bytes / len(vectors), server_bytes / len(vectors)
+
+
+def search(client, name, vector_type, queries, k, ef_runtime):
+    """
+    Returns: The rows found for every query and the latency of every query.
+    """
+    ef = f" EF_RUNTIME {ef_runtime}" if ef_runtime else ""
+    query = (
+        Query(f"*=>[KNN {k} @embedding $vector{ef} AS vector_score]")
+        .return_fields("vector_score")
+        .sort_by("vector_score")
+        .paging(0, k)
+        .dialect(2)
+    )
+    found, latencies = [], []
+    prefix = len(name) + 1
+    for vector in queries.astype(VECTOR_TYPES[vector_type]):
+        start = time.perf_counter()
+        results = client.ft(name).search(
+            query, query_params={"vector": vector.tobytes()}
+        )
+        latencies.append(time.perf_counter() - start)
+        found.append([int(doc.id[prefix:]) for doc in results.docs])
+    return found, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--dim", type=int, default=EMBED_DIM)
+    parser.add_argument(
+        "--settings",
+        type=parse_setting,
+        nargs="+",
+        default=[("FLAT", "FLOAT32"), ("HNSW", "FLOAT32"), ("HNSW", "FLOAT16")],
+    )
+    parser.add_argument("--m", type=int, default=16)
+    parser.add_argument("--ef-construction", type=int, default=200)
+    parser.add_argument("--ef-runtime", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--centers", type=int, default=1000)
+    parser.add_argument("--index", default="redis-index-benchmark")
+    parser.add_argument("--redis-host", default="localhost")
+    parser.add_argument("--redis-port", type=int, default=6379)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results as JSON")
+    args = parser.parse_args()
+
+    client = redis.Redis(host=args.redis_host, port=args.redis_port)
+    for key in client.scan_iter(count=1000):
+        if not key.startswith(args.index.encode()):
+            raise SystemExit(
+                f"Redis at {args.redis_host}:{args.redis_port} holds other keys,"
+                " point --redis-host at a throwaway Redis Stack"
+            )
+
+    rng = np.random.default_rng(args.seed)
+    means = rng.standard_normal((args.centers, args.dim), dtype=np.float32)
+    vectors = clustered_unit_vectors(rng, means, args.rows).array
+    queries = clustered_unit_vectors(rng, means, args.queries).array
+    exact, _ = top_k(vectors.dot(queries.T).T, args.k)
+
+    print(
+        f"rows={args.rows} dim={args.dim} k={args.k} m={args.m}"
+        f" ef_construction={args.ef_construction}"
+    )
+    print(
+        f"{'index':>14} {'ef':>5} {'build s':>8} {'index B/vec':>12}"
+        f" {'server B/vec':>13} {'recall@k':>9} {'p50 ms':>8} {'p99 ms':>8}"
+    )
+    results = []
+    for number, (algorithm, vector_type) in enumerate(args.settings):
+        name = f"{args.index}-{number}"
+        seconds, index_bytes, server_bytes = build(
+            client, name, algorithm, vector_type, vectors, args
+        )
+        try:
+            for ef_runtime in args.ef_runtime if algorithm == "HNSW" else [None]:
+                found, latencies = search(
+                    client, name, vector_type, queries, args.k, ef_runtime
+                )
+                hits = sum(len(set(f) & set(e)) for f, e in zip(found, exact))
+                p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+                result = {
+                    "algorithm": algorithm,
+                    "vector_type": vector_type,
+                    "ef_runtime": ef_runtime,
+                    "build_seconds": round(seconds, 3),
+                    "index_bytes_per_vector": round(index_bytes, 1),
+                    "server_bytes_per_vector": round(server_bytes, 1),
+                    "recall": round(hits / exact.size, 4),
+                    "query_p50_ms": round(float(p50), 3),
+                    "query_p99_ms": round(float(p99), 3),
+                }
+                results.append(result)
+                print(
+                    f"{algorithm + ':' + vector_type:>14} {ef_runtime or '-':>5}"
+                    f" {seconds:>8.2f} {index_bytes:>12.0f} {server_bytes:>13.0f}"
+                    f" {result['recall']:>9.3f} {p50:>8.3f} {p99:>8.3f}"
+                )
+        finally:
+            client.ft(name).dropindex(delete_documents=True)
+
+    if args.output:
+        settings = {
+            name: getattr(args, name)
+            for name in ("rows", "dim", "m", "ef_construction", "queries", "k", "seed")
+        }
+        with open(args.output, "w") as f:
+            report = {
+                "benchmark": "redis-index",
+                "results": results,
+                "settings": settings,
+            }
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
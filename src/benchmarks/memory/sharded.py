@@ -0,0 +1,66 @@
+"""
+Query latency of sharded LocalCache search versus the number of workers.
+
+Scores random unit vectors in the agent process with one matrix product, then
+with ShardedSearch for every worker count, checking that the results match.
+The in-process product may use several BLAS threads, the workers use one each.
+
+Usage, from the src directory:
+
+    python -m benchmarks.memory.sharded --rows 1000000 --workers 1 2 4 8
+
+A 1M x 1536 float32 matrix needs about 6 GB of RAM, twice while it is copied to
+the shared memory of the workers, pass --dim to shrink it.
+"""
+import argparse
+import os
+
+import numpy as np
+
+from benchmarks.memory.topk import argpartition_batch
+from benchmarks.memory.topk import build_matrix
+from benchmarks.memory.topk import random_unit_vectors
+from benchmarks.memory.topk import timed
+from memories.local import EMBED_DIM
+from memories.sharded import ShardedSearch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=10**6)
+    parser.add_argument("--dim", type=int, default=EMBED_DIM)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--queries", type=int, default=16)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    matrix = build_matrix(rng, args.rows, args.dim)
+    queries = random_unit_vectors(rng, args.queries, args.dim)
+    baseline, expected = timed(
+        argpartition_batch, matrix, queries, args.k, repeat=args.repeat
+    )
+    print(
+        f"rows={args.rows} dim={args.dim} queries={args.queries} k={args.k}"
+        f" cpus={os.cpu_count()}"
+    )
+    print(f"{'workers':>8} {'ms/query':>9} {'speedup':>8}")
+    print(f"{'process':>8} {baseline / args.queries * 1e3:>9.3f} {1:>7.1f}x")
+    for workers in args.workers:
+        shards = ShardedSearch(args.dim, workers)
+        shards.extend(matrix)
+        # the first search attaches the workers to the shards
+        shards.search(queries, args.k)
+        seconds, (found, _) = timed(shards.search, queries, args.k, repeat=args.repeat)
+        shards.close()
+        assert np.array_equal(expected, found), "sharded results differ"
+        print(
+            f"{workers:>8} {seconds / args.queries * 1e3:>9.3f}"
+            f" {baseline / seconds:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark of LocalCache top-k retrieval.
+
+Compares the former per-query scoring with a full np.argsort against batched
+scoring (one matrix-matrix product) with np.argpartition, on random unit vectors.
+
+Usage, from the src directory:
+
+    python -m benchmarks.memory.topk --rows 10000 100000 1000000
+
+A 1M x 1536 float32 matrix needs about 6 GB of RAM, pass --dim to shrink it.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from memories.local import EMBED_DIM
+from memories.local import EmbeddingMatrix
+from memories.search import top_k
+
+
+def random_unit_vectors(rng, n, dim):
+    vectors = rng.standard_normal((n, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def build_matrix(rng, rows, dim, chunk=65536):
+    matrix = EmbeddingMatrix(dim, capacity=rows)
+    for start in range(0, rows, chunk):
+        matrix.append(random_unit_vectors(rng, min(chunk, rows - start), dim))
+    return matrix
+
+
+def argsort_per_query(matrix, queries, k):
+    results = []
+    for query in queries:
+        scores = matrix.dot(query)
+        results.append(np.argsort(scores)[-k:][::-1])
+    return np.array(results)
+
+
+def argpartition_batch(matrix, queries, k):
+    return top_k(matrix.dot(queries.T).T, k)[0]
+
+
+def timed(function, *args, repeat=3):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10**4, 10**5, 10**6]
+    )
+    parser.add_argument("--dim", type=int, default=EMBED_DIM)
+    parser.add_argument("--queries", type=int, default=16)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'rows':>10} {'argsort/query':>16} {'batched/query':>16} {'speedup':>8}")
+    for rows in args.rows:
+        matrix = build_matrix(rng, rows, args.dim)
+        queries = random_unit_vectors(rng, args.queries, args.dim)
+        old, expected = timed(argsort_per_query, matrix, queries, args.k)
+        new, found = timed(argpartition_batch, matrix, queries, args.k)
+        assert np.array_equal(expected, found), "top-k results differ"
+        print(
+            f"{rows:>10} {old / args.queries * 1e3:>13.3f} ms"
+            f" {new / args.queries * 1e3:>13.3f} ms {old / new:>7.1f}x"
+        )
+        del matrix
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,6 @@
 import json
 
 from click import BaseCommand
-from duckduckgo_search import ddg
 
 from configs import Config
 
@@ -21,6 +20,8 @@ class GoogleCommand(BaseCommand):
 
     def google_search(self, query, num_results=8):
         """Return the results of a google search"""
+        from duckduckgo_search import ddg
+
         search_results = list(ddg(query, max_results=num_results))
         return json.dumps(search_results, ensure_ascii=False, indent=4)
 
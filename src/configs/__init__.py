@@ -0,0 +1,14 @@
+import importlib
+
+from configs.singleton import AbstractSingleton
+from configs.singleton import Singleton
+
+
+def __getattr__(name):
+    # the config loads openai, yaml and the .env file, only when it is used
+    if name != "Config":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return importlib.import_module("configs.config").Config
+
+
+__all__ = ["AbstractSingleton", "Config", "Singleton"]
@@ -1,37 +1,16 @@
 # -*- coding: utf-8 -*-
-import abc
 import os
 
 import openai
 import yaml
-from dotenv import load_dotenv
 
-from src.prompts.prompt import load_prompt
-from utils.utils import clean_input
+from configs.singleton import AbstractSingleton
+from configs.singleton import Singleton  # noqa: F401
+from prompts.prompt import load_prompt
+from utils.utils import get_clean_input
 
-# Load environment variables from .env file
-load_dotenv()
 
-
-class Singleton(abc.ABCMeta, type):
-    """
-    Singleton metaclass for ensuring only one instance of a class.
-    """
-
-    _instances = {}
-
-    def __call__(self, *args, **kwargs):
-        """Call method for the singleton metaclass."""
-        if self not in self._instances:
-            self._instances[self] = super().__call__(*args, **kwargs)
-        return self._instances[self]
-
-
-class AbstractSingleton(abc.ABC, metaclass=Singleton):
-    pass
-
-
-class AGIConfig(AbstractSingleton):
+class Config(AbstractSingleton):
     """
     Configuration class to store the state of bools for different scripts access.
     """
@@ -39,7 +18,6 @@ class AGIConfig(AbstractSingleton):
     def __init__(self):
         """Initialize the Config class"""
         self.load_environment_variables()
-        self.load_ai_settings(config_file)
         self.debug_mode = False
         self.continuous_mode = False
         self.speak_mode = False
@@ -70,6 +48,13 @@ class AGIConfig(AbstractSingleton):
 
         self.pinecone_api_key = os.getenv("PINECONE_API_KEY")
         self.pinecone_region = os.getenv("PINECONE_ENV")
+        # Pinecone upserts are buffered and sent PINECONE_UPSERT_BATCH vectors per
+        # request, at the latest PINECONE_FLUSH_SECONDS after the first buffered one
+        # (0 sends every add at once). Batched queries are sent by up to
+        # PINECONE_QUERY_WORKERS threads.
+        self.pinecone_upsert_batch = int(os.getenv("PINECONE_UPSERT_BATCH", 100))
+        self.pinecone_flush_seconds = float(os.getenv("PINECONE_FLUSH_SECONDS", 1))
+        self.pinecone_query_workers = int(os.getenv("PINECONE_QUERY_WORKERS", 4))
 
         self.image_provider = os.getenv("IMAGE_PROVIDER")
         self.huggingface_api_token = os.getenv("HUGGINGFACE_API_TOKEN")
@@ -83,13 +68,102 @@ class AGIConfig(AbstractSingleton):
         self.redis_port = os.getenv("REDIS_PORT", "6379")
         self.redis_password = os.getenv("REDIS_PASSWORD", "")
         self.wipe_redis_on_start = os.getenv("WIPE_REDIS_ON_START", "True") == "True"
+        # How Redis memories are searched: "redisearch" (the RediSearch module),
+        # "local" (a copy of the index in the agent process, for plain Redis
+        # servers) or "auto" (RediSearch when the server has it).
+        self.redis_search = os.getenv("REDIS_SEARCH", "auto")
+        # The RediSearch vector index: "HNSW" (approximate) or "FLAT" (exact, fine for
+        # small indexes), of "FLOAT32" or "FLOAT16" embeddings, which halve the memory
+        # of the vectors. HNSW builds graphs of M links per vector, larger M and
+        # EF_CONSTRUCTION build slower, better graphs; EF_RUNTIME is the candidate
+        # list size of a query, larger finds more true neighbours, more slowly.
+        # They only apply when the index is created.
+        self.redis_vector_algorithm = os.getenv("REDIS_VECTOR_ALGORITHM", "HNSW")
+        self.redis_vector_type = os.getenv("REDIS_VECTOR_TYPE", "FLOAT32")
+        self.redis_hnsw_m = int(os.getenv("REDIS_HNSW_M", 16))
+        self.redis_hnsw_ef_construction = int(
+            os.getenv("REDIS_HNSW_EF_CONSTRUCTION", 200)
+        )
+        self.redis_hnsw_ef_runtime = int(os.getenv("REDIS_HNSW_EF_RUNTIME", 10))
         self.memory_index = os.getenv("MEMORY_INDEX", "auto-gpt")
         # Note that indexes must be created on db 0 in redis, this is not configureable.
 
+        # "local", "sqlite", "redis" or "pinecone"
         self.memory_backend = os.getenv("MEMORY_BACKEND", "local")
+        # Approximate nearest-neighbour index of the local backend: "ivf" or "none".
+        # NLIST=0 picks 4 * sqrt(rows), NPROBE trades recall for query latency.
+        self.memory_ann_index = os.getenv("MEMORY_ANN_INDEX", "none")
+        self.memory_ann_nlist = int(os.getenv("MEMORY_ANN_NLIST", 0))
+        self.memory_ann_nprobe = int(os.getenv("MEMORY_ANN_NPROBE", 16))
+        self.memory_ann_min_rows = int(os.getenv("MEMORY_ANN_MIN_ROWS", 20000))
+        # Worker processes that score shards of the local embeddings in shared
+        # memory, 0 scores in the agent process. Used from SHARD_MIN_ROWS rows on.
+        self.memory_search_workers = int(os.getenv("MEMORY_SEARCH_WORKERS", 0))
+        self.memory_shard_min_rows = int(os.getenv("MEMORY_SHARD_MIN_ROWS", 100000))
+        # Memories are embedded by "openai" (the embedding API) or "hashing" (local
+        # feature hashing of the words, no network). EMBEDDING_DIMENSION sets the
+        # size of hashed embeddings, 0 for the provider default (1536 for openai,
+        # which cannot be changed, 1024 for hashing).
+        self.embedding_provider = os.getenv("EMBEDDING_PROVIDER", "openai")
+        self.embedding_dimension = int(os.getenv("EMBEDDING_DIMENSION", 0))
+        # Embeddings are cached by text hash, in memory and in a SQLite file shared
+        # by all memory backends. An empty path keeps the cache in memory only.
+        self.embedding_cache_path = os.getenv(
+            "EMBEDDING_CACHE_PATH", "embedding-cache.sqlite3"
+        )
+        self.embedding_cache_entries = int(os.getenv("EMBEDDING_CACHE_ENTRIES", 4096))
+        self.embedding_cache_size_mb = int(os.getenv("EMBEDDING_CACHE_SIZE_MB", 256))
+        # What to do with a memory that repeats a stored one: "off", "skip", "bump"
+        # its repeat count or "merge" it into the stored one. Texts whose SimHashes
+        # differ in at most MEMORY_DEDUP_DISTANCE bits count as repeats.
+        self.memory_dedup = os.getenv("MEMORY_DEDUP", "bump")
+        self.memory_dedup_distance = int(os.getenv("MEMORY_DEDUP_DISTANCE", 3))
+        # The number of memories to keep, 0 keeps every memory. When the memory is
+        # full, adding evicts a memory picked by MEMORY_EVICTION: "lru" (least
+        # recently retrieved), "fifo" or "importance", which weighs how often a memory
+        # was retrieved against how long ago, halving every half life (in hours).
+        self.memory_max_entries = int(os.getenv("MEMORY_MAX_ENTRIES", 0))
+        self.memory_eviction = os.getenv("MEMORY_EVICTION", "lru")
+        self.memory_importance_half_life = float(
+            os.getenv("MEMORY_IMPORTANCE_HALF_LIFE", 24)
+        )
+        # How memories are retrieved: "vector" (embedding similarity), "lexical"
+        # (BM25 over the words, without embedding the query) or "hybrid" (both,
+        # fused by reciprocal rank), which also finds exact names, paths and codes.
+        self.memory_search_mode = os.getenv("MEMORY_SEARCH_MODE", "hybrid")
+        # Retrieved memories are re-ranked before they are injected into the prompt:
+        # their relevance halves every MEMORY_RECENCY_HALF_LIFE hours since they
+        # were added (0 disables it), and MEMORY_MMR_LAMBDA < 1 trades relevance
+        # for diversity by Maximal Marginal Relevance (1 disables it).
+        self.memory_recency_half_life = float(
+            os.getenv("MEMORY_RECENCY_HALF_LIFE", 168)
+        )
+        self.memory_mmr_lambda = float(os.getenv("MEMORY_MMR_LAMBDA", 0.7))
+        # Memories are embedded and stored by a background worker, in batches of
+        # up to MEMORY_WRITE_BATCH, so that adding a memory does not block the agent.
+        self.memory_write_behind = os.getenv("MEMORY_WRITE_BEHIND", "True") == "True"
+        self.memory_write_batch = int(os.getenv("MEMORY_WRITE_BATCH", 64))
+        # Redis memories recently added or retrieved are kept in a hot set of up to
+        # MEMORY_HOT_ENTRIES in the agent process (0 disables it). A query is answered
+        # from it without a round trip when its results there are all at least
+        # MEMORY_HOT_MIN_SCORE similar to it.
+        self.memory_hot_entries = int(os.getenv("MEMORY_HOT_ENTRIES", 0))
+        self.memory_hot_min_score = float(os.getenv("MEMORY_HOT_MIN_SCORE", 0.9))
+        # The hot set is checked against the writes of other processes at most every
+        # MEMORY_HOT_WATERMARK_SECONDS, for that long it may miss their memories
+        # (0 checks before every query, a round trip each).
+        self.memory_hot_watermark_seconds = float(
+            os.getenv("MEMORY_HOT_WATERMARK_SECONDS", 10)
+        )
         # Initialize the OpenAI API client
         openai.api_key = self.openai_api_key
 
+    def load_environment_variables(self):
+        """Load environment variables from the .env file."""
+        from dotenv import load_dotenv
+
+        load_dotenv()
+
     def set_continuous_mode(self, value: bool):
         """Set the continuous mode value."""
         self.continuous_mode = value
@@ -167,12 +241,12 @@ class AGIConfig(AbstractSingleton):
 
         # Prompt the user for input if config file is missing or empty values
         if not agi_name:
-            agi_name = clean_input("Name your AI: ")
+            agi_name = get_clean_input("Name your AI: ")
             if agi_name == "":
                 agi_name = "Entrepreneur-GPT"
 
         if not agi_role:
-            agi_role = clean_input(f"{agi_name} is: ")
+            agi_role = get_clean_input(f"{agi_name} is: ")
             if agi_role == "":
                 agi_role = "an AI designed to autonomously develop and run businesses with the sole goal of increasing your net worth."
 
@@ -201,7 +275,7 @@ class AGIConfig(AbstractSingleton):
         )
         print("Enter nothing to load defaults, enter nothing when finished.")
         for i in range(5):
-            agi_goal = clean_input(f"Goal {i+1}: ")
+            agi_goal = get_clean_input(f"Goal {i+1}: ")
             if agi_goal == "":
                 break
             agi_goals.append(agi_goal)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Singleton metaclasses, kept apart from the config so that importing them does
+not load openai, yaml or the .env file.
+"""
+import abc
+
+
+class Singleton(abc.ABCMeta, type):
+    """
+    Singleton metaclass for ensuring only one instance of a class.
+    """
+
+    _instances = {}
+
+    def __call__(self, *args, **kwargs):
+        """Call method for the singleton metaclass."""
+        if self not in self._instances:
+            self._instances[self] = super().__call__(*args, **kwargs)
+        return self._instances[self]
+
+
+class AbstractSingleton(abc.ABC, metaclass=Singleton):
+    pass
@@ -1,5 +1,4 @@
 import httpx
-from bs4 import BeautifulSoup
 from rich.console import Console
 
 from configs import Config
@@ -24,6 +23,8 @@ class WebScraper:
 
     def scrape_text(self, url):
         """Scrape text from a webpage"""
+        from bs4 import BeautifulSoup
+
         if not url.startswith("http"):
             return "Error: Invalid URL"
 
@@ -60,6 +61,8 @@ class WebScraper:
 
     def scrape_links(self, url):
         """Scrape links from a webpage"""
+        from bs4 import BeautifulSoup
+
         response = httpx.get(url, headers=self.cfg.user_agent_header)
 
         # Check if the response contains an HTTP error
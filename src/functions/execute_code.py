@@ -1,11 +1,11 @@
 import os
 
-import docker
-
 
 class DockerExecutor:
     def __init__(self, workspace_folder="auto_gpt_workspace"):
         self.workspace_folder = workspace_folder
+        import docker
+
         self.client = docker.from_env()
 
     def execute_file(self, file):
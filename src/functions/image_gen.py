@@ -5,7 +5,6 @@ from base64 import b64decode
 
 import openai
 import requests
-from PIL import Image
 
 from configs import Config
 
@@ -45,6 +44,8 @@ class ImageGenerator:
         return f"Saved to disk:{filename}"
 
     def _generate_image_sd(self, prompt, filename):
+        from PIL import Image
+
         API_URL = (
             "https://api-inference.huggingface.co/models/CompVis/stable-diffusion-v1-4"
         )
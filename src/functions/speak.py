@@ -3,9 +3,7 @@ import threading
 from threading import Lock
 from threading import Semaphore
 
-import gtts
 import requests
-from playsound import playsound
 
 from configs import Config
 
@@ -34,6 +32,8 @@ class TextToSpeech:
         )
 
         if response.status_code == 200:
+            from playsound import playsound
+
             with open("temp.mp3", "wb") as f:
                 f.write(response.content)
             playsound("temp.mp3")
@@ -43,15 +43,21 @@ class TextToSpeech:
 
     def google_speech(self, text):
         """Speak text using Google's TTS API"""
+        import gtts
+
         tts = gtts.gTTS(text)
         self.playsoundText(tts)
 
     def gtts_speech(self, text):
+        import gtts
+
         tts = gtts.gTTS(text)
         with self.mutex_lock:
             self.playsoundText(tts)
 
     def playsoundText(self, tts):
+        from playsound import playsound
+
         tts.save("temp.mp3")
         playsound("temp.mp3")
         os.remove("temp.mp3")
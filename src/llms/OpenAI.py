@@ -4,8 +4,6 @@ from typing import List
 
 import openai
 import token_counter
-from tiktoken import encoding_for_model
-from tiktoken import get_encoding
 
 from configs import Config
 
@@ -88,9 +86,19 @@ class ChatAssistant:
 
                 send_token_limit = token_limit - 1000
 
-                relevant_memory = permanent_memory.get_relevant(
-                    str(full_message_history[-5:]), 10
+                # the tokens of the context without memories bound the tokens
+                # the memories may take
+                _, base_tokens_used, _, _ = self.generate_context(
+                    prompt, [], full_message_history, model
                 )
+                relevant_memory = [
+                    memory
+                    for memory, _ in permanent_memory.get_relevant_batch(
+                        [str(full_message_history[-5:])],
+                        10,
+                        max_tokens=max(2500 - base_tokens_used, 0),
+                    )[0]
+                ]
 
                 if cfg.debug:
                     print("Memory Stats: ", permanent_memory.get_stats())
@@ -105,8 +113,8 @@ class ChatAssistant:
                 )
 
                 while current_tokens_used > 2500:
-                    # remove memories until we are under 2500 tokens
-                    relevant_memory = relevant_memory[1:]
+                    # remove the least relevant memories until we are under 2500 tokens
+                    relevant_memory = relevant_memory[:-1]
                     (
                         next_message_to_add_index,
                         current_tokens_used,
@@ -208,6 +216,9 @@ class ChatAssistant:
     def count_message_tokens(
         self, messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo-0301"
     ) -> int:
+        from tiktoken import encoding_for_model
+        from tiktoken import get_encoding
+
         try:
             encoding = encoding_for_model(model)
         except KeyError:
@@ -241,6 +252,8 @@ class ChatAssistant:
         :param model_name: The name of the model to use.
         :return: The number of tokens in the string.
         """
+        from tiktoken import encoding_for_model
+
         encoding = encoding_for_model(model_name)
         return len(encoding.encode(string))
 
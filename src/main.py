@@ -237,7 +237,7 @@ class AutoGPT:
                 f"\nHuman Feedback: {user_input} "
             )
 
-            memory.add(memory_to_add)
+            memory.add(memory_to_add, {"command": command_name})
 
             # Check if there's a result from the command append it to the message
             # history
@@ -252,6 +252,9 @@ class AutoGPT:
                 )
                 print_to_console("SYSTEM: ", Fore.YELLOW, "Unable to execute command")
 
+        # store the memories that are still queued
+        memory.close()
+
 
 def main(
     continuous: bool = typer.Option(False, help="Enable Continuous Mode"),
@@ -1,21 +1,59 @@
-from memories.local import LocalCache
+"""
+Memory providers.
 
-try:
-    from memories.redismem import RedisMemory
-except ImportError:
-    print("Redis not installed. Skipping import.")
-    RedisMemory = None
+The providers and their clients are imported when get_memory opens them, or
+when one is first read from this package, so that importing it does not load
+openai, tiktoken, redis or pinecone for a backend that is never selected.
+"""
+import importlib
 
-try:
-    from memories.pinecone import PineconeMemory
-except ImportError:
-    print("Pinecone not installed. Skipping import.")
-    PineconeMemory = None
+# name -> module of the providers this package exports
+PROVIDERS = {
+    "LocalCache": "memories.local",
+    "SQLiteMemory": "memories.sqlitemem",
+    "RedisMemory": "memories.redismem",
+    "PineconeMemory": "memories.pinecone",
+    "TieredMemory": "memories.tiered",
+    "WriteBehindMemory": "memories.ingest",
+}
+# providers whose client is optional -> the client
+OPTIONAL = {"RedisMemory": "Redis", "PineconeMemory": "Pinecone"}
+
+
+def _load(name):
+    """
+    Imports a provider once.
+
+    Returns: The provider class, None if its client is not installed.
+    """
+    if name in globals():
+        return globals()[name]
+    try:
+        provider = getattr(importlib.import_module(PROVIDERS[name]), name)
+    except ImportError:
+        if name not in OPTIONAL:
+            raise
+        print(f"{OPTIONAL[name]} not installed. Skipping import.")
+        provider = None
+    globals()[name] = provider
+    return provider
+
+
+def __getattr__(name):
+    if name not in PROVIDERS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return _load(name)
 
 
 def get_memory(cfg, init=False):
+    from memories.base import configure_embedding_provider
+    from memories.embedding_cache import configure_embedding_cache
+
+    configure_embedding_provider(cfg)
+    configure_embedding_cache(cfg)
     memory = None
     if cfg.memory_backend == "pinecone":
+        PineconeMemory = _load("PineconeMemory")
         if not PineconeMemory:
             print(
                 "Error: Pinecone is not installed. Please install pinecone"
@@ -26,6 +64,7 @@ def get_memory(cfg, init=False):
             if init:
                 memory.clear()
     elif cfg.memory_backend == "redis":
+        RedisMemory = _load("RedisMemory")
         if not RedisMemory:
             print(
                 "Error: Redis is not installed. Please install redis-py to"
@@ -33,17 +72,28 @@ def get_memory(cfg, init=False):
             )
         else:
             memory = RedisMemory(cfg)
+    elif cfg.memory_backend == "sqlite":
+        memory = _load("SQLiteMemory")(cfg)
+        if init:
+            memory.clear()
 
     if memory is None:
-        memory = LocalCache(cfg)
+        memory = _load("LocalCache")(cfg)
         if init:
             memory.clear()
+    if cfg.memory_hot_entries > 0 and memory.watermark() is not None:
+        memory = _load("TieredMemory")(memory, cfg)
+    if cfg.memory_write_behind:
+        memory = _load("WriteBehindMemory")(memory, cfg.memory_write_batch)
     return memory
 
 
 __all__ = [
     "get_memory",
     "LocalCache",
+    "SQLiteMemory",
     "RedisMemory",
     "PineconeMemory",
+    "TieredMemory",
+    "WriteBehindMemory",
 ]
@@ -1,23 +1,302 @@
 """Base class for memory providers."""
 import abc
+import functools
 
-import openai
+import numpy as np
 
 from configs import AbstractSingleton
+from memories.coalesce import Coalescer
+from memories.embedders import EmbeddingProvider
+from memories.embedders import HASHING_DIMENSION
+from memories.embedders import HashingEmbeddings
+from memories.embedding_cache import cache_key
+from memories.embedding_cache import get_embedding_cache
+from memories.embedding_cache import normalize_text
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_DIMENSION = 1536
+EMBEDDING_ENCODING = "cl100k_base"
+# limits of one embedding request
+MAX_INPUT_TOKENS = 8191
+MAX_REQUEST_TOKENS = 100_000
+MAX_REQUEST_INPUTS = 2048
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    import tiktoken
+
+    return tiktoken.get_encoding(EMBEDDING_ENCODING)
+
+
+def count_tokens(text):
+    """
+    Returns: The number of tokens of a text. The embedding and chat models
+        share the encoding.
+    """
+    return len(_encoding().encode(text))
+
+
+def _token_batches(texts):
+    """
+    Splits texts into requests that stay under the input and token limits.
+    Texts longer than MAX_INPUT_TOKENS are truncated, the API would reject them.
+
+    Args:
+        texts: The normalized texts to embed.
+
+    Yields: Lists of texts, one per request.
+    """
+    encoding = _encoding()
+    batch, batch_tokens = [], 0
+    for text in texts:
+        tokens = encoding.encode(text)
+        if len(tokens) > MAX_INPUT_TOKENS:
+            tokens = tokens[:MAX_INPUT_TOKENS]
+            text = encoding.decode(tokens)
+        if batch and (
+            batch_tokens + len(tokens) > MAX_REQUEST_TOKENS
+            or len(batch) == MAX_REQUEST_INPUTS
+        ):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(text)
+        batch_tokens += len(tokens)
+    if batch:
+        yield batch
+
+
+class OpenAIEmbeddings(EmbeddingProvider):
+    model = EMBEDDING_MODEL
+    dimension = EMBEDDING_DIMENSION
+
+    def embed(self, texts):
+        """
+        Embeds normalized texts with as few requests as the limits allow.
+        """
+        import openai
+
+        vectors = []
+        for batch in _token_batches(texts):
+            data = openai.Embedding.create(input=batch, model=self.model)["data"]
+            data = sorted(data, key=lambda x: x["index"])
+            vectors.extend(x["embedding"] for x in data)
+        return np.array(vectors, dtype=np.float32)
+
+
+_provider = OpenAIEmbeddings()
+
+
+def get_embedding_provider():
+    """
+    Returns: The provider get_ada_embedding(s) embed texts with.
+    """
+    return _provider
+
+
+def set_embedding_provider(provider):
+    """
+    Replaces the embedding provider, for embedders that are not configurable.
+
+    Args:
+        provider: An EmbeddingProvider.
+    """
+    global _provider
+    _provider = provider
+
+
+def configure_embedding_provider(cfg):
+    """
+    Replaces the embedding provider with the one picked by the config.
+
+    Args:
+        cfg: The config object.
+
+    Returns: The provider.
+    """
+    global _provider
+    name = cfg.embedding_provider
+    dimension = cfg.embedding_dimension
+    if name == "openai":
+        if dimension and dimension != EMBEDDING_DIMENSION:
+            raise ValueError(
+                f"{EMBEDDING_MODEL} embeddings have {EMBEDDING_DIMENSION}"
+                f" dimensions, not {dimension}"
+            )
+        if not isinstance(_provider, OpenAIEmbeddings):
+            _provider = OpenAIEmbeddings()
+    elif name == "hashing":
+        dimension = dimension or HASHING_DIMENSION
+        if not (
+            isinstance(_provider, HashingEmbeddings)
+            and _provider.dimension == dimension
+        ):
+            _provider = HashingEmbeddings(dimension)
+    else:
+        raise ValueError(
+            f"Invalid embedding provider {name!r}, expected 'openai' or 'hashing'"
+        )
+    return _provider
+
+
+def _request_embeddings(texts):
+    """
+    Embeds normalized texts with the embedding provider and stores the results
+    in the embedding cache.
+
+    Args:
+        texts: The normalized texts to embed.
+
+    Returns: One float32 embedding per text, in the order of the texts.
+    """
+    provider = get_embedding_provider()
+    unique = list(dict.fromkeys(texts))
+    # truncated texts keep their full key
+    fetched = dict(zip(unique, provider.embed(unique)))
+    get_embedding_cache().put_many(
+        {cache_key(provider.model, text): vector for text, vector in fetched.items()}
+    )
+    return [fetched[text] for text in texts]
+
+
+_coalescer = Coalescer(_request_embeddings)
 
 
 def get_ada_embedding(text):
-    text = text.replace("\n", " ")
-    return openai.Embedding.create(input=[text], model="text-embedding-ada-002")[
-        "data"
-    ][0]["embedding"]
+    """
+    Embeds one text with the embedding provider. Concurrent calls from other
+    threads are sent together in one request.
+
+    Args:
+        text: The text to embed.
+
+    Returns: The embedding of the text.
+    """
+    provider = get_embedding_provider()
+    if provider.model is None:
+        return provider.embed([normalize_text(text)])[0].tolist()
+    key = cache_key(provider.model, text)
+    found = get_embedding_cache().get_many([key])
+    if key in found:
+        return found[key].tolist()
+    return _coalescer.submit(normalize_text(text)).tolist()
+
+
+def get_ada_embeddings(texts):
+    """
+    Embeds several texts with the embedding provider, splitting them into as
+    few requests as the token limits allow. Texts that were embedded before
+    are served from the shared embedding cache and are not sent. Local
+    providers are not cached.
+
+    Args:
+        texts: The texts to embed.
+
+    Returns: One embedding per text, in the order of the texts.
+    """
+    provider = get_embedding_provider()
+    if provider.model is None:
+        return provider.embed([normalize_text(text) for text in texts]).tolist()
+    keys = [cache_key(provider.model, text) for text in texts]
+    found = get_embedding_cache().get_many(keys)
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in found:
+            missing.setdefault(key, normalize_text(text))
+    if missing:
+        vectors = _request_embeddings(list(missing.values()))
+        found.update(zip(missing, vectors))
+    return [found[key].tolist() for key in keys]
 
 
 class MemoryProviderSingleton(AbstractSingleton):
     @abc.abstractmethod
-    def add(self, data):
+    def add(self, data, metadata=None):
         pass
 
+    def add_many(self, texts, metadata=None):
+        """
+        Adds several data points. Providers that can store a batch at once
+        override this.
+
+        Args:
+            texts: The data to add.
+            metadata: The metadata of every data point, or None.
+
+        Returns: The messages of the single adds.
+        """
+        metadata = metadata or [None] * len(texts)
+        return [self.add(text, fields) for text, fields in zip(texts, metadata)]
+
+    def add_embeddings(self, texts, embeddings, metadata=None):
+        """
+        Adds data points with the embeddings another memory stored them with,
+        without embedding them again.
+
+        Args:
+            texts: The data to add.
+            embeddings: One embedding per text.
+            metadata: The metadata of every data point, or None.
+
+        Returns: The data that was added.
+        """
+        raise NotImplementedError(f"{type(self).__name__} cannot import embeddings")
+
+    def write_many(self, texts, metadata=None):
+        """
+        Adds several data points like add_many, reporting what was stored.
+
+        Args:
+            texts: The data to add.
+            metadata: The metadata of every data point, or None.
+
+        Returns: For every data point, the dedup action applied ("add",
+            "merge", "bump", "skip" or "error"), the message add returns and
+            the embedding the data was stored with, None unless it was added
+            or merged.
+        """
+        raise NotImplementedError(f"{type(self).__name__} cannot report writes")
+
+    def search_many(
+        self, texts, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
+        """
+        Searches like get_relevant_batch, reporting what the results were
+        stored with.
+
+        Args:
+            texts: The queries.
+            num_relevant: The number of relevant data to return per query.
+            mode: "vector", "lexical" or "hybrid".
+            where: A metadata filter, see memories.metadata.
+            max_tokens: The most tokens of the data returned per query.
+
+        Returns: For every query, (data, score, embedding, added) results,
+            best first: the float32 embedding the data was stored with and
+            when it was added, NaN if unknown.
+        """
+        raise NotImplementedError(f"{type(self).__name__} cannot report results")
+
+    def iter_embeddings(self, start=0, batch_size=1024):
+        """
+        Streams the stored data with its embeddings and metadata, in batches.
+        The cursor yielded with a batch, a JSON value, resumes the stream after
+        that batch.
+
+        Args:
+            start: The cursor to start from, 0 for the first batch.
+            batch_size: The number of memories to read per batch.
+
+        Returns: An iterator of (cursor, texts, embeddings, metadata) batches.
+        """
+        raise NotImplementedError(f"{type(self).__name__} cannot export embeddings")
+
+    def texts_to_embed(self, texts):
+        """
+        Returns: The texts that add_many would send to the embedding API.
+        """
+        return texts
+
     @abc.abstractmethod
     def get(self, data):
         pass
@@ -27,9 +306,30 @@ class MemoryProviderSingleton(AbstractSingleton):
         pass
 
     @abc.abstractmethod
-    def get_relevant(self, data, num_relevant=5):
+    def get_relevant(
+        self, data, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
+        pass
+
+    @abc.abstractmethod
+    def get_relevant_batch(
+        self, texts, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
         pass
 
     @abc.abstractmethod
     def get_stats(self):
         pass
+
+    def close(self):
+        """Writes out pending data, providers that buffer writes override this."""
+        pass
+
+    def watermark(self):
+        """
+        Returns: The number of memory ids handed out to every process sharing
+            the memory, which only grows until the memory is cleared, or None
+            if the provider does not count them. Providers with a watermark
+            implement write_many and search_many, see memories.tiered.
+        """
+        return None
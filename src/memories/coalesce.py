@@ -0,0 +1,87 @@
+"""
+Request coalescing for the embedding API.
+
+Coalescer merges single-item calls made concurrently from several threads (agents,
+the ingestion worker, the chat loop) into one batch call. The first caller becomes
+the leader: it waits a short window for other callers, sends everything that is
+pending as one batch and hands leadership over when its own item is done. Callers
+that arrive while a batch is in flight are sent together in the next batch.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+
+class Coalescer:
+    def __init__(
+        self,
+        batch_function: Callable[[List[Any]], List[Any]],
+        window: float = 0.005,
+        max_batch: int = 2048,
+    ) -> None:
+        """
+        Args:
+            batch_function: Maps a list of items to a list of results.
+            window: The seconds a leader waits for more items before sending.
+            max_batch: The maximum number of items per batch call.
+
+        Returns: None
+        """
+        self.batch_function = batch_function
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self._pending: List[Tuple[Any, Future]] = []
+        self._leading = False
+        self._cond = threading.Condition()
+
+    def submit(self, item: Any) -> Any:
+        """
+        Computes the result of one item, batched with concurrent calls.
+
+        Args:
+            item: The item to pass to the batch function.
+
+        Returns: The result of the item. Exceptions raised by the batch function
+            are raised in every caller of the failed batch.
+        """
+        future = Future()
+        with self._cond:
+            self._pending.append((item, future))
+            while self._leading and not future.done():
+                self._cond.wait()
+            if future.done():
+                return future.result()
+            self._leading = True
+        try:
+            while not future.done():
+                self._flush()
+        finally:
+            with self._cond:
+                self._leading = False
+                self._cond.notify_all()
+        return future.result()
+
+    def _flush(self) -> None:
+        if self.window:
+            time.sleep(self.window)
+        with self._cond:
+            batch = self._pending[: self.max_batch]
+            del self._pending[: self.max_batch]
+        if not batch:
+            return
+        self.batches += 1
+        try:
+            results = self.batch_function([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+        with self._cond:
+            self._cond.notify_all()
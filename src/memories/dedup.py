@@ -0,0 +1,243 @@
+"""
+Near-duplicate detection for memories, checked before a text is embedded.
+
+Every memory gets two 64-bit fingerprints: a hash of its exact text and a SimHash
+of its words and word pairs. Texts that differ in a few words have SimHashes a few
+bits apart, so a new text is a near duplicate of a memory when their SimHashes
+differ in at most ``max_distance`` bits. The SimHash is split into
+``max_distance + 1`` bands; two fingerprints within the distance agree on at least
+one band, so only memories sharing a band are compared.
+
+What happens to a duplicate depends on the policy (MEMORY_DEDUP):
+
+    off    every text is stored
+    skip   the duplicate is dropped
+    bump   the duplicate is dropped and the count and last-seen time of the
+           memory it repeats are updated
+    merge  like bump, but a near duplicate replaces the text and embedding of
+           the memory it repeats, so the memory holds the latest version
+"""
+import hashlib
+import re
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import numpy as np
+
+from memories.embedding_cache import normalize_text
+from memories.records import RecordFile
+
+POLICIES = ("off", "skip", "bump", "merge")
+FINGERPRINT_BITS = 64
+WORD = re.compile(r"\w+")
+RECORD = np.dtype(
+    [("exact", "<u8"), ("simhash", "<u8"), ("count", "<u4"), ("last_seen", "<f8")]
+)
+_BIT_WEIGHTS = np.uint64(1) << np.arange(FINGERPRINT_BITS, dtype=np.uint64)
+
+
+def _hash64(data: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(data.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def exact_hash(text: str) -> int:
+    return _hash64(normalize_text(text))
+
+
+def simhash(text: str) -> int:
+    """
+    Computes the SimHash of the words and word pairs of a text.
+
+    Args:
+        text: The text to fingerprint.
+
+    Returns: The 64-bit fingerprint, 0 for a text without words.
+    """
+    words = WORD.findall(text.lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not features:
+        return 0
+    hashes = np.array([_hash64(feature) for feature in features], dtype=np.uint64)
+    bits = (hashes[:, None] & _BIT_WEIGHTS) != 0
+    majority = bits.sum(axis=0) * 2 > len(features)
+    return int(np.bitwise_or.reduce(_BIT_WEIGHTS[majority], initial=np.uint64(0)))
+
+
+def fingerprint(text: str) -> Tuple[int, int]:
+    """
+    Returns: The exact hash and the SimHash of a text.
+    """
+    return exact_hash(text), simhash(text)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class DuplicateIndex:
+    def __init__(self, max_distance: int = 3) -> None:
+        """
+        Creates an empty index.
+
+        Args:
+            max_distance: The largest number of differing SimHash bits for
+                which two texts are near duplicates.
+
+        Returns: None
+        """
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        self._band_bits = FINGERPRINT_BITS // bands
+        self._exact: Dict[int, int] = {}
+        self._bands: List[Dict[int, Set[int]]] = [{} for _ in range(bands)]
+        self._fingerprints: Dict[int, Tuple[int, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._fingerprints)
+
+    def _band_keys(self, value: int):
+        mask = (1 << self._band_bits) - 1
+        for band in range(len(self._bands)):
+            yield band, (value >> (band * self._band_bits)) & mask
+
+    def find(self, exact: int, sim: int) -> Tuple[Optional[int], bool]:
+        """
+        Looks up a text by its fingerprints.
+
+        Args:
+            exact: The exact hash of the text.
+            sim: The SimHash of the text.
+
+        Returns: The id of a memory the text repeats, or None, and whether the
+            memory has the same text.
+        """
+        if exact in self._exact:
+            return self._exact[exact], True
+        if not sim:
+            return None, False
+        best, best_distance = None, self.max_distance + 1
+        for band, key in self._band_keys(sim):
+            for memory_id in self._bands[band].get(key, ()):
+                distance = hamming(sim, self._fingerprints[memory_id][1])
+                if distance < best_distance:
+                    best, best_distance = memory_id, distance
+        return best, False
+
+    def add(self, memory_id: int, exact: int, sim: int) -> None:
+        """
+        Indexes a memory, replacing the fingerprints it had before.
+
+        Returns: None
+        """
+        self.remove(memory_id)
+        self._fingerprints[memory_id] = (exact, sim)
+        self._exact.setdefault(exact, memory_id)
+        if sim:
+            for band, key in self._band_keys(sim):
+                self._bands[band].setdefault(key, set()).add(memory_id)
+
+    def remove(self, memory_id: int) -> None:
+        fingerprints = self._fingerprints.pop(memory_id, None)
+        if fingerprints is None:
+            return
+        exact, sim = fingerprints
+        if self._exact.get(exact) == memory_id:
+            del self._exact[exact]
+        if sim:
+            for band, key in self._band_keys(sim):
+                self._bands[band][key].discard(memory_id)
+
+    def clear(self) -> None:
+        self._exact.clear()
+        self._fingerprints.clear()
+        for band in self._bands:
+            band.clear()
+
+
+class Deduplicator:
+    def __init__(self, policy: str = "bump", max_distance: int = 3) -> None:
+        """
+        Applies a dedup policy to the memories of one provider.
+
+        Args:
+            policy: One of POLICIES.
+            max_distance: See DuplicateIndex.
+
+        Returns: None
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown dedup policy {policy!r}, expected {POLICIES}")
+        self.policy = policy
+        self.index = DuplicateIndex(max_distance) if policy != "off" else None
+
+    def decide(self, fingerprints: Tuple[int, int]) -> Tuple[str, Optional[int]]:
+        """
+        Decides what adding a text does.
+
+        Args:
+            fingerprints: The exact hash and SimHash of the text.
+
+        Returns: "add" and None for a new text, otherwise "skip", "bump" or
+            "merge" and the id of the memory it repeats. Exact repeats are
+            bumped instead of merged, there is nothing to merge.
+        """
+        if self.index is None:
+            return "add", None
+        memory_id, exact = self.index.find(*fingerprints)
+        if memory_id is None:
+            return "add", None
+        if self.policy == "merge" and exact:
+            return "bump", memory_id
+        return self.policy, memory_id
+
+    def needs_embedding(self, text: str) -> bool:
+        """
+        Returns: Whether adding the text would embed it.
+        """
+        return self.decide(fingerprint(text))[0] in ("add", "merge")
+
+    def remember(self, memory_id: int, fingerprints: Tuple[int, int]) -> None:
+        if self.index is not None:
+            self.index.add(memory_id, *fingerprints)
+
+    def forget(self, memory_id: int) -> None:
+        if self.index is not None:
+            self.index.remove(memory_id)
+
+    def clear(self) -> None:
+        if self.index is not None:
+            self.index.clear()
+
+
+class DuplicateRecords(RecordFile):
+    """
+    The fingerprints, repeat count and last-seen time of every row of a local
+    memory.
+    """
+
+    def __init__(self, filename: str) -> None:
+        super().__init__(filename, RECORD)
+
+    def bump(self, row: int) -> None:
+        record = self._buffer[row : row + 1].copy()
+        record["count"] += 1
+        record["last_seen"] = time.time()
+        self.write(row, record)
+
+
+def new_records(fingerprints: List[Tuple[int, int]]) -> np.ndarray:
+    """
+    Returns: Records seen once, now, for the given fingerprints.
+    """
+    records = np.zeros(len(fingerprints), dtype=RECORD)
+    if fingerprints:
+        records["exact"], records["simhash"] = zip(*fingerprints)
+    records["count"] = 1
+    records["last_seen"] = time.time()
+    return records
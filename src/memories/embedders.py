@@ -0,0 +1,85 @@
+"""
+Embedding providers.
+
+The memories embed texts with the provider picked by EMBEDDING_PROVIDER:
+
+- "openai", the default, sends the texts to the OpenAI embedding API, see
+  memories.base. Its embeddings are cached and have 1536 dimensions.
+- "hashing" embeds texts locally by feature hashing: the words and word
+  n-grams of a text are hashed into the columns of a fixed-size vector, with a
+  hashed sign so that colliding features cancel out on average. It needs no
+  network and takes microseconds per text, but only texts that share words are
+  similar, it has no notion of synonyms.
+
+The dimension of the embeddings is fixed by the provider, every memory backend
+reads it when it is opened. Memories stored with one provider cannot be queried
+with another, switching providers needs a new MEMORY_INDEX or clearing the
+memory.
+"""
+import abc
+import re
+import zlib
+from typing import List
+from typing import Optional
+
+import numpy as np
+
+HASHING_DIMENSION = 1024
+WORD = re.compile(r"\w+")
+
+
+class EmbeddingProvider(abc.ABC):
+    # the model embeddings are cached under, None to not cache them
+    model: Optional[str] = None
+    dimension: int
+
+    @abc.abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """
+        Embeds texts.
+
+        Args:
+            texts: The normalized texts to embed.
+
+        Returns: A (len(texts), dimension) float32 matrix.
+        """
+
+
+class HashingEmbeddings(EmbeddingProvider):
+    def __init__(self, dimension: int = HASHING_DIMENSION, ngrams: int = 2) -> None:
+        if dimension <= 0:
+            raise ValueError(f"Invalid embedding dimension {dimension}")
+        self.dimension = dimension
+        self.ngrams = ngrams
+
+    def features(self, text: str) -> List[str]:
+        """
+        Returns: The words of a text, lowercased, and its word n-grams.
+        """
+        words = WORD.findall(text.lower())
+        features = list(words)
+        for n in range(2, self.ngrams + 1):
+            features.extend(
+                " ".join(words[i : i + n]) for i in range(len(words) - n + 1)
+            )
+        return features
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features = self.features(text)
+            if not features:
+                continue
+            # crc32 rather than hash(), which is salted per process
+            hashes = np.fromiter(
+                (zlib.crc32(feature.encode()) for feature in features),
+                dtype=np.uint32,
+                count=len(features),
+            )
+            signs = np.where(hashes >> 31, -1.0, 1.0)
+            vectors[row] = np.bincount(
+                hashes % self.dimension, weights=signs, minlength=self.dimension
+            )
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms > 0, norms, 1)
+        return vectors
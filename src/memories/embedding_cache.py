@@ -0,0 +1,210 @@
+"""
+Content-addressed cache of embeddings shared by all memory providers.
+
+Entries are keyed by a hash of the model name and the normalized text. Lookups go
+through an in-process LRU first, then through a size-bounded SQLite file, so the
+same text is embedded once even across restarts and across memory backends.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_ENTRIES = 4096
+# share of the disk entries dropped when the disk tier is full
+EVICT_FRACTION = 0.1
+
+
+def normalize_text(text: str) -> str:
+    """The text that is actually sent to the embedding API."""
+    return text.replace("\n", " ")
+
+
+def cache_key(model: str, text: str) -> bytes:
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_entries: int = DEFAULT_ENTRIES,
+        max_disk_bytes: int = 256 * 1024 * 1024,
+    ) -> None:
+        """
+        Creates the cache.
+
+        Args:
+            path: The SQLite file of the disk tier, None keeps the cache in memory.
+            max_entries: The number of embeddings kept in the in-process LRU.
+            max_disk_bytes: The size above which the least recently used disk
+                entries are evicted.
+
+        Returns: None
+        """
+        self.settings = (path, max_entries, max_disk_bytes)
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._lru: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = 0
+        self._db = None
+        self.disk_bytes = 0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings"
+                " (key BLOB PRIMARY KEY, vector BLOB NOT NULL, used REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)"
+            )
+            self._db.commit()
+            (total,) = self._db.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+            self.disk_bytes = total
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        Looks up several keys, promoting disk hits into the LRU.
+
+        Args:
+            keys: The cache keys.
+
+        Returns: The cached embeddings by key; missing keys are left out.
+        """
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    found[key] = vector
+            missing = [key for key in keys if key not in found]
+            if missing and self._db is not None:
+                now = time.time()
+                for key in set(missing):
+                    row = self._db.execute(
+                        "SELECT vector FROM embeddings WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is None:
+                        continue
+                    self._db.execute(
+                        "UPDATE embeddings SET used = ? WHERE key = ?", (now, key)
+                    )
+                    found[key] = np.frombuffer(row[0], dtype=np.float32)
+                    self._remember(key, found[key])
+                    self.disk_hits += 1
+                self._db.commit()
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, entries: Dict[bytes, np.ndarray]) -> None:
+        """
+        Stores embeddings in both tiers.
+
+        Args:
+            entries: The embeddings by key.
+
+        Returns: None
+        """
+        with self._lock:
+            for key, vector in entries.items():
+                self._remember(key, np.asarray(vector, dtype=np.float32))
+            if self._db is None or not entries:
+                return
+            now = time.time()
+            rows = [
+                (key, np.asarray(vector, dtype=np.float32).tobytes(), now)
+                for key, vector in entries.items()
+            ]
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, used) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.disk_bytes += sum(len(vector) for _, vector, _ in rows)
+            if self.disk_bytes > self.max_disk_bytes:
+                self._evict()
+            self._db.commit()
+
+    def _remember(self, key: bytes, vector: np.ndarray) -> None:
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _evict(self) -> None:
+        """Drops the least recently used disk entries until there is headroom."""
+        (count,) = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        while self.disk_bytes > self.max_disk_bytes and count:
+            batch = max(1, int(count * EVICT_FRACTION))
+            self._db.execute(
+                "DELETE FROM embeddings WHERE key IN"
+                " (SELECT key FROM embeddings ORDER BY used LIMIT ?)",
+                (batch,),
+            )
+            (self.disk_bytes,) = self._db.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+            count -= batch
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns: The hit and miss counters and the size of both tiers.
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._lru),
+                "disk_bytes": self.disk_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+_cache = EmbeddingCache()
+
+
+def get_embedding_cache() -> EmbeddingCache:
+    """
+    Returns: The cache used by get_ada_embedding(s).
+    """
+    return _cache
+
+
+def configure_embedding_cache(cfg) -> EmbeddingCache:
+    """
+    Replaces the shared cache with one built from the config, unless it is
+    already configured the same way.
+
+    Args:
+        cfg: The config object.
+
+    Returns: The shared cache.
+    """
+    global _cache
+    settings = (
+        cfg.embedding_cache_path or None,
+        cfg.embedding_cache_entries,
+        cfg.embedding_cache_size_mb * 1024 * 1024,
+    )
+    if _cache.settings != settings:
+        _cache.close()
+        _cache = EmbeddingCache(*settings)
+    return _cache
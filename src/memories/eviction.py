@@ -0,0 +1,208 @@
+"""
+Eviction for capacity-bounded memories (MEMORY_MAX_ENTRIES).
+
+An Evictor tracks when every memory was added, when it was last retrieved and how
+often, and keeps the memories in a heap ordered by the eviction policy
+(MEMORY_EVICTION):
+
+    fifo        the oldest memory goes first
+    lru         the memory retrieved least recently goes first
+    importance  the memory with the lowest (1 + retrievals) * 2 ** (-idle / half
+                life) goes first, idle being the time since its last retrieval
+
+The importance of every memory decays at the same rate, so comparing them only
+needs log2(1 + retrievals) + last_used / half_life, which does not change while a
+memory is idle. Every policy therefore has a fixed key per memory, updated on
+add and retrieval, and inserting, retrieving or evicting costs O(log n). Updated
+keys are pushed as new heap entries; the outdated entries are skipped when they
+reach the top.
+"""
+import heapq
+import math
+import time
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+POLICIES = ("lru", "fifo", "importance")
+DEFAULT_HALF_LIFE = 24 * 3600.0
+# the usage of a row of a local memory, added is 0 for a released row
+USAGE = np.dtype([("added", "<f8"), ("last_used", "<f8"), ("retrievals", "<u4")])
+
+
+class Evictor:
+    def __init__(
+        self,
+        capacity: int,
+        policy: str = "lru",
+        half_life: float = DEFAULT_HALF_LIFE,
+    ) -> None:
+        """
+        Creates an empty evictor.
+
+        Args:
+            capacity: The number of memories to keep.
+            policy: One of POLICIES.
+            half_life: The seconds after which the importance of an idle memory
+                has halved.
+
+        Returns: None
+        """
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown eviction policy {policy!r}, expected {POLICIES}")
+        self.capacity = capacity
+        self.policy = policy
+        self.half_life = half_life
+        self.evictions = 0
+        # memory id -> [added, last used, retrievals]
+        self._usage: Dict[int, List[float]] = {}
+        # (key, push number, memory id), only the latest push of a memory counts
+        self._heap: List[Tuple[float, int, int]] = []
+        self._latest: Dict[int, int] = {}
+        self._pushes = 0
+
+    def __len__(self) -> int:
+        return len(self._usage)
+
+    def __contains__(self, memory_id: int) -> bool:
+        return memory_id in self._usage
+
+    @property
+    def full(self) -> bool:
+        return len(self._usage) >= self.capacity
+
+    def _key(self, added: float, last_used: float, retrievals: int) -> float:
+        if self.policy == "fifo":
+            return added
+        if self.policy == "lru":
+            return last_used
+        return math.log2(1 + retrievals) + last_used / self.half_life
+
+    def _push(self, memory_id: int) -> None:
+        self._pushes += 1
+        self._latest[memory_id] = self._pushes
+        key = self._key(*self._usage[memory_id])
+        heapq.heappush(self._heap, (key, self._pushes, memory_id))
+        if len(self._heap) > 2 * len(self._usage) + 64:
+            self._compact()
+
+    def _compact(self) -> None:
+        """Drops the outdated heap entries."""
+        self._heap = [
+            entry for entry in self._heap if self._latest.get(entry[2]) == entry[1]
+        ]
+        heapq.heapify(self._heap)
+
+    def track(
+        self,
+        memory_id: int,
+        added: Optional[float] = None,
+        last_used: Optional[float] = None,
+        retrievals: int = 0,
+    ) -> None:
+        """
+        Starts tracking a new memory, or a stored one with its usage.
+
+        Args:
+            memory_id: The id of the memory.
+            added: When the memory was added, defaults to now.
+            last_used: When the memory was last retrieved, defaults to added.
+            retrievals: How often the memory was retrieved.
+
+        Returns: None
+        """
+        added = time.time() if added is None else added
+        last_used = added if last_used is None else last_used
+        self._usage[memory_id] = [added, last_used, retrievals]
+        self._push(memory_id)
+
+    def track_many(self, memory_ids: List[int], usage: np.ndarray) -> None:
+        """
+        Tracks stored memories at once, building the heap in O(n).
+
+        Args:
+            memory_ids: The ids of the memories.
+            usage: Their USAGE records.
+
+        Returns: None
+        """
+        for memory_id, (added, last_used, retrievals) in zip(
+            memory_ids, usage.tolist()
+        ):
+            self._usage[memory_id] = [added, last_used, retrievals]
+            self._pushes += 1
+            self._latest[memory_id] = self._pushes
+            key = self._key(added, last_used, retrievals)
+            self._heap.append((key, self._pushes, memory_id))
+        heapq.heapify(self._heap)
+
+    def touch(self, memory_ids: Iterable[int], now: Optional[float] = None) -> None:
+        """
+        Records a retrieval of memories.
+
+        Args:
+            memory_ids: The ids of the retrieved memories.
+            now: The time of the retrieval, defaults to now.
+
+        Returns: None
+        """
+        now = time.time() if now is None else now
+        for memory_id in memory_ids:
+            usage = self._usage.get(memory_id)
+            if usage is None:
+                continue
+            usage[1] = now
+            usage[2] += 1
+            if self.policy != "fifo":
+                self._push(memory_id)
+
+    def usage(self, memory_id: int) -> Tuple[float, float, int]:
+        """
+        Returns: When a memory was added and last retrieved, and how often it
+            was retrieved.
+        """
+        added, last_used, retrievals = self._usage[memory_id]
+        return added, last_used, int(retrievals)
+
+    def victim(self) -> Optional[int]:
+        """
+        Stops tracking the memory that goes first, if the evictor is full.
+
+        Returns: The id of the memory to evict, or None.
+        """
+        if not self.full:
+            return None
+        while self._heap:
+            _, push, memory_id = heapq.heappop(self._heap)
+            if self._latest.get(memory_id) == push:
+                self.forget(memory_id)
+                self.evictions += 1
+                return memory_id
+        return None
+
+    def forget(self, memory_id: int) -> None:
+        self._usage.pop(memory_id, None)
+        self._latest.pop(memory_id, None)
+
+    def clear(self) -> None:
+        self._usage.clear()
+        self._latest.clear()
+        self._heap = []
+
+
+def evictor_from_config(cfg) -> Optional[Evictor]:
+    """
+    Returns: The evictor configured for memory providers, None if the memory
+        is not bounded.
+    """
+    if cfg.memory_max_entries <= 0:
+        return None
+    return Evictor(
+        cfg.memory_max_entries,
+        cfg.memory_eviction,
+        cfg.memory_importance_half_life * 3600,
+    )
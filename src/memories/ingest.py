@@ -0,0 +1,394 @@
+"""
+Write-behind ingestion for memory providers.
+
+WriteBehindMemory wraps any memory provider and moves ``add`` off the agent loop:
+added texts are queued and a background worker embeds and stores them in batches.
+The embedding request, the slow part, happens outside the provider lock, so
+queries are only held up while the provider stores an already embedded batch.
+
+Queries see pending texts too. They are filtered by the metadata filter of the
+query, ranked in its search mode and merged with the results of the provider,
+so a memory can be recalled on the next turn even if it has not been stored yet.
+Pending texts the dedup policy of the provider would drop or bump are left out,
+the provider returns the stored memory. When the provider re-ranks, the pending
+texts and its results are re-ranked together by the same reranker, on one scale
+of relevance, see memories.rerank.
+"""
+import atexit
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from memories.base import count_tokens
+from memories.base import get_ada_embeddings
+from memories.lexical import BM25Index
+from memories.lexical import check_mode
+from memories.lexical import reciprocal_rank_fusion
+from memories.metadata import check_metadata
+from memories.metadata import Metadata
+from memories.metadata import MetadataColumns
+from memories.rerank import Reranker
+
+DEFAULT_BATCH = 64
+# a batch that keeps failing is dropped after this many attempts
+MAX_ATTEMPTS = 5
+# pause before the first retry, doubled after each failed attempt
+RETRY_SECONDS = 1.0
+
+
+class WriteBehindMemory:
+    def __init__(self, memory, batch_size: int = DEFAULT_BATCH) -> None:
+        """
+        Starts the ingestion worker of a memory provider.
+
+        Args:
+            memory: The memory provider to store the texts in.
+            batch_size: The maximum number of texts stored at once.
+
+        Returns: None
+        """
+        self.memory = memory
+        self.batch_size = batch_size
+        self.failed = 0
+        # failed attempts at the batch at the head of the queue
+        self._attempts = 0
+        # (text, metadata) pairs
+        self._pending: List[Tuple[str, Metadata]] = []
+        self._in_flight: List[Tuple[str, Metadata]] = []
+        self._closed = False
+        self._cond = threading.Condition()
+        # held while the provider is written to or queried
+        self._memory_lock = threading.RLock()
+        self._worker = threading.Thread(
+            target=self._run, name="memory-ingest", daemon=True
+        )
+        self._worker.start()
+        atexit.register(self.close)
+
+    def add(self, text: str, metadata: Optional[Metadata] = None) -> str:
+        """
+        Queues a text to be embedded and stored.
+
+        Args:
+            text: The text to add.
+            metadata: The metadata queries can filter the text by.
+
+        Returns: The queued text.
+        """
+        if "Command Error:" in text:
+            return ""
+        self.add_many([text], [metadata])
+        return text
+
+    def add_many(
+        self, texts: List[str], metadata: Optional[List[Metadata]] = None
+    ) -> List[str]:
+        """
+        Queues several texts, they are stored in order. The metadata is checked
+        and stamped with the time the texts are queued.
+
+        Args:
+            texts: The texts to add.
+            metadata: The metadata of every text, or None.
+
+        Returns: The queued texts.
+        """
+        items = [
+            (text, check_metadata(fields))
+            for text, fields in zip(texts, metadata or [None] * len(texts))
+            if "Command Error:" not in text
+        ]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The memory is closed")
+            self._pending.extend(items)
+            self._cond.notify_all()
+        return [text for text, _ in items]
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch = self._pending[: self.batch_size]
+                self._in_flight = batch
+                del self._pending[: self.batch_size]
+            texts = [text for text, _ in batch]
+            try:
+                # fills the embedding cache, the provider then embeds from it
+                get_ada_embeddings(self.memory.texts_to_embed(texts))
+                with self._memory_lock:
+                    self.memory.add_many(texts, [fields for _, fields in batch])
+                    with self._cond:
+                        self._in_flight = []
+            except Exception as e:
+                print("Error storing memories: ", e)
+                self._retry(batch)
+                continue
+            with self._cond:
+                self._attempts = 0
+                self._cond.notify_all()
+
+    def _retry(self, batch: List[Tuple[str, Metadata]]) -> None:
+        # puts a failed batch back at the head of the queue and waits before the
+        # next attempt, the batch is dropped after MAX_ATTEMPTS or once closed
+        with self._cond:
+            self._in_flight = []
+            self._attempts += 1
+            if self._attempts >= MAX_ATTEMPTS or self._closed:
+                self.failed += len(batch)
+                self._attempts = 0
+                self._cond.notify_all()
+                return
+            self._pending[:0] = batch
+            self._cond.notify_all()
+            deadline = time.monotonic() + RETRY_SECONDS * 2 ** (self._attempts - 1)
+            while not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+    def flush(self) -> None:
+        """
+        Waits until every queued text is stored.
+
+        Returns: None
+        """
+        with self._cond:
+            while self._pending or self._in_flight:
+                self._cond.wait()
+
+    def close(self) -> None:
+        """
+        Stores the queued texts and stops the worker. Called at exit. A batch
+        that fails to store is not retried after this, it is dropped.
+
+        Returns: None
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._worker.join()
+        atexit.unregister(self.close)
+        self.memory.close()
+
+    def clear(self) -> str:
+        """
+        Drops the queued texts and clears the memory.
+
+        Returns: A message indicating that the memory has been cleared.
+        """
+        with self._cond:
+            self._pending.clear()
+            self._attempts = 0
+        self.flush()
+        with self._memory_lock:
+            return self.memory.clear()
+
+    def get(self, data: str) -> Optional[List[Any]]:
+        return self.get_relevant(data, 1)
+
+    def get_relevant(
+        self,
+        data: str,
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[Any]:
+        return [
+            memory
+            for memory, _ in self.get_relevant_batch(
+                [data], num_relevant, mode, where, max_tokens
+            )[0]
+        ]
+
+    def get_relevant_batch(
+        self,
+        texts: List[str],
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Queries the memory and the texts that are not stored yet.
+
+        Args:
+            texts: The queries.
+            num_relevant: The number of relevant data to return per query.
+            mode: "vector", "lexical" or "hybrid", defaults to the search mode
+                of the memory.
+            where: A metadata filter, see memories.metadata.
+            max_tokens: The most tokens of the data returned per query, None
+                for no limit.
+
+        Returns: For every query, (data, score) pairs, best first. Pending
+            texts are merged by score in vector mode and by reciprocal rank
+            otherwise, then the merged results that do not fit max_tokens
+            are dropped. When the provider re-ranks, the merged results are
+            re-ranked by its reranker instead, scores are then decayed
+            relevances scaled to a best of 1.
+        """
+        if not texts:
+            return []
+        mode = check_mode(mode or getattr(self.memory, "search_mode", "vector"))
+        reranker = getattr(self.memory, "reranker", None) or Reranker()
+        with self._memory_lock:
+            with self._cond:
+                pending = self._in_flight + self._pending
+            batch = self.memory.get_relevant_batch(
+                texts, num_relevant, mode, where, max_tokens
+            )
+            if pending:
+                unique = {}
+                for text, fields in pending:
+                    unique.setdefault(text, fields)
+                stored = set(self.memory.texts_to_embed(list(unique)))
+                pending = [item for item in unique.items() if item[0] in stored]
+        if pending and where:
+            columns = MetadataColumns()
+            columns.set_many(range(len(pending)), [fields for _, fields in pending])
+            pending = [item for item, keep in zip(pending, columns.mask(where)) if keep]
+        added = {text: fields["added"] for text, fields in pending}
+        pending = [text for text, _ in pending]
+        if not pending:
+            return batch
+        rankings = [[] for _ in texts]
+        if mode != "lexical":
+            queries = np.array(get_ada_embeddings(texts), dtype=np.float32)
+            vectors = np.array(get_ada_embeddings(pending), dtype=np.float32)
+            for ranking, query_scores in zip(rankings, queries @ vectors.T):
+                ranking.append(
+                    sorted(zip(pending, query_scores.tolist()), key=lambda x: -x[1])
+                )
+        if mode != "vector":
+            lexical = BM25Index()
+            lexical.add_many(enumerate(pending))
+            for ranking, text in zip(rankings, texts):
+                hits = lexical.search(text, num_relevant)
+                ranking.append([(pending[i], score) for i, score in hits])
+        if reranker.pool_size(num_relevant, max_tokens) > num_relevant:
+            return _rerank(
+                reranker, texts, batch, rankings, added, mode, num_relevant, max_tokens
+            )
+        merged = []
+        for results, ranking in zip(batch, rankings):
+            if mode == "vector":
+                results = list(results) + ranking[0]
+                results.sort(key=lambda x: -x[1])
+            else:
+                # fuse the pending texts on their own first, the results of the
+                # provider are fused already
+                pending_ranking = reciprocal_rank_fusion(
+                    [text for text, _ in ranked] for ranked in ranking
+                )
+                results = reciprocal_rank_fusion(
+                    [[text for text, _ in results], [t for t, _ in pending_ranking]]
+                )
+            merged.append(_fit(results[:num_relevant], max_tokens))
+        return merged
+
+    def get_stats(self):
+        """
+        Returns: The stats of the memory, without the queued texts.
+        """
+        with self._memory_lock:
+            return self.memory.get_stats()
+
+
+def _rerank(
+    reranker: Reranker,
+    texts: List[str],
+    batch: List[List[Tuple[str, float]]],
+    rankings: List[List[List[Tuple[str, float]]]],
+    added: Dict[str, float],
+    mode: str,
+    num_relevant: int,
+    max_tokens: Optional[int],
+) -> List[List[Tuple[str, float]]]:
+    """
+    Re-ranks the results of the provider together with the pending texts, so
+    that a pending near duplicate of a result loses to a new memory and both
+    share the token budget.
+
+    Args:
+        reranker: The reranker of the provider.
+        texts: The queries.
+        batch: The re-ranked results of the provider for every query.
+        rankings: The rankings of the pending texts for every query, by
+            similarity and by BM25 as the mode has them.
+        added: When every pending text was added.
+        mode: "vector", "lexical" or "hybrid".
+        num_relevant: The number of relevant data to return per query.
+        max_tokens: The most tokens per query, None for no limit.
+
+    Returns: For every query, (data, decayed relevance) pairs in the order
+        they were picked.
+    """
+    candidates = [
+        list(
+            dict.fromkeys(
+                [text for text, _ in results] + [t for r in ranking for t, _ in r]
+            )
+        )
+        for results, ranking in zip(batch, rankings)
+    ]
+    unique = list(dict.fromkeys(text for found in candidates for text in found))
+    vectors = dict(zip(unique, np.array(get_ada_embeddings(unique), dtype=np.float32)))
+    if mode == "vector":
+        queries = np.array(get_ada_embeddings(texts), dtype=np.float32)
+    merged = []
+    for i, (results, ranking) in enumerate(zip(batch, rankings)):
+        if mode == "vector":
+            # the scores of the provider are re-ranked already, score both by
+            # similarity
+            matrix = np.array([vectors[text] for text in candidates[i]])
+            similarity = (matrix @ queries[i]).tolist()
+            hits = sorted(zip(candidates[i], similarity), key=lambda x: -x[1])
+        else:
+            pending_ranking = reciprocal_rank_fusion(
+                [text for text, _ in ranked] for ranked in ranking
+            )
+            hits = reciprocal_rank_fusion(
+                [[text for text, _ in results], [t for t, _ in pending_ranking]]
+            )
+        token_counts = None
+        if max_tokens is not None:
+            token_counts = [count_tokens(text) for text, _ in hits]
+        merged.append(
+            reranker.select(
+                hits,
+                np.array([vectors[text] for text, _ in hits]),
+                num_relevant,
+                # the provider decayed its results when it picked them
+                added=np.array([added.get(text, np.nan) for text, _ in hits]),
+                token_counts=token_counts,
+                max_tokens=max_tokens,
+            )
+        )
+    return merged
+
+
+def _fit(results: List[Tuple[str, float]], max_tokens: Optional[int]):
+    """
+    Returns: The results, best first, that fit max_tokens together.
+    """
+    if max_tokens is None:
+        return results
+    fitting = []
+    for text, score in results:
+        tokens = count_tokens(text)
+        if tokens <= max_tokens:
+            fitting.append((text, score))
+            max_tokens -= tokens
+    return fitting
@@ -0,0 +1,292 @@
+"""
+Approximate nearest-neighbour index for LocalCache.
+
+IVFIndex is an inverted-file index with a flat (exact) second stage. The rows are
+clustered with spherical k-means into ``nlist`` lists. A query is compared with the
+list centroids first and only the rows of its ``nprobe`` closest lists are scored,
+so ``nprobe`` trades recall for latency at query time.
+
+The index lives next to the cache data:
+
+    ivf-centroids.npy  (nlist, dim) float32 centroids, written when trained
+    ivf-lists.i32      the list of every row, appended as rows are added and
+                       rewritten in place when a row is replaced
+"""
+import math
+import os
+import threading
+from array import array
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from memories.search import top_k
+
+KMEANS_ITERATIONS = 10
+TRAIN_POINTS_PER_LIST = 64
+ASSIGN_CHUNK = 65536
+
+
+def spherical_kmeans(
+    vectors: np.ndarray, nlist: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0
+) -> np.ndarray:
+    """
+    Clusters unit vectors by cosine similarity.
+
+    Args:
+        vectors: A (n, dim) array of unit vectors.
+        nlist: The number of clusters.
+        iterations: The number of assignment/update rounds.
+        seed: The seed used to pick the initial centroids.
+
+    Returns: The (nlist, dim) unit-norm centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=nlist)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        filled = counts > 0
+        sums = np.add.reduceat(vectors[order], starts[filled], axis=0)
+        centroids[filled] = sums
+        # restart empty lists from random points
+        centroids[~filled] = vectors[rng.choice(len(vectors), int((~filled).sum()))]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    def __init__(self, path: str, dim: int, nlist: int = 0, nprobe: int = 16) -> None:
+        """
+        Opens the index files in the given directory, if any.
+
+        Args:
+            path: The directory holding the index files.
+            dim: The width of an embedding row.
+            nlist: The number of lists, 0 picks 4 * sqrt(rows) when training.
+            nprobe: The default number of lists scored per query.
+
+        Returns: None
+        """
+        self.path = path
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids: Optional[np.ndarray] = None
+        self.size = 0
+        self._lists: List[List[int]] = []
+        self._arrays: List[Optional[np.ndarray]] = []
+        # the list of every row
+        self._assignment = array("i")
+        self._lock = threading.Lock()
+        self._trainer = None
+        self._file = None
+        os.makedirs(path, exist_ok=True)
+        self.centroids_file = os.path.join(path, "ivf-centroids.npy")
+        self.lists_file = os.path.join(path, "ivf-lists.i32")
+        if os.path.exists(self.centroids_file) and os.path.exists(self.lists_file):
+            self.centroids = np.load(self.centroids_file)
+            assign = np.fromfile(self.lists_file, dtype=np.int32)
+            self._set_lists(assign)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def _set_lists(self, assign: np.ndarray) -> None:
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(len(self.centroids) + 1))
+        self._lists = [
+            order[bounds[i] : bounds[i + 1]].tolist()
+            for i in range(len(self.centroids))
+        ]
+        self._arrays = [None] * len(self.centroids)
+        self._assignment = array("i", assign.astype(np.int32).tobytes())
+        self.size = len(assign)
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        assign = [
+            np.argmax(vectors[i : i + ASSIGN_CHUNK] @ self.centroids.T, axis=1)
+            for i in range(0, len(vectors), ASSIGN_CHUNK)
+        ]
+        return (
+            np.concatenate(assign).astype(np.int32) if assign else np.zeros(0, np.int32)
+        )
+
+    def add(self, start: int, vectors: np.ndarray) -> None:
+        """
+        Assigns rows to their closest list and appends the assignment to disk.
+        Rows that are already indexed are skipped, so callers can replay rows.
+
+        Args:
+            start: The row of the first vector.
+            vectors: A (n, dim) array.
+
+        Returns: None
+        """
+        with self._lock:
+            if not self.is_trained or start + len(vectors) <= self.size:
+                return
+            vectors = np.asarray(vectors, dtype=np.float32)[self.size - start :]
+            assign = self._assign(vectors)
+            for offset, list_id in enumerate(assign.tolist()):
+                self._lists[list_id].append(self.size + offset)
+                self._arrays[list_id] = None
+            self._assignment.extend(assign.tolist())
+            if self._file is None:
+                self._file = open(self.lists_file, "ab")
+            self._file.write(assign.tobytes())
+            self._file.flush()
+            self.size += len(assign)
+
+    def update(self, rows: List[int], vectors: np.ndarray) -> None:
+        """
+        Moves replaced rows to the list closest to their new vectors. Rows that
+        are not indexed yet are left to ``add``.
+
+        Args:
+            rows: The replaced rows.
+            vectors: A (len(rows), dim) array of their new vectors.
+
+        Returns: None
+        """
+        with self._lock:
+            if not self.is_trained:
+                return
+            assign = self._assign(np.asarray(vectors, dtype=np.float32))
+            with open(self.lists_file, "r+b") as f:
+                for row, list_id in zip(rows, assign.tolist()):
+                    if row >= self.size or self._assignment[row] == list_id:
+                        continue
+                    old = self._assignment[row]
+                    self._lists[old].remove(row)
+                    self._lists[list_id].append(row)
+                    self._arrays[old] = self._arrays[list_id] = None
+                    self._assignment[row] = list_id
+                    f.seek(row * 4)
+                    f.write(np.int32(list_id).tobytes())
+
+    def train(self, matrix, seed: int = 0) -> None:
+        """
+        Clusters a sample of the rows and indexes every row of the matrix.
+
+        Args:
+            matrix: The EmbeddingMatrix of the cache. Rows appended while training
+                are indexed once the centroids are in place.
+            seed: The seed of the sample and of k-means.
+
+        Returns: None
+        """
+        rows = matrix.size
+        nlist = self.nlist or int(4 * math.sqrt(rows))
+        nlist = max(1, min(nlist, rows))
+        rng = np.random.default_rng(seed)
+        sample_size = min(rows, nlist * TRAIN_POINTS_PER_LIST)
+        sample = matrix.take(np.sort(rng.choice(rows, sample_size, replace=False)))
+        centroids = spherical_kmeans(sample, nlist, seed=seed)
+
+        assign = []
+        for first, block in matrix.blocks():
+            block = block[: max(0, rows - first)]
+            for i in range(0, len(block), ASSIGN_CHUNK):
+                chunk = np.asarray(block[i : i + ASSIGN_CHUNK])
+                assign.append(np.argmax(chunk @ centroids.T, axis=1))
+        assign = np.concatenate(assign).astype(np.int32)
+
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            np.save(f"{self.centroids_file}.tmp.npy", centroids)
+            assign.tofile(f"{self.lists_file}.tmp")
+            os.replace(f"{self.lists_file}.tmp", self.lists_file)
+            os.replace(f"{self.centroids_file}.tmp.npy", self.centroids_file)
+            self.centroids = centroids
+            self._set_lists(assign)
+        # index the rows appended while training
+        self.add(rows, matrix.take(np.arange(rows, matrix.size)))
+
+    def train_in_background(self, matrix) -> None:
+        """
+        Starts a training thread unless one is already running.
+
+        Returns: None
+        """
+        with self._lock:
+            if self._trainer is not None and self._trainer.is_alive():
+                return
+            self._trainer = threading.Thread(
+                target=self.train, args=(matrix,), daemon=True
+            )
+            self._trainer.start()
+
+    def _list_array(self, list_id: int) -> np.ndarray:
+        array = self._arrays[list_id]
+        if array is None:
+            array = np.array(self._lists[list_id], dtype=np.int64)
+            self._arrays[list_id] = array
+        return array
+
+    def search(
+        self, matrix, queries: np.ndarray, k: int, nprobe: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scores the rows of the closest lists of every query.
+
+        Args:
+            matrix: The EmbeddingMatrix the index was built on.
+            queries: A (queries, dim) array.
+            k: The number of results per query.
+            nprobe: The number of lists to score, defaults to ``self.nprobe``.
+
+        Returns: The (queries, k) row indices and scores, best first. Rows with
+            fewer than k candidates are padded with index -1 and score -inf.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes, _ = top_k(queries @ self.centroids.T, nprobe)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        with self._lock:
+            candidates = [
+                np.concatenate([self._list_array(i) for i in probe]) for probe in probes
+            ]
+        for q, rows in enumerate(candidates):
+            found, found_scores = top_k(matrix.take(rows) @ queries[q], k)
+            indices[q, : len(found)] = rows[found]
+            scores[q, : len(found)] = found_scores
+        return indices, scores
+
+    def clear(self) -> None:
+        """
+        Deletes the index files and forgets the centroids.
+
+        Returns: None
+        """
+        self.close()
+        with self._lock:
+            for filename in (self.centroids_file, self.lists_file):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            self.centroids = None
+            self._lists, self._arrays = [], []
+            self._assignment = array("i")
+            self.size = 0
+
+    def close(self) -> None:
+        """
+        Waits for training and closes the assignment file.
+
+        Returns: None
+        """
+        trainer = self._trainer
+        if trainer is not None:
+            trainer.join()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
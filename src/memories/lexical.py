@@ -0,0 +1,175 @@
+"""
+Lexical retrieval of memories, and its fusion with vector retrieval.
+
+Embeddings capture what a text is about but blur exact identifiers, so a query
+for a file name, URL or error code may miss the memory that contains it. A
+BM25Index keeps an inverted index of the words of every memory, updated on every
+add, and ranks memories by BM25. Identifiers are indexed whole as well as by
+their words, so "src/main.py" matches both "main" and the exact path.
+
+Memory providers search in one of three modes (MEMORY_SEARCH_MODE):
+
+    vector   cosine similarity of the embeddings
+    lexical  BM25, the query is not embedded
+    hybrid   both rankings, fused by reciprocal rank
+"""
+import heapq
+import math
+import re
+from collections import Counter
+from typing import Dict
+from typing import Hashable
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+SEARCH_MODES = ("vector", "lexical", "hybrid")
+# the rank offset of reciprocal rank fusion, 60 in the original paper
+RRF_K = 60
+# hybrid search fuses this many times the requested results of each ranking
+FUSION_DEPTH = 2
+WORD = re.compile(r"\w+")
+# punctuation around an identifier, such as quotes or a trailing period
+EDGES = "\"'`.,;:!?()[]{}<>"
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into lowercase words, adding every identifier that joins
+    several words with punctuation as one more token.
+
+    Args:
+        text: The text to split.
+
+    Returns: The tokens, in the order of the text.
+    """
+    tokens = []
+    for chunk in text.lower().split():
+        words = WORD.findall(chunk)
+        tokens.extend(words)
+        if len(words) > 1:
+            tokens.append(chunk.strip(EDGES))
+    return tokens
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        """
+        Creates an empty index.
+
+        Args:
+            k1: How quickly repeating a term stops raising the score.
+            b: How much the score is normalized by the length of a memory.
+
+        Returns: None
+        """
+        self.k1 = k1
+        self.b = b
+        # term -> memory id -> term frequency
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._lengths: Dict[int, int] = {}
+        self._terms: Dict[int, Tuple[str, ...]] = {}
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def __contains__(self, memory_id: int) -> bool:
+        return memory_id in self._lengths
+
+    def add(self, memory_id: int, text: str) -> None:
+        """
+        Indexes a memory, replacing the text it had before.
+
+        Returns: None
+        """
+        self.remove(memory_id)
+        counts = Counter(tokenize(text))
+        for term, count in counts.items():
+            self._postings.setdefault(term, {})[memory_id] = count
+        length = sum(counts.values())
+        self._lengths[memory_id] = length
+        self._terms[memory_id] = tuple(counts)
+        self._total_length += length
+
+    def add_many(self, memories: Iterable[Tuple[int, str]]) -> None:
+        for memory_id, text in memories:
+            self.add(memory_id, text)
+
+    def remove(self, memory_id: int) -> None:
+        length = self._lengths.pop(memory_id, None)
+        if length is None:
+            return
+        self._total_length -= length
+        for term in self._terms.pop(memory_id):
+            postings = self._postings[term]
+            del postings[memory_id]
+            if not postings:
+                del self._postings[term]
+
+    def clear(self) -> None:
+        self._postings.clear()
+        self._lengths.clear()
+        self._terms.clear()
+        self._total_length = 0
+
+    def search(
+        self, query: str, k: int, allowed: Optional[Sequence[bool]] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Ranks the memories that share a term with the query.
+
+        Args:
+            query: The query text.
+            k: The number of results.
+            allowed: A boolean array indexed by memory id, the memories it
+                leaves out are not ranked.
+
+        Returns: Up to k (memory id, BM25 score) pairs, best first.
+        """
+        n = len(self._lengths)
+        if not n or k <= 0:
+            return []
+        average_length = self._total_length / n
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            df = len(postings)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for memory_id, tf in postings.items():
+                if allowed is not None and not allowed[memory_id]:
+                    continue
+                norm = 1 - self.b + self.b * self._lengths[memory_id] / average_length
+                score = idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+                scores[memory_id] = scores.get(memory_id, 0.0) + score
+        return heapq.nlargest(k, scores.items(), key=lambda x: x[1])
+
+
+def reciprocal_rank_fusion(
+    rankings: Iterable[Iterable[Hashable]], k: int = RRF_K
+) -> List[Tuple[Hashable, float]]:
+    """
+    Fuses rankings of different scales by summing 1 / (k + rank) over the
+    rankings each item appears in.
+
+    Args:
+        rankings: Rankings of items, best first.
+        k: The rank offset, larger values favour agreement over top ranks.
+
+    Returns: (item, fused score) pairs, best first.
+    """
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: -x[1])
+
+
+def check_mode(mode: str) -> str:
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {mode!r}, expected {SEARCH_MODES}")
+    return mode
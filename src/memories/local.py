@@ -1,32 +1,220 @@
 """
-LocalCache is a memory provider that stores data in a local file.
-The file is in JSON format and consists of text data and their corresponding embeddings.
+LocalCache is a memory provider that stores data in a local directory.
+The directory is an append-only segmented log of text data and their corresponding embeddings,
+compacted into memory-mapped snapshots so that startup does not parse anything.
 The embeddings are generated using OpenAI's Ada embeddings model.
 """
 import dataclasses
 import os
+import time
+from collections.abc import Sequence
 from typing import Any
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 import numpy as np
 import orjson
 
-from memories.base import get_ada_embedding
+from memories.base import count_tokens
+from memories.base import EMBEDDING_DIMENSION
+from memories.base import get_ada_embeddings
+from memories.base import get_embedding_provider
 from memories.base import MemoryProviderSingleton
+from memories.dedup import Deduplicator
+from memories.dedup import DuplicateRecords
+from memories.dedup import fingerprint
+from memories.dedup import new_records
+from memories.embedding_cache import get_embedding_cache
+from memories.eviction import evictor_from_config
+from memories.eviction import USAGE
+from memories.ivf import IVFIndex
+from memories.lexical import BM25Index
+from memories.lexical import check_mode
+from memories.lexical import FUSION_DEPTH
+from memories.lexical import reciprocal_rank_fusion
+from memories.metadata import check_metadata
+from memories.metadata import Metadata
+from memories.metadata import MetadataFile
+from memories.records import RecordFile
+from memories.rerank import reranker_from_config
+from memories.search import top_k
+from memories.segments import copy_on_write
+from memories.segments import SegmentLog
+from memories.sharded import ShardedSearch
 
-EMBED_DIM = 1536
-SAVE_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SERIALIZE_DATACLASS
+# the dimension of the default embedding provider, a memory uses the dimension
+# of the configured one
+EMBED_DIM = EMBEDDING_DIMENSION
+INITIAL_CAPACITY = 1024
+
+
+class EmbeddingMatrix:
+    """
+    A float32 matrix that rows are appended to. It starts from an optional
+    read-only base, usually a memory-mapped snapshot, and appended rows go to a
+    buffer that doubles its capacity when it is full, so n appends cost O(n)
+    copies in total.
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        capacity: int = INITIAL_CAPACITY,
+        base: Optional[np.ndarray] = None,
+    ) -> None:
+        self.dim = dim
+        self.base = np.zeros((0, dim), dtype=np.float32) if base is None else base
+        self.size = len(self.base)
+        self._buffer = np.zeros((capacity, dim), dtype=np.float32)
+
+    @property
+    def capacity(self) -> int:
+        return self._buffer.shape[0]
+
+    @property
+    def tail(self) -> np.ndarray:
+        """
+        Returns: A view of the rows appended after the base.
+        """
+        return self._buffer[: self.size - len(self.base)]
+
+    @property
+    def array(self) -> np.ndarray:
+        """
+        Returns: The filled rows. This is a view unless both the base and the
+            appended rows are non-empty, in which case they are copied together.
+        """
+        if not len(self.base):
+            return self.tail
+        if self.size == len(self.base):
+            return self.base
+        return np.concatenate([self.base, self.tail])
+
+    @property
+    def shape(self):
+        return self.size, self.dim
+
+    def __len__(self) -> int:
+        return self.size
+
+    def blocks(self):
+        """
+        Yields: (first row, rows) for the base and the appended rows.
+        """
+        if len(self.base):
+            yield 0, self.base
+        if self.size > len(self.base):
+            yield len(self.base), self.tail
+
+    def __setitem__(self, row: int, vector: np.ndarray) -> None:
+        """
+        Replaces a row. Rows of a memory-mapped base are only changed in memory.
+        """
+        if row < len(self.base):
+            self.base = copy_on_write(self.base)
+            self.base[row] = vector
+        else:
+            self.tail[row - len(self.base)] = vector
+
+    def take(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Gathers rows by index.
+
+        Args:
+            indices: The rows to gather.
+
+        Returns: A (len(indices), dim) copy of the rows.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        in_base = indices < len(self.base)
+        if in_base.all():
+            return np.asarray(self.base[indices], dtype=np.float32)
+        rows = np.empty((len(indices), self.dim), dtype=np.float32)
+        rows[in_base] = self.base[indices[in_base]]
+        rows[~in_base] = self.tail[indices[~in_base] - len(self.base)]
+        return rows
+
+    def dot(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Multiplies the matrix with a vector or with a (dim, m) matrix without
+        copying the base.
+
+        Args:
+            vectors: A (dim,) or (dim, m) array.
+
+        Returns: A (size,) or (size, m) array.
+        """
+        shape = (0,) + np.shape(vectors)[1:]
+        parts = [np.dot(rows, vectors) for _, rows in self.blocks()]
+        return np.concatenate(parts) if parts else np.zeros(shape, np.float32)
+
+    def append(self, rows: np.ndarray) -> int:
+        """
+        Appends rows to the end of the matrix.
+
+        Args:
+            rows: A (n, dim) or (dim,) array.
+
+        Returns: The index of the first appended row.
+        """
+        rows = np.asarray(rows, dtype=np.float32).reshape(-1, self.dim)
+        start = self.size - len(self.base)
+        needed = start + rows.shape[0]
+        if needed > self.capacity:
+            buffer = np.zeros((max(needed, 2 * self.capacity), self.dim), np.float32)
+            buffer[:start] = self._buffer[:start]
+            self._buffer = buffer
+        self._buffer[start:needed] = rows
+        self.size += rows.shape[0]
+        return len(self.base) + start
+
+
+class TextList(Sequence):
+    """
+    The texts of the cache: an optional read-only base, usually the texts of a
+    snapshot, followed by the texts added since.
+    """
+
+    def __init__(self, base: Sequence = ()) -> None:
+        self.base = base
+        self.tail: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.base) + len(self.tail)
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if index < len(self.base):
+            return self.base[index]
+        return self.tail[index - len(self.base)]
+
+    def __setitem__(self, index: int, text: str) -> None:
+        if index < 0:
+            index += len(self)
+        if index < len(self.base):
+            self.base[index] = text
+        else:
+            self.tail[index - len(self.base)] = text
+
+    def append(self, text: str) -> None:
+        self.tail.append(text)
+
+    def extend(self, texts: List[str]) -> None:
+        self.tail.extend(texts)
 
 
 def create_default_embeddings():
-    return np.zeros((0, EMBED_DIM)).astype(np.float32)
+    return EmbeddingMatrix(EMBED_DIM)
 
 
 @dataclasses.dataclass
 class CacheContent:
-    texts: List[str] = dataclasses.field(default_factory=list)
-    embeddings: np.ndarray = dataclasses.field(
+    texts: TextList = dataclasses.field(default_factory=TextList)
+    embeddings: EmbeddingMatrix = dataclasses.field(
         default_factory=create_default_embeddings
     )
 
@@ -35,43 +223,376 @@ class LocalCache(MemoryProviderSingleton):
     # on load, load our database
     def __init__(self, cfg) -> None:
         self.filename = f"{cfg.memory_index}.json"
-        if os.path.exists(self.filename):
-            with open(self.filename, "rb") as f:
-                loaded = orjson.loads(f.read())
-                self.data = CacheContent(**loaded)
-        else:
-            self.data = CacheContent()
+        self.dimension = get_embedding_provider().dimension
+        self.log = SegmentLog(f"{cfg.memory_index}.mem", self.dimension)
+        if os.path.exists(self.filename) and self.log.is_empty():
+            self._convert_json()
+        base_texts, base_embeddings, texts, embeddings = self.log.load()
+        self.data = CacheContent(
+            TextList(base_texts),
+            EmbeddingMatrix(self.dimension, base=base_embeddings),
+        )
+        self.data.texts.extend(texts)
+        self.data.embeddings.append(embeddings)
+        self.search_mode = check_mode(cfg.memory_search_mode)
+        self.reranker = reranker_from_config(cfg)
+        # built on the first lexical or hybrid query
+        self.lexical: Optional[BM25Index] = None
+        # started on the first query once there are enough rows
+        self.shards: Optional[ShardedSearch] = None
+        self.search_workers = cfg.memory_search_workers
+        self.shard_min_rows = cfg.memory_shard_min_rows
+        self._open_duplicates(cfg.memory_dedup, cfg.memory_dedup_distance)
+        self.metadata = MetadataFile(os.path.join(self.log.path, "metadata.jsonl"))
+        self.metadata.load(len(self.data.texts))
+        self._open_usage(cfg)
+
+        self.index = None
+        if cfg.memory_ann_index == "ivf":
+            self.index = IVFIndex(
+                self.log.path,
+                self.dimension,
+                nlist=cfg.memory_ann_nlist,
+                nprobe=cfg.memory_ann_nprobe,
+            )
+            self.ann_min_rows = cfg.memory_ann_min_rows
+            if self.index.size > self.data.embeddings.size:
+                # the index outlived rows lost to a torn write, rebuild it
+                self.index.clear()
+            self._update_index()
+
+    def _open_duplicates(self, policy: str, max_distance: int) -> None:
+        """
+        Loads the fingerprints of the rows, computing those of rows stored
+        before fingerprints were kept, and indexes them unless dedup is off.
+
+        Returns: None
+        """
+        self.seen = DuplicateRecords(os.path.join(self.log.path, "dedup.bin"))
+        rows = len(self.data.texts)
+        if len(self.seen) > rows:
+            self.seen.truncate(rows)
+        if len(self.seen) < rows:
+            missing = range(len(self.seen), rows)
+            self.seen.write(
+                len(self.seen),
+                new_records([fingerprint(self.data.texts[i]) for i in missing]),
+            )
+        self.duplicates = Deduplicator(policy, max_distance)
+        if policy != "off":
+            records = self.seen.records
+            for row, fingerprints in enumerate(
+                zip(records["exact"].tolist(), records["simhash"].tolist())
+            ):
+                self.duplicates.remember(row, fingerprints)
+
+    def _open_usage(self, cfg) -> None:
+        """
+        Loads the usage of the rows when the memory is bounded, and releases
+        the rows that no longer fit if the capacity was lowered.
+
+        Returns: None
+        """
+        self.evictor = evictor_from_config(cfg)
+        self.free_rows: List[int] = []
+        if self.evictor is None:
+            return
+        self.usage = RecordFile(os.path.join(self.log.path, "usage.bin"), USAGE)
+        rows = len(self.data.texts)
+        if len(self.usage) > rows:
+            self.usage.truncate(rows)
+        if len(self.usage) < rows:
+            missing = np.zeros(rows - len(self.usage), dtype=USAGE)
+            missing["added"] = missing["last_used"] = time.time()
+            self.usage.write(len(self.usage), missing)
+        records = self.usage.records
+        live = records["added"] > 0
+        self.free_rows = np.flatnonzero(~live).tolist()
+        self.evictor.track_many(np.flatnonzero(live).tolist(), records[live])
+        while len(self.evictor) > self.evictor.capacity:
+            self._release(self.evictor.victim())
+
+    def _release(self, row: int) -> None:
+        """
+        Empties an evicted row that is not reused right away. Empty rows are
+        left out of query results and reused by later adds.
+
+        Returns: None
+        """
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        self.log.append(row, "", vector)
+        self.data.texts[row] = ""
+        self.data.embeddings[row] = vector
+        if self.shards is not None:
+            self.shards[row] = vector
+        self.duplicates.forget(row)
+        if self.lexical is not None:
+            self.lexical.remove(row)
+        self.metadata.write([row], [{}])
+        self.usage.write(row, np.zeros(1, dtype=USAGE))
+        self.free_rows.append(row)
 
-    def add(self, text: str):
+    def _convert_json(self) -> None:
+        """
+        Converts a memory file written by the JSON format into the segmented log.
+        The JSON format prepended every new embedding, so its rows are reversed.
+        The old file is kept with a ``.bak`` suffix.
+
+        Returns: None
+        """
+        with open(self.filename, "rb") as f:
+            loaded = orjson.loads(f.read())
+        texts = loaded.get("texts", [])
+        embeddings = np.asarray(loaded.get("embeddings", []), dtype=np.float32)
+        self.log.extend(0, texts, embeddings.reshape(-1, self.dimension)[::-1])
+        self.log.compact(seal_active=True)
+        os.replace(self.filename, f"{self.filename}.bak")
+
+    def add(self, text: str, metadata: Optional[Metadata] = None):
         """
         Add text to our list of texts, add embedding as row to our
             embeddings-matrix
 
         Args:
             text: str
+            metadata: The metadata queries can filter the text by
 
         Returns: None
         """
         if "Command Error:" in text:
             return ""
-        self.data.texts.append(text)
-
-        embedding = get_ada_embedding(text)
-
-        vector = np.array(embedding).astype(np.float32)
-        vector = vector[np.newaxis, :]
-        self.data.embeddings = np.concatenate(
-            [
-                vector,
-                self.data.embeddings,
-            ],
-            axis=0,
+        return text if self.add_many([text], [metadata]) else ""
+
+    def add_many(
+        self, texts: List[str], metadata: Optional[List[Metadata]] = None
+    ) -> List[str]:
+        """
+        Add several texts at once, appending their embeddings as rows of the
+            embeddings-matrix in the same order as the texts. Duplicates of
+            stored memories are handled by the dedup policy before they are
+            embedded, and a bounded memory writes new texts over the rows of
+            evicted ones
+
+        Args:
+            texts: List[str]
+            metadata: The metadata of every text, or None
+
+        Returns: The texts that were added or merged into a memory
+        """
+        return self._store(texts, get_ada_embeddings, metadata)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadata: Optional[List[Metadata]] = None,
+    ) -> List[str]:
+        """
+        Add texts with the embeddings they were stored with in another memory,
+            like add_many but without embedding them
+
+        Args:
+            texts: List[str]
+            embeddings: A (len(texts), dim) array
+            metadata: The metadata of every text, or None
+
+        Returns: The texts that were added or merged into a memory
+        """
+        vectors = dict(zip(texts, np.asarray(embeddings, dtype=np.float32)))
+        return self._store(
+            texts, lambda stored: [vectors[text] for text in stored], metadata
+        )
+
+    def _store(
+        self, texts: List[str], embed, metadata: Optional[List[Metadata]] = None
+    ) -> List[str]:
+        """
+        Applies the dedup and eviction policies to texts and writes the ones
+            that are stored
+
+        Args:
+            texts: List[str]
+            embed: Returns the embeddings of a list of texts
+            metadata: The metadata of every text, or None
+
+        Returns: The texts that were added or merged into a memory
+        """
+        now = time.time()
+        items = [
+            (text, check_metadata(fields, now))
+            for text, fields in zip(texts, metadata or [None] * len(texts))
+            if "Command Error:" not in text
+        ]
+        writes = self._plan_writes(items)
+        if not writes:
+            return []
+        rows = list(writes)
+        stored = [writes[row][0] for row in rows]
+        vectors = np.array(embed(stored), dtype=np.float32)
+        vectors = vectors.reshape(len(stored), self.dimension)
+
+        start = len(self.data.texts)
+        appended = sorted(
+            (i for i, row in enumerate(rows) if row >= start), key=rows.__getitem__
         )
+        replaced = [i for i, row in enumerate(rows) if row < start]
+        if appended:
+            new_texts = [stored[i] for i in appended]
+            self.log.extend(start, new_texts, vectors[appended])
+            self.data.texts.extend(new_texts)
+            self.data.embeddings.append(vectors[appended])
+        for i in replaced:
+            self.log.append(rows[i], stored[i], vectors[i])
+            self.data.texts[rows[i]] = stored[i]
+            self.data.embeddings[rows[i]] = vectors[i]
+        if self.shards is not None:
+            self.shards.append(vectors[appended])
+            for i in replaced:
+                self.shards[rows[i]] = vectors[i]
+        if self.lexical is not None:
+            self.lexical.add_many(zip(rows, stored))
+        self.metadata.write(rows, [writes[row][3] for row in rows])
+
+        records = np.zeros(len(rows), dtype=self.seen.dtype)
+        for i, row in enumerate(rows):
+            _, fingerprints, count, _ = writes[row]
+            if count is None:
+                # a merge keeps the counters of the memory
+                records[i] = self.seen.records[row]
+            else:
+                records[i] = new_records([fingerprints])[0]
+                records[i]["count"] = count
+            records[i]["exact"], records[i]["simhash"] = fingerprints
+        if appended:
+            self.seen.write(start, records[appended])
+        self.seen.write_rows([rows[i] for i in replaced], records[replaced])
+        if self.evictor is not None:
+            usage = np.zeros(len(rows), dtype=USAGE)
+            for i, row in enumerate(rows):
+                if row in self.evictor:
+                    usage[i] = self.evictor.usage(row)
+                else:
+                    usage[i] = self.usage.records[row]
+            if appended:
+                self.usage.write(start, usage[appended])
+            self.usage.write_rows([rows[i] for i in replaced], usage[replaced])
+
+        if replaced and self.index is not None:
+            self.index.update([rows[i] for i in replaced], vectors[replaced])
+        self._update_index()
+        return stored
+
+    def _plan_writes(self, items: List[Tuple[str, Metadata]]) -> Dict[int, list]:
+        """
+        Applies the dedup policy to texts about to be added and picks the row
+        of every text that is stored.
+
+        Args:
+            items: The (text, metadata) pairs to add
+
+        Returns: The [text, fingerprints, repeat count, metadata] to write, by
+            row. The count is None for a text merged into the memory of its row
+        """
+        next_row = len(self.data.texts)
+        writes = {}
+        for text, metadata in items:
+            fingerprints = fingerprint(text)
+            action, row = self.duplicates.decide(fingerprints)
+            if action == "add":
+                row = self._free_row()
+                if row is None:
+                    row, next_row = next_row, next_row + 1
+                # the row may belong to a text of this batch that was evicted
+                writes.pop(row, None)
+                writes[row] = [text, fingerprints, 1, metadata]
+                self.duplicates.remember(row, fingerprints)
+                if self.evictor is not None:
+                    self.evictor.track(row)
+                continue
+            if action == "skip":
+                continue
+            if row in writes and writes[row][2] is not None:
+                # repeats a text of the same batch
+                writes[row][2] += 1
+                if action == "merge":
+                    writes[row][:2] = text, fingerprints
+                    writes[row][3] = metadata
+            else:
+                self.seen.bump(row)
+                if action == "merge":
+                    writes[row] = [text, fingerprints, None, metadata]
+            if action == "merge":
+                self.duplicates.remember(row, fingerprints)
+        return writes
+
+    def _free_row(self) -> Optional[int]:
+        """
+        Returns: A released row or the row of the memory evicted to make
+            room, None if the memory is not full
+        """
+        if self.evictor is None:
+            return None
+        row = self.evictor.victim()
+        if row is not None:
+            self.duplicates.forget(row)
+            return row
+        return self.free_rows.pop() if self.free_rows else None
+
+    def iter_embeddings(
+        self, start: int = 0, batch_size: int = 1024
+    ) -> Iterator[Tuple[int, List[str], np.ndarray, List[Metadata]]]:
+        """
+        Streams the stored texts, their embeddings and their metadata in row
+            order, skipping released rows
+
+        Args:
+            start: The row to start from, a cursor yielded before
+            batch_size: The number of rows per batch
+
+        Returns: (cursor after the batch, texts, embeddings, metadata) per
+            batch
+        """
+        size = len(self.data.texts)
+        for first in range(start, size, batch_size):
+            rows = [
+                row
+                for row in range(first, min(first + batch_size, size))
+                if self.data.texts[row]
+            ]
+            texts = [self.data.texts[row] for row in rows]
+            yield (
+                first + batch_size,
+                texts,
+                self.data.embeddings.take(rows),
+                self.metadata.columns.get(rows),
+            )
+
+    def texts_to_embed(self, texts: List[str]) -> List[str]:
+        """
+        Returns: The texts that add_many would embed, the dedup policy drops
+            or bumps the others without an embedding
+        """
+        return [
+            text
+            for text in texts
+            if "Command Error:" not in text and self.duplicates.needs_embedding(text)
+        ]
 
-        with open(self.filename, "wb") as f:
-            out = orjson.dumps(self.data, option=SAVE_OPTIONS)
-            f.write(out)
-        return text
+    def _update_index(self) -> None:
+        """
+        Indexes the rows the approximate index has not seen yet, or starts
+        training it in the background once there are enough rows.
+
+        Returns: None
+        """
+        if self.index is None:
+            return
+        matrix = self.data.embeddings
+        if self.index.is_trained:
+            new_rows = np.arange(self.index.size, matrix.size)
+            self.index.add(self.index.size, matrix.take(new_rows))
+        elif matrix.size >= self.ann_min_rows:
+            self.index.train_in_background(matrix)
 
     def clear(self) -> str:
         """
@@ -79,7 +600,20 @@ class LocalCache(MemoryProviderSingleton):
 
         Returns: A message indicating that the memory has been cleared.
         """
-        self.data = CacheContent()
+        self.log.clear()
+        self.seen.clear()
+        self.duplicates.clear()
+        if self.evictor is not None:
+            self.usage.clear()
+            self.evictor.clear()
+            self.free_rows = []
+        if self.index is not None:
+            self.index.clear()
+        if self.shards is not None:
+            self.shards.clear()
+        self.lexical = None
+        self.metadata.clear()
+        self.data = CacheContent(TextList(), EmbeddingMatrix(self.dimension))
         return "Obliviated"
 
     def get(self, data: str) -> Optional[List[Any]]:
@@ -93,7 +627,14 @@ class LocalCache(MemoryProviderSingleton):
         """
         return self.get_relevant(data, 1)
 
-    def get_relevant(self, text: str, k: int) -> List[Any]:
+    def get_relevant(
+        self,
+        text: str,
+        k: int,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[Any]:
         """ "
         matrix-vector mult to find score-for-each-row-of-matrix
         get indices for top-k winning scores
@@ -101,19 +642,201 @@ class LocalCache(MemoryProviderSingleton):
         Args:
             text: str
             k: int
+            mode: "vector", "lexical" or "hybrid", defaults to MEMORY_SEARCH_MODE
+            where: A metadata filter, see memories.metadata
+            max_tokens: The most tokens of all returned texts, None for no limit
 
         Returns: List[str]
         """
-        embedding = get_ada_embedding(text)
+        return [
+            memory
+            for memory, _ in self.get_relevant_batch(
+                [text], k, mode, where, max_tokens
+            )[0]
+        ]
+
+    def get_relevant_batch(
+        self,
+        texts: List[str],
+        k: int,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Embeds all queries with one request, scores them with one matrix-matrix
+        product and selects the top-k of every query with a partial sort.
+        Lexical queries are ranked by BM25 without embedding them, hybrid
+        queries fuse both rankings by reciprocal rank. A metadata filter is
+        evaluated on the metadata columns first, only the rows it selects are
+        scored. With re-ranking on or a token budget, a larger pool of
+        candidates is re-ranked by recency and diversity, see memories.rerank
+
+        Args:
+            texts: List[str]
+            k: int
+            mode: "vector", "lexical" or "hybrid", defaults to MEMORY_SEARCH_MODE
+            where: A metadata filter, see memories.metadata
+            max_tokens: The most tokens of the texts returned per query, None
+                for no limit
+
+        Returns: For every query, the (text, score) pairs of its k most
+            relevant memories, best first. Scores are cosine similarities,
+            BM25 scores or fused reciprocal ranks, depending on the mode, or
+            decayed relevances scaled to a best of 1 when re-ranked
+        """
+        if not texts:
+            return []
+        mode = check_mode(mode or self.search_mode)
+        pool = self.reranker.pool_size(k, max_tokens)
+        depth = pool if mode == "vector" else FUSION_DEPTH * pool
+        allowed = None
+        if where:
+            columns = self.metadata.columns
+            columns.grow(len(self.data.texts))
+            allowed = columns.mask(where)
+        rankings = [[] for _ in texts]
+        if mode != "lexical":
+            queries = np.array(get_ada_embeddings(texts), dtype=np.float32)
+            indices, scores = self.search(queries, depth, allowed)
+            for ranking, row, row_scores in zip(
+                rankings, indices.tolist(), scores.tolist()
+            ):
+                # released rows are empty
+                ranking.append(
+                    [
+                        (i, score)
+                        for i, score in zip(row, row_scores)
+                        if i >= 0 and self.data.texts[i]
+                    ]
+                )
+        if mode != "vector":
+            lexical = self._lexical_index()
+            for ranking, text in zip(rankings, texts):
+                ranking.append(lexical.search(text, depth, allowed))
+
+        batch, retrieved = [], []
+        for ranking in rankings:
+            if mode == "hybrid":
+                hits = reciprocal_rank_fusion(
+                    [i for i, _ in ranked] for ranked in ranking
+                )[:pool]
+            else:
+                hits = ranking[0]
+            if pool > k:
+                hits = self._rerank(hits, k, max_tokens)
+            batch.append([(self.data.texts[i], float(score)) for i, score in hits])
+            retrieved.extend(i for i, _ in hits)
+        self._touch(retrieved)
+        return batch
+
+    def _rerank(
+        self, hits: List[Tuple[int, float]], k: int, max_tokens: Optional[int]
+    ) -> List[Tuple[int, float]]:
+        """
+        Returns: The (row, score) results picked from the candidates of a query
+        """
+        rows = [i for i, _ in hits]
+        token_counts = None
+        if max_tokens is not None:
+            token_counts = [count_tokens(self.data.texts[i]) for i in rows]
+        return self.reranker.select(
+            hits,
+            self.data.embeddings.take(rows),
+            k,
+            added=self.metadata.columns.numbers_of("added", rows),
+            token_counts=token_counts,
+            max_tokens=max_tokens,
+        )
+
+    def _lexical_index(self) -> BM25Index:
+        if self.lexical is None:
+            self.lexical = BM25Index()
+            self.lexical.add_many(
+                (row, text) for row, text in enumerate(self.data.texts) if text
+            )
+        return self.lexical
+
+    def _touch(self, rows: List[int]) -> None:
+        """
+        Records a retrieval of rows for eviction.
+
+        Returns: None
+        """
+        if self.evictor is None or not rows:
+            return
+        rows = sorted(set(rows))
+        self.evictor.touch(rows)
+        usage = np.array([self.evictor.usage(row) for row in rows], dtype=USAGE)
+        self.usage.write_rows(rows, usage)
+
+    def search(
+        self, queries: np.ndarray, k: int, allowed: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scores every row against a batch of query embeddings, or only the
+            rows of the closest lists when the approximate index is trained.
+            Exact scoring is spread over worker processes when
+            MEMORY_SEARCH_WORKERS is set and there are enough rows. Rows
+            selected by a metadata filter are gathered and scored exactly
+
+        Args:
+            queries: A (queries, dim) array
+            k: int
+            allowed: A boolean mask of the rows to score, None for all rows
+
+        Returns: The (queries, k) row indices and scores, best first; missing
+            results have index -1
+        """
+        if allowed is not None:
+            rows = np.flatnonzero(allowed)
+            scores = np.asarray(queries, np.float32) @ self.data.embeddings.take(rows).T
+            indices, scores = top_k(scores, k)
+            return rows[indices], scores
+        if self.index is not None and self.index.is_trained:
+            return self.index.search(self.data.embeddings, queries, k)
+        if self._sharded():
+            return self.shards.search(queries, k)
+        scores = self.data.embeddings.dot(np.asarray(queries, np.float32).T).T
+        return top_k(scores, k)
 
-        scores = np.dot(self.data.embeddings, embedding)
+    def _sharded(self) -> bool:
+        """
+        Starts the search workers once there are enough rows to spread over
+        them, copying the embeddings to their shared memory.
 
-        top_k_indices = np.argsort(scores)[-k:][::-1]
+        Returns: Whether queries are scored by the workers
+        """
+        if (
+            self.shards is None
+            and self.search_workers > 0
+            and self.data.embeddings.size >= self.shard_min_rows
+        ):
+            self.shards = ShardedSearch(self.dimension, self.search_workers)
+            self.shards.extend(self.data.embeddings)
+        return self.shards is not None
 
-        return [self.data.texts[i] for i in top_k_indices]
+    def close(self) -> None:
+        """
+        Waits for a running compaction and index training, closes the files
+        of the log and the index and stops the search workers, if they were
+        started. The files are opened again if the cache is used again.
+
+        Returns: None
+        """
+        self.log.close()
+        if self.index is not None:
+            self.index.close()
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
 
     def get_stats(self):
         """
-        Returns: The stats of the local cache.
+        Returns: The stats of the local cache and of the embedding cache.
         """
-        return len(self.data.texts), self.data.embeddings.shape
+        return (
+            len(self.data.texts),
+            self.data.embeddings.shape,
+            get_embedding_cache().stats(),
+        )
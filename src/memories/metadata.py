@@ -0,0 +1,350 @@
+"""
+Metadata of memories and the filters that select memories by it.
+
+Metadata is a flat dict of field names to strings, numbers or booleans, stored
+with a memory when it is added. Every memory gets an ``added`` field, the time
+it was added, unless one is given.
+
+A filter, the ``where`` argument of the queries, maps fields to conditions that
+must all hold:
+
+    {"command": "google"}                      equal to a value
+    {"command": ["google", "browse_website"]}  equal to one of the values
+    {"added": {"gte": time.time() - 3600}}     in a range, with gt, gte, lt, lte
+
+A memory without the field never matches a condition on it. Providers apply the
+filter before ranking, so a query returns up to k matching memories instead of
+the matches among the k best memories.
+
+MetadataColumns holds the metadata of the rows of a local memory as NumPy
+columns, numbers as float64 with NaN for a missing value and strings and
+booleans as int32 codes into a vocabulary, so a filter is evaluated as a boolean
+mask over all rows with a few vectorized comparisons.
+"""
+import os
+import re
+import time
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+import orjson
+
+FIELD = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+# fields the providers store next to the metadata
+RESERVED = frozenset(
+    (
+        "data",
+        "embedding",
+        "exact",
+        "simhash",
+        "count",
+        "last_seen",
+        "last_used",
+        "retrievals",
+        "vector_score",
+        "raw_text",
+    )
+)
+RANGE_OPERATORS = ("gt", "gte", "lt", "lte")
+INITIAL_ROWS = 1024
+
+Metadata = Dict[str, Any]
+# (field, "in", values) or (field, "range", (low, low inclusive, high, high
+# inclusive))
+Condition = Tuple[str, str, tuple]
+
+
+def is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_metadata(metadata: Optional[Metadata], now: Optional[float] = None):
+    """
+    Validates the metadata of a memory about to be added.
+
+    Args:
+        metadata: The metadata, None for none.
+        now: The time the memory is added, defaults to now.
+
+    Returns: A copy of the metadata with the ``added`` field set.
+    """
+    metadata = dict(metadata or {})
+    for name, value in metadata.items():
+        if not isinstance(name, str) or not FIELD.match(name) or name in RESERVED:
+            raise ValueError(f"Invalid metadata field {name!r}")
+        if not isinstance(value, (str, bool, int, float)):
+            raise ValueError(
+                f"Metadata field {name!r} must be a string, number or boolean,"
+                f" not {type(value).__name__}"
+            )
+    if not is_number(metadata.setdefault("added", now or time.time())):
+        raise ValueError("Metadata field 'added' must be a timestamp")
+    return metadata
+
+
+def parse_where(where: Optional[Metadata]) -> List[Condition]:
+    """
+    Parses a filter.
+
+    Args:
+        where: The filter, see the module docstring.
+
+    Returns: Its conditions, empty for no filter.
+    """
+    conditions = []
+    for name, condition in (where or {}).items():
+        if isinstance(condition, dict):
+            unknown = set(condition) - set(RANGE_OPERATORS)
+            if unknown or not condition:
+                raise ValueError(
+                    f"Invalid range for {name!r}, expected {RANGE_OPERATORS}"
+                )
+            if not all(is_number(value) for value in condition.values()):
+                raise ValueError(f"The range of {name!r} must be numbers")
+            low, low_inclusive = -np.inf, True
+            high, high_inclusive = np.inf, True
+            if "gt" in condition:
+                low, low_inclusive = condition["gt"], False
+            if "gte" in condition and condition["gte"] > low:
+                low, low_inclusive = condition["gte"], True
+            if "lt" in condition:
+                high, high_inclusive = condition["lt"], False
+            if "lte" in condition and condition["lte"] < high:
+                high, high_inclusive = condition["lte"], True
+            conditions.append(
+                (name, "range", (low, low_inclusive, high, high_inclusive))
+            )
+        else:
+            values = (
+                condition if isinstance(condition, (list, tuple, set)) else [condition]
+            )
+            for value in values:
+                if not isinstance(value, (str, bool, int, float)):
+                    raise ValueError(
+                        f"Invalid value {value!r} for {name!r}, expected strings,"
+                        " numbers or booleans"
+                    )
+            conditions.append((name, "in", tuple(values)))
+    return conditions
+
+
+class MetadataColumns:
+    def __init__(self) -> None:
+        self.size = 0
+        self._capacity = 0
+        self.numbers: Dict[str, np.ndarray] = {}
+        self.codes: Dict[str, np.ndarray] = {}
+        # field -> value -> code, for strings and booleans
+        self.vocabulary: Dict[str, Dict[Any, int]] = {}
+
+    def __len__(self) -> int:
+        return self.size
+
+    def grow(self, size: int) -> None:
+        """Extends the columns to size rows, new rows have no metadata."""
+        if size > self._capacity:
+            capacity = max(size, 2 * self._capacity, INITIAL_ROWS)
+            for columns, missing in ((self.numbers, np.nan), (self.codes, -1)):
+                for name, column in columns.items():
+                    grown = np.full(capacity, missing, dtype=column.dtype)
+                    grown[: len(column)] = column
+                    columns[name] = grown
+            self._capacity = capacity
+        self.size = max(self.size, size)
+
+    def _column(self, name: str, number: bool) -> np.ndarray:
+        columns = self.numbers if number else self.codes
+        if name not in columns:
+            if number:
+                columns[name] = np.full(self._capacity, np.nan, dtype=np.float64)
+            else:
+                columns[name] = np.full(self._capacity, -1, dtype=np.int32)
+                self.vocabulary[name] = {}
+        return columns[name]
+
+    def set(self, row: int, metadata: Metadata) -> None:
+        """
+        Replaces the metadata of a row, an empty dict removes it.
+
+        Args:
+            row: The row.
+            metadata: The metadata.
+
+        Returns: None
+        """
+        self.grow(row + 1)
+        for column in self.numbers.values():
+            column[row] = np.nan
+        for column in self.codes.values():
+            column[row] = -1
+        for name, value in metadata.items():
+            if is_number(value):
+                self._column(name, True)[row] = value
+            else:
+                column = self._column(name, False)
+                vocabulary = self.vocabulary[name]
+                column[row] = vocabulary.setdefault(value, len(vocabulary))
+
+    def numbers_of(self, name: str, rows: Sequence[int]) -> np.ndarray:
+        """
+        Returns: The numeric values of a field in rows, NaN where missing.
+        """
+        column = self.numbers.get(name)
+        if column is None:
+            return np.full(len(rows), np.nan)
+        return column[np.asarray(rows, dtype=np.int64)]
+
+    def set_many(self, rows: Iterable[int], metadata: Iterable[Metadata]) -> None:
+        for row, fields in zip(rows, metadata):
+            self.set(row, fields)
+
+    def get(self, rows: Sequence[int]) -> List[Metadata]:
+        """
+        Returns: The metadata of rows, numbers as floats.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        metadata: List[Metadata] = [{} for _ in range(len(rows))]
+        for name, column in self.numbers.items():
+            numbers = column[rows]
+            for i in np.flatnonzero(~np.isnan(numbers)).tolist():
+                metadata[i][name] = float(numbers[i])
+        for name, column in self.codes.items():
+            values = list(self.vocabulary[name])
+            codes = column[rows]
+            for i in np.flatnonzero(codes >= 0).tolist():
+                metadata[i][name] = values[codes[i]]
+        return metadata
+
+    def mask(self, where: Optional[Metadata]) -> np.ndarray:
+        """
+        Evaluates a filter on every row.
+
+        Args:
+            where: The filter, see the module docstring.
+
+        Returns: A boolean array with one entry per row.
+        """
+        mask = np.ones(self.size, dtype=bool)
+        for name, kind, values in parse_where(where):
+            numbers = self.numbers.get(name)
+            codes = self.codes.get(name)
+            matches = np.zeros(self.size, dtype=bool)
+            if kind == "range":
+                low, low_inclusive, high, high_inclusive = values
+                if numbers is not None:
+                    column = numbers[: self.size]
+                    with np.errstate(invalid="ignore"):
+                        matches = (column >= low if low_inclusive else column > low) & (
+                            column <= high if high_inclusive else column < high
+                        )
+            else:
+                if numbers is not None:
+                    wanted = [value for value in values if is_number(value)]
+                    matches |= np.isin(numbers[: self.size], wanted)
+                if codes is not None:
+                    vocabulary = self.vocabulary[name]
+                    # holds strings and booleans only, True does not match 1
+                    wanted = [
+                        vocabulary[value]
+                        for value in values
+                        if not is_number(value) and value in vocabulary
+                    ]
+                    matches |= np.isin(codes[: self.size], wanted)
+            mask &= matches
+        return mask
+
+    def clear(self) -> None:
+        self.__init__()
+
+
+class MetadataFile:
+    """
+    The metadata of the rows of a local memory, as an append-only file of
+    ``[row, metadata]`` JSON lines. A later line for a row replaces the earlier
+    ones, so the file is replayed into MetadataColumns at start and rewritten
+    when most of its lines are outdated.
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.columns = MetadataColumns()
+        self.lines = 0
+
+    def load(self, rows: int) -> None:
+        """
+        Replays the file into the columns.
+
+        Args:
+            rows: The number of rows of the memory, lines for rows past it
+                were lost with their rows to a torn write.
+
+        Returns: None
+        """
+        self.columns.clear()
+        self.columns.grow(rows)
+        latest: Dict[int, Metadata] = {}
+        if os.path.exists(self.filename):
+            # the end of the last complete line
+            end = 0
+            with open(self.filename, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        row, metadata = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        break
+                    if row < rows:
+                        latest[row] = metadata
+                    self.lines += 1
+                    end += len(line)
+            if end < os.path.getsize(self.filename):
+                # a torn last line, the next write would extend it
+                with open(self.filename, "r+b") as f:
+                    f.truncate(end)
+        for row, metadata in latest.items():
+            self.columns.set(row, metadata)
+        if self.lines > 2 * len(latest) + INITIAL_ROWS:
+            self._rewrite(latest)
+
+    def _rewrite(self, latest: Dict[int, Metadata]) -> None:
+        partial = f"{self.filename}.tmp"
+        with open(partial, "wb") as f:
+            for row, metadata in sorted(latest.items()):
+                f.write(orjson.dumps([row, metadata]) + b"\n")
+        os.replace(partial, self.filename)
+        self.lines = len(latest)
+
+    def write(self, rows: List[int], metadata: List[Metadata]) -> None:
+        """
+        Replaces the metadata of rows.
+
+        Args:
+            rows: The rows.
+            metadata: The metadata of every row.
+
+        Returns: None
+        """
+        if not rows:
+            return
+        with open(self.filename, "ab") as f:
+            f.write(
+                b"".join(
+                    orjson.dumps([row, fields]) + b"\n"
+                    for row, fields in zip(rows, metadata)
+                )
+            )
+        self.lines += len(rows)
+        self.columns.set_many(rows, metadata)
+
+    def clear(self) -> None:
+        self.columns.clear()
+        self.lines = 0
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
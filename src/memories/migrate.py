@@ -0,0 +1,123 @@
+"""
+Bulk migration of memories from one memory provider to another.
+
+The stored texts are streamed out of the source with the embeddings they were
+stored with and their metadata, and bulk-loaded into the target, so nothing is embedded again. After
+every batch the position in the source is written to a checkpoint file; an
+interrupted migration started again with the same checkpoint resumes after the
+last batch the target stored. A batch stored but not checkpointed before the
+interruption is loaded again, the dedup policy of the target drops it: every
+target knows the fingerprints and ids of what it stores before the import,
+Pinecone reads them from its index before its first import.
+"""
+import json
+import os
+import time
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import Optional
+
+
+@dataclass
+class MigrationStats:
+    # where the source stream resumes, a JSON value the source yielded
+    cursor: Any = 0
+    read: int = 0
+    written: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rate(self) -> float:
+        """Returns: The items read per second."""
+        return self.read / self.seconds if self.seconds else 0.0
+
+
+def load_checkpoint(path: str, source: str, target: str) -> MigrationStats:
+    """
+    Loads the progress of an earlier run of the same migration.
+
+    Args:
+        path: The checkpoint file.
+        source: The name of the source memory.
+        target: The name of the target memory.
+
+    Returns: The stats to resume from, empty if there is no checkpoint.
+    """
+    if not os.path.exists(path):
+        return MigrationStats()
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if (checkpoint["source"], checkpoint["target"]) != (source, target):
+        raise ValueError(
+            f"{path} checkpoints a migration from {checkpoint['source']} to "
+            f"{checkpoint['target']}, not from {source} to {target}"
+        )
+    return MigrationStats(
+        checkpoint["cursor"],
+        checkpoint["read"],
+        checkpoint["written"],
+        checkpoint["seconds"],
+    )
+
+
+def save_checkpoint(path: str, source: str, target: str, stats: MigrationStats) -> None:
+    """Replaces the checkpoint file atomically."""
+    partial = f"{path}.tmp"
+    with open(partial, "w") as f:
+        json.dump(
+            {
+                "source": source,
+                "target": target,
+                "cursor": stats.cursor,
+                "read": stats.read,
+                "written": stats.written,
+                "seconds": stats.seconds,
+            },
+            f,
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(partial, path)
+
+
+def migrate(
+    source,
+    target,
+    checkpoint: Optional[str] = None,
+    batch_size: int = 1024,
+    names=("source", "target"),
+    progress: Optional[Callable[[MigrationStats], None]] = None,
+) -> MigrationStats:
+    """
+    Copies every memory of the source into the target.
+
+    Args:
+        source: The memory provider to read.
+        target: The memory provider to write.
+        checkpoint: The checkpoint file, None to start over without one.
+        batch_size: The number of memories read and written at once.
+        names: The names of the source and target, stored in the checkpoint
+            so that it is not used for another migration.
+        progress: Called with the stats after every batch.
+
+    Returns: The stats of the migration, including the resumed runs.
+    """
+    stats = MigrationStats()
+    if checkpoint is not None:
+        stats = load_checkpoint(checkpoint, *names)
+    start = time.perf_counter()
+    batches = source.iter_embeddings(stats.cursor, batch_size)
+    for cursor, texts, embeddings, metadata in batches:
+        if texts:
+            stats.written += len(target.add_embeddings(texts, embeddings, metadata))
+        stats.cursor = cursor
+        stats.read += len(texts)
+        now = time.perf_counter()
+        stats.seconds += now - start
+        start = now
+        if checkpoint is not None:
+            save_checkpoint(checkpoint, *names, stats)
+        if progress is not None:
+            progress(stats)
+    return stats
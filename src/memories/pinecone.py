@@ -2,12 +2,86 @@
 PineconeMemory is a memory provider that stores data using Pinecone, a vector database service.
 The data is stored in the form of embeddings generated using OpenAI's Ada embeddings model.
 The Pinecone service allows for efficient similarity search based on embeddings.
+Upserts are buffered and sent in batches, when the buffer is full or a few
+seconds after its first vector, and batched queries are sent in parallel.
+Queries do not flush the buffer: the buffered vectors are scored in process and
+merged with the matches of Pinecone, so the agent loop, which queries between
+every add, still upserts in batches.
 
 """
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
 import pinecone
 
+from memories.base import count_tokens
 from memories.base import get_ada_embedding
+from memories.base import get_ada_embeddings
+from memories.base import get_embedding_provider
 from memories.base import MemoryProviderSingleton
+from memories.dedup import Deduplicator
+from memories.dedup import fingerprint
+from memories.embedding_cache import get_embedding_cache
+from memories.eviction import evictor_from_config
+from memories.metadata import check_metadata
+from memories.metadata import MetadataColumns
+from memories.metadata import parse_where
+from memories.rerank import reranker_from_config
+from memories.search import top_k
+
+# the names of the indexes known to exist, listed once per process
+_indexes = None
+# the ids are fetched until this many requests in a row past vec_num find none
+EMPTY_FETCHES = 10
+
+
+def ensure_index(name, dimension):
+    """
+    Creates a Pinecone index unless it exists. The indexes are only listed by
+    the first call of the process.
+    :param name: The name of the index.
+    :param dimension: The dimension of the embeddings of a new index.
+    """
+    global _indexes
+    if _indexes is None:
+        _indexes = set(pinecone.list_indexes())
+    if name not in _indexes:
+        pinecone.create_index(name, dimension=dimension, metric="cosine", pod_type="p1")
+        _indexes.add(name)
+
+
+def pinecone_filter(where):
+    """
+    Translates a metadata filter into the filter of a Pinecone query.
+    :param where: A metadata filter, see memories.metadata.
+    :return: The Pinecone filter, None for no filter.
+    """
+    conditions = {}
+    for name, kind, values in parse_where(where):
+        if kind == "range":
+            low, low_inclusive, high, high_inclusive = values
+            condition = {}
+            if low != -np.inf:
+                condition["$gte" if low_inclusive else "$gt"] = low
+            if high != np.inf:
+                condition["$lte" if high_inclusive else "$lt"] = high
+        elif len(values) == 1:
+            condition = {"$eq": values[0]}
+        else:
+            condition = {"$in": list(values)}
+        conditions[name] = condition
+    return conditions or None
+
+
+class BufferedMatch(SimpleNamespace):
+    """A match of a buffered vector, read by key or by attribute like a match."""
+
+    def __getitem__(self, name):
+        return getattr(self, name)
 
 
 class PineconeMemory(MemoryProviderSingleton):
@@ -20,42 +94,473 @@ class PineconeMemory(MemoryProviderSingleton):
         # for now this works.
         # we'll need a more complicated and robust system if we want to start with memory.
         self.vec_num = 0
-        if table_name not in pinecone.list_indexes():
-            dimension = 1536
-            metric = "cosine"
-            pod_type = "p1"
-            pinecone.create_index(
-                table_name, dimension=dimension, metric=metric, pod_type=pod_type
-            )
+        # whether vec_num and the fingerprints were seeded from the index
+        self._loaded = False
+        ensure_index(table_name, get_embedding_provider().dimension)
         self.index = pinecone.Index(table_name)
+        self.upsert_batch = cfg.pinecone_upsert_batch
+        self.flush_seconds = cfg.pinecone_flush_seconds
+        self.query_workers = cfg.pinecone_query_workers
+        # id -> (id, embedding, metadata) to upsert, the last write of an id wins
+        self._buffer = {}
+        # held while the buffer is changed or upserted
+        self._lock = threading.RLock()
+        self._timer = None
+        self._executor = None
+        atexit.register(self.close)
+        # memories are only fingerprinted in this process, like vec_num
+        self.duplicates = Deduplicator(cfg.memory_dedup, cfg.memory_dedup_distance)
+        self.counts = {}
+        self.evictor = evictor_from_config(cfg)
+        # Pinecone only holds the embeddings, queries are always vector queries
+        self.search_mode = "vector"
+        self.reranker = reranker_from_config(cfg)
 
-    def add(self, data):
-        vector = get_ada_embedding(data)
-        # no metadata here. We may wish to change that long term.
-        resp = self.index.upsert([(str(self.vec_num), vector, {"raw_text": data})])
-        _text = f"Inserting data into memory at index: {self.vec_num}:\n data: {data}"
-        self.vec_num += 1
+    def add(self, data, metadata=None):
+        vectors = []
+        _text = self._prepare(data, get_ada_embedding, vectors, metadata)
+        self._buffer_vectors(vectors)
         return _text
 
+    def add_many(self, texts, metadata=None):
+        """
+        Adds several data points, embedding them with one request.
+        :param texts: The data to add.
+        :param metadata: The metadata of every data point, or None.
+        :return: The messages of the single adds.
+        """
+        # fills the embedding cache, the data is then embedded from it
+        to_embed = self.texts_to_embed(texts)
+        if to_embed:
+            get_ada_embeddings(to_embed)
+        vectors, messages = [], []
+        for data, fields in zip(texts, metadata or [None] * len(texts)):
+            messages.append(self._prepare(data, get_ada_embedding, vectors, fields))
+        self._buffer_vectors(vectors)
+        return messages
+
+    def add_embeddings(self, texts, embeddings, metadata=None):
+        """
+        Adds data with embeddings computed before.
+        :param texts: The data to add.
+        :param embeddings: One embedding per text.
+        :param metadata: The metadata of every data point, or None.
+        :return: The data that was inserted or merged.
+        """
+        if not self._loaded:
+            self._load_stored()
+        added, vectors = [], []
+        for data, embedding, fields in zip(
+            texts, embeddings, metadata or [None] * len(texts)
+        ):
+            before = len(vectors)
+            self._prepare(data, lambda _: list(map(float, embedding)), vectors, fields)
+            if len(vectors) > before:
+                added.append(data)
+        self._buffer_vectors(vectors)
+        return added
+
+    def _buffer_vectors(self, vectors):
+        """
+        Buffers vectors to upsert. The buffer is flushed once it holds
+        upsert_batch vectors, or flush_seconds after its first vector.
+        :param vectors: The (id, embedding, metadata) tuples to upsert.
+        """
+        with self._lock:
+            for vector in vectors:
+                self._buffer[vector[0]] = vector
+            if len(self._buffer) >= self.upsert_batch or self.flush_seconds <= 0:
+                self.flush()
+            elif self._buffer and self._timer is None:
+                self._timer = threading.Timer(self.flush_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """
+        Upserts the buffered vectors, upsert_batch per request. The vectors of
+        a failed request stay buffered for the next flush.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            vectors = list(self._buffer.values())
+            self._buffer.clear()
+            for start in range(0, len(vectors), self.upsert_batch):
+                try:
+                    self.index.upsert(vectors[start : start + self.upsert_batch])
+                except Exception as e:
+                    print("Error upserting to Pinecone: ", e)
+                    for vector in vectors[start:]:
+                        self._buffer.setdefault(vector[0], vector)
+                    return
+
+    def close(self):
+        """Upserts the buffered vectors and stops the query threads."""
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _prepare(self, data, embed, vectors, metadata=None):
+        """
+        Applies the dedup and eviction policies to data about to be added and
+        appends the vector to upsert, if any, to vectors.
+        :param data: The data to add.
+        :param embed: Returns the embedding of the data.
+        :param vectors: The (id, embedding, metadata) tuples to upsert.
+        :param metadata: The metadata queries can filter the data by.
+        :return: A message describing what was done.
+        """
+        metadata = check_metadata(metadata)
+        fingerprints = fingerprint(data)
+        action, memory_id = self.duplicates.decide(fingerprints)
+        if action == "skip":
+            return f"Skipping data already in memory at index: {memory_id}"
+        if action != "add":
+            self.counts[memory_id] += 1
+        if action == "bump":
+            changes = {"count": self.counts[memory_id], "last_seen": time.time()}
+            with self._lock:
+                buffered = self._buffer.get(str(memory_id))
+                for vector in vectors:
+                    # added by the same add_many, not buffered yet
+                    if vector[0] == str(memory_id):
+                        buffered = vector
+                if buffered is not None:
+                    buffered[2].update(changes)
+                else:
+                    self.index.update(id=str(memory_id), set_metadata=changes)
+            return f"Data already in memory at index: {memory_id}"
+        vector = embed(data)
+        if action == "merge":
+            _text = f"Merging data into memory at index: {memory_id}:\n data: {data}"
+        else:
+            if self.evictor is not None:
+                victim = self.evictor.victim()
+                if victim is not None:
+                    with self._lock:
+                        self._buffer.pop(str(victim), None)
+                        self.index.delete(ids=[str(victim)])
+                    vectors[:] = [
+                        vector for vector in vectors if vector[0] != str(victim)
+                    ]
+                    self.duplicates.forget(victim)
+                    del self.counts[victim]
+                self.evictor.track(self.vec_num)
+            memory_id = self.vec_num
+            self.counts[memory_id] = 1
+            _text = f"Inserting data into memory at index: {memory_id}:\n data: {data}"
+            self.vec_num += 1
+        metadata = {
+            **metadata,
+            "raw_text": data,
+            "count": self.counts[memory_id],
+            "last_seen": time.time(),
+        }
+        vectors.append((str(memory_id), vector, metadata))
+        self.duplicates.remember(memory_id, fingerprints)
+        return _text
+
+    def iter_embeddings(self, start=0, batch_size=1000):
+        """
+        Streams the stored data with its embeddings and metadata, fetching
+        batch_size ids per request, see _fetch_stored.
+        :param start: The cursor to start from, a cursor yielded before: the
+            next id and the number of vectors found below it.
+        :param batch_size: The number of ids to fetch per request.
+        :return: An iterator of (cursor, texts, embeddings, metadata) batches.
+        """
+        for cursor, stored in self._fetch_stored(start, batch_size):
+            texts, embeddings, metadata = [], [], []
+            for _, vector in stored:
+                fields = dict(vector["metadata"])
+                texts.append(str(fields.pop("raw_text")))
+                embeddings.append(vector["values"])
+                fields.pop("count", None)
+                fields.pop("last_seen", None)
+                metadata.append(fields)
+            embeddings = np.array(embeddings, dtype=np.float32)
+            yield cursor, texts, embeddings, metadata
+
+    def _fetch_stored(self, start, batch_size):
+        """
+        Fetches the stored vectors in the order of their ids. Ids are the
+        numbers this provider counts up from 0, with gaps where memories were
+        evicted, and the index cannot list them, so ids are fetched up to
+        vec_num and then until EMPTY_FETCHES requests in a row find none: ids
+        that are not numbers and the vector count of the index, which is only
+        eventually consistent, do not decide when the stream ends. A gap of
+        evicted ids longer than that ends it early.
+        :param start: The cursor to start from, see iter_embeddings.
+        :param batch_size: The number of ids to fetch per request.
+        :return: An iterator of (cursor, [(id, vector)]) batches, without the
+            empty ones.
+        """
+        self.flush()
+        first, found = start or (0, 0)
+        empty = 0
+        while first < self.vec_num or empty < EMPTY_FETCHES:
+            ids = [str(memory_id) for memory_id in range(first, first + batch_size)]
+            fetched = self.index.fetch(ids=ids).vectors
+            stored = [
+                (int(memory_id), fetched[memory_id])
+                for memory_id in ids
+                if memory_id in fetched
+            ]
+            first += batch_size
+            found += len(stored)
+            empty = 0 if stored else empty + 1
+            if stored:
+                yield [first, found], stored
+
+    def _load_stored(self):
+        """
+        Seeds vec_num, the fingerprints, the counts and the eviction order from
+        the vectors stored in the index, so that imported memories neither
+        overwrite the ones an earlier run stored nor repeat them. Memories are
+        otherwise only counted in process, the index is read once, before the
+        first import.
+        """
+        self._loaded = True
+        for _, stored in self._fetch_stored(0, 1000):
+            for memory_id, vector in stored:
+                self.vec_num = max(self.vec_num, memory_id + 1)
+                if memory_id in self.counts:
+                    continue
+                fields = vector["metadata"]
+                self.counts[memory_id] = int(fields.get("count", 1))
+                self.duplicates.remember(
+                    memory_id, fingerprint(str(fields["raw_text"]))
+                )
+                if self.evictor is not None:
+                    self.evictor.track(
+                        memory_id, fields.get("added"), fields.get("last_seen")
+                    )
+
+    def watermark(self):
+        """
+        Returns None: memories are only counted in process, like vec_num, so
+        the writes of other processes cannot be detected and Pinecone gets no
+        hot tier.
+        """
+        return None
+
+    def texts_to_embed(self, texts):
+        """
+        Returns the texts that add would embed, the dedup policy drops or bumps
+        the others without an embedding.
+        :param texts: The data to add.
+        """
+        return [text for text in texts if self.duplicates.needs_embedding(text)]
+
     def get(self, data):
         return self.get_relevant(data, 1)
 
     def clear(self):
-        self.index.delete(deleteAll=True)
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._buffer.clear()
+            self.index.delete(deleteAll=True)
+        self._loaded = True
+        self.duplicates.clear()
+        self.counts = {}
+        if self.evictor is not None:
+            self.evictor.clear()
         return "Obliviated"
 
-    def get_relevant(self, data, num_relevant=5):
+    def get_relevant(
+        self, data, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
         """
         Returns all the data in the memory that is relevant to the given data.
         :param data: The data to compare to.
         :param num_relevant: The number of relevant data to return. Defaults to 5
+        :param mode: Ignored, Pinecone memories are always searched by vector.
+        :param where: A metadata filter, applied by Pinecone before ranking.
+        :param max_tokens: The most tokens of all returned data, None for no limit.
         """
-        query_embedding = get_ada_embedding(data)
-        results = self.index.query(
-            query_embedding, top_k=num_relevant, include_metadata=True
+        if max_tokens is None and not self.reranker.enabled:
+            query_embedding = get_ada_embedding(data)
+            # before the query, a vector flushed meanwhile is still found
+            buffered_ids, buffered = self._buffered_matches(
+                [query_embedding], num_relevant, where
+            )
+            results = self.index.query(
+                query_embedding,
+                top_k=num_relevant,
+                include_metadata=True,
+                filter=pinecone_filter(where),
+            )
+            sorted_results = self._merge_buffered(
+                results.matches, buffered_ids, buffered[0], num_relevant
+            )
+            self._touch(sorted_results)
+            return [str(item["metadata"]["raw_text"]) for item in sorted_results]
+        return [
+            text
+            for text, _ in self.get_relevant_batch(
+                [data], num_relevant, mode, where, max_tokens
+            )[0]
+        ]
+
+    def get_relevant_batch(
+        self, texts, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
+        """
+        Returns the data relevant to each of several queries, embedding all the
+        queries with one request and sending up to query_workers queries at
+        once. The buffered vectors the queries match are merged with the
+        matches of Pinecone. With re-ranking on or a token budget, a larger
+        pool of matches is re-ranked by recency and diversity, see
+        memories.rerank.
+        :param texts: The data to compare to.
+        :param num_relevant: The number of relevant data to return per query.
+        :param mode: Ignored, Pinecone memories are always searched by vector.
+        :param where: A metadata filter, applied by Pinecone before ranking.
+        :param max_tokens: The most tokens of the data returned per query, None
+            for no limit.
+        :return: For every query, (data, score) pairs, best first.
+        """
+        batch = []
+        query_filter = pinecone_filter(where)
+        pool = self.reranker.pool_size(num_relevant, max_tokens)
+
+        def query(query_embedding):
+            return self.index.query(
+                query_embedding,
+                top_k=pool,
+                include_metadata=True,
+                include_values=pool > num_relevant,
+                filter=query_filter,
+            )
+
+        query_embeddings = get_ada_embeddings(texts) if texts else []
+        # before the queries, a vector flushed meanwhile is still found
+        buffered_ids, buffered = self._buffered_matches(query_embeddings, pool, where)
+        if self.query_workers > 1 and len(query_embeddings) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.query_workers, thread_name_prefix="pinecone-query"
+                )
+            responses = list(self._executor.map(query, query_embeddings))
+        else:
+            responses = [query(query_embedding) for query_embedding in query_embeddings]
+        for results, buffered_matches in zip(responses, buffered):
+            sorted_results = self._merge_buffered(
+                results.matches, buffered_ids, buffered_matches, pool
+            )
+            if pool > num_relevant:
+                sorted_results = self._rerank(sorted_results, num_relevant, max_tokens)
+            self._touch(sorted_results)
+            batch.append(
+                [
+                    (str(item["metadata"]["raw_text"]), item.score)
+                    for item in sorted_results
+                ]
+            )
+        return batch
+
+    def _buffered_matches(self, query_embeddings, num_matches, where):
+        """
+        Scores the buffered vectors, which Pinecone does not have yet, against
+        queries by cosine similarity, like the index.
+        :param query_embeddings: The embeddings of the queries.
+        :param num_matches: The most matches per query.
+        :param where: A metadata filter, see memories.metadata.
+        :return: The ids of the buffered vectors, and for every query the
+            matches of the buffered vectors that pass the filter, best first.
+        """
+        with self._lock:
+            buffered = list(self._buffer.values())
+        ids = {memory_id for memory_id, _, _ in buffered}
+        if buffered and where:
+            columns = MetadataColumns()
+            columns.set_many(
+                range(len(buffered)), [fields for _, _, fields in buffered]
+            )
+            buffered = [
+                vector for vector, keep in zip(buffered, columns.mask(where)) if keep
+            ]
+        if not buffered or not len(query_embeddings):
+            return ids, [[] for _ in query_embeddings]
+        vectors = np.array([values for _, values, _ in buffered], dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        queries = np.array(query_embeddings, dtype=np.float32)
+        queries /= np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        rows, scores = top_k(queries @ vectors.T, num_matches)
+        return ids, [
+            [
+                BufferedMatch(
+                    id=buffered[row][0],
+                    score=score,
+                    values=buffered[row][1],
+                    metadata=buffered[row][2],
+                )
+                for row, score in zip(query_rows.tolist(), query_scores.tolist())
+            ]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def _merge_buffered(self, matches, buffered_ids, buffered, num_matches):
+        """
+        Merges the matches of Pinecone with the matches of the buffered
+        vectors. A buffered vector replaces the stored vector of its id, whose
+        match is dropped.
+        :param matches: The matches of Pinecone.
+        :param buffered_ids: The ids of the buffered vectors.
+        :param buffered: The matches of the buffered vectors.
+        :param num_matches: The most matches.
+        :return: The num_matches best matches, best first.
+        """
+        merged = [item for item in matches if item.id not in buffered_ids]
+        merged.extend(buffered)
+        return sorted(merged, key=lambda x: -x.score)[:num_matches]
+
+    def _rerank(self, matches, num_relevant, max_tokens):
+        """
+        Picks the results of a query from its matches.
+        :param matches: The matches, best first, with their values.
+        :param num_relevant: The most results.
+        :param max_tokens: The most tokens of all results, None for no limit.
+        :return: The picked matches, their scores replaced by the decayed
+            relevances.
+        """
+        if not matches:
+            return []
+        token_counts = None
+        if max_tokens is not None:
+            token_counts = [
+                count_tokens(str(item["metadata"]["raw_text"])) for item in matches
+            ]
+        picked = self.reranker.select(
+            [(item, item.score) for item in matches],
+            np.array([item.values for item in matches], dtype=np.float32),
+            num_relevant,
+            added=np.array(
+                [item["metadata"].get("added", np.nan) for item in matches],
+                dtype=np.float64,
+            ),
+            token_counts=token_counts,
+            max_tokens=max_tokens,
         )
-        sorted_results = sorted(results.matches, key=lambda x: x.score)
-        return [str(item["metadata"]["raw_text"]) for item in sorted_results]
+        for item, score in picked:
+            item.score = score
+        return [item for item, _ in picked]
+
+    def _touch(self, matches):
+        """
+        Records the retrieval of memories for eviction.
+        :param matches: The retrieved matches.
+        """
+        if self.evictor is not None:
+            self.evictor.touch(int(item.id) for item in matches)
 
     def get_stats(self):
-        return self.index.describe_index_stats()
+        self.flush()
+        stats = self.index.describe_index_stats().to_dict()
+        stats["embedding_cache"] = get_embedding_cache().stats()
+        return stats
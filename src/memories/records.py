@@ -0,0 +1,88 @@
+"""
+Fixed-width per-row records of a local memory.
+
+A RecordFile keeps one record of a numpy structured dtype per row, in memory and
+mirrored to a file in the memory directory. Every record has the same width, so
+the record of a single row is rewritten in place with one seek and one write.
+"""
+import os
+from typing import Iterable
+
+import numpy as np
+
+
+class RecordFile:
+    def __init__(self, filename: str, dtype: np.dtype) -> None:
+        """
+        Loads the records of a file, if it exists.
+
+        Args:
+            filename: The path of the file.
+            dtype: The structured dtype of a record.
+
+        Returns: None
+        """
+        self.filename = filename
+        self.dtype = np.dtype(dtype)
+        self._buffer = np.zeros(0, dtype=self.dtype)
+        if os.path.exists(filename):
+            self._buffer = np.fromfile(filename, dtype=self.dtype)
+        self.size = len(self._buffer)
+
+    @property
+    def records(self) -> np.ndarray:
+        return self._buffer[: self.size]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def truncate(self, size: int) -> None:
+        """Drops the records of rows that were lost to a torn write."""
+        self.size = min(self.size, size)
+        os.truncate(self.filename, self.size * self.dtype.itemsize)
+
+    def write(self, row: int, records: np.ndarray) -> None:
+        """
+        Writes records for consecutive rows, extending the file if needed.
+
+        Args:
+            row: The row of the first record.
+            records: The records.
+
+        Returns: None
+        """
+        end = row + len(records)
+        if end > len(self._buffer):
+            grown = np.zeros(max(end, 2 * len(self._buffer)), dtype=self.dtype)
+            grown[: self.size] = self.records
+            self._buffer = grown
+        self._buffer[row:end] = records
+        self.size = max(self.size, end)
+        mode = "r+b" if os.path.exists(self.filename) else "wb"
+        with open(self.filename, mode) as f:
+            f.seek(row * self.dtype.itemsize)
+            f.write(records.tobytes())
+
+    def write_rows(self, rows: Iterable[int], records: np.ndarray) -> None:
+        """
+        Rewrites the records of existing rows that need not be consecutive.
+
+        Args:
+            rows: The rows, all smaller than the number of records.
+            records: One record per row.
+
+        Returns: None
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        with open(self.filename, "r+b") as f:
+            for row, record in zip(rows, records):
+                self._buffer[row] = record
+                f.seek(row * self.dtype.itemsize)
+                f.write(record.tobytes())
+
+    def clear(self) -> None:
+        self.size = 0
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
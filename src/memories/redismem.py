@@ -2,32 +2,116 @@
 
 RedisMemory is a memory provider that stores data in a Redis server, a popular in-memory data store.
 The data is stored in the form of text and their corresponding embeddings, generated using OpenAI's Ada embeddings model.
-The Redis server is configured to support similarity search using the Redisearch module and the HNSW indexing algorithm.
+The Redis server is configured to support similarity search using the Redisearch module and the HNSW indexing algorithm,
+and lexical search with the BM25 scorer of Redisearch over the full-text data field.
+Metadata fields are stored in the hash of a memory and indexed as TAG or NUMERIC
+fields, added to the index the first time they are seen, so metadata filters run
+as pre-filters of the KNN and BM25 queries.
+On Redis servers without the RediSearch module, memories are searched in a copy
+of the index kept in the agent process, see memories.redismirror.
 
 """
+import re
+import time
 from typing import Any
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Tuple
 
 import numpy as np
 import redis
+from redis.commands.search.field import NumericField
+from redis.commands.search.field import TagField
 from redis.commands.search.field import TextField
 from redis.commands.search.field import VectorField
 from redis.commands.search.indexDefinition import IndexDefinition
 from redis.commands.search.indexDefinition import IndexType
 from redis.commands.search.query import Query
 
-from memories.base import get_ada_embedding
+from memories.base import count_tokens
+from memories.base import get_ada_embeddings
+from memories.base import get_embedding_provider
 from memories.base import MemoryProviderSingleton
+from memories.dedup import Deduplicator
+from memories.dedup import fingerprint
+from memories.embedding_cache import get_embedding_cache
+from memories.eviction import evictor_from_config
+from memories.lexical import check_mode
+from memories.lexical import FUSION_DEPTH
+from memories.lexical import reciprocal_rank_fusion
+from memories.lexical import WORD
+from memories.metadata import check_metadata
+from memories.metadata import is_number
+from memories.metadata import Metadata
+from memories.metadata import parse_where
+from memories.redismirror import key_pattern
+from memories.redismirror import RedisMirror
+from memories.rerank import reranker_from_config
 
-SCHEMA = [
-    TextField("data"),
-    VectorField(
-        "embedding",
-        "HNSW",
-        {"TYPE": "FLOAT32", "DIM": 1536, "DISTANCE_METRIC": "COSINE"},
-    ),
-]
+# the most commands sent with one pipeline by bulk reads and writes
+PIPELINE_CHUNK = 1000
+# the hash fields the dedup and eviction state is loaded from
+POLICY_FIELDS = (b"exact", b"simhash", b"added", b"last_used", b"retrievals")
+
+VECTOR_ALGORITHMS = ("HNSW", "FLAT")
+# vector type -> the dtype of the embeddings stored in the hashes
+VECTOR_TYPES = {"FLOAT32": np.float32, "FLOAT16": np.float16}
+
+# characters a TAG query value escapes
+TAG_SPECIAL = re.compile(r"([^A-Za-z0-9_])")
+
+
+def schema(
+    dimension: int,
+    algorithm: str = "HNSW",
+    vector_type: str = "FLOAT32",
+    m: int = 16,
+    ef_construction: int = 200,
+    ef_runtime: int = 10,
+) -> list:
+    """
+    Returns: The fields of the search index of a memory. The HNSW settings
+        are ignored by FLAT indexes, which search exhaustively.
+    """
+    attributes = {"TYPE": vector_type, "DIM": dimension, "DISTANCE_METRIC": "COSINE"}
+    if algorithm == "HNSW":
+        attributes.update(M=m, EF_CONSTRUCTION=ef_construction, EF_RUNTIME=ef_runtime)
+    return [
+        TextField("data"),
+        NumericField("added"),
+        VectorField("embedding", algorithm, attributes),
+    ]
+
+
+def _tag(value: Any) -> Any:
+    """Returns: The value stored in a hash, booleans as "true" or "false"."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+
+def _tag_filter(where: Optional[Metadata]) -> Optional[Metadata]:
+    """Returns: A metadata filter with the values as they are stored."""
+    if not where:
+        return where
+    tagged = {}
+    for name, condition in where.items():
+        if isinstance(condition, (list, tuple, set)):
+            tagged[name] = [_tag(value) for value in condition]
+        elif isinstance(condition, dict):
+            tagged[name] = condition
+        else:
+            tagged[name] = _tag(condition)
+    return tagged
+
+
+def _bound(value: float, inclusive: bool) -> str:
+    """Returns: A bound of a NUMERIC range query."""
+    if value in (np.inf, -np.inf):
+        return "+inf" if value > 0 else "-inf"
+    return f"{'' if inclusive else '('}{value}"
 
 
 class RedisMemory(MemoryProviderSingleton):
@@ -43,7 +127,20 @@ class RedisMemory(MemoryProviderSingleton):
         redis_host = cfg.redis_host
         redis_port = cfg.redis_port
         redis_password = cfg.redis_password
-        self.dimension = 1536
+        self.dimension = get_embedding_provider().dimension
+        self.algorithm = cfg.redis_vector_algorithm.upper()
+        if self.algorithm not in VECTOR_ALGORITHMS:
+            raise ValueError(
+                f"Invalid Redis vector algorithm {cfg.redis_vector_algorithm!r},"
+                f" expected one of {VECTOR_ALGORITHMS}"
+            )
+        vector_type = cfg.redis_vector_type.upper()
+        if vector_type not in VECTOR_TYPES:
+            raise ValueError(
+                f"Invalid Redis vector type {cfg.redis_vector_type!r}, expected"
+                f" one of {tuple(VECTOR_TYPES)}"
+            )
+        self.vector_dtype = VECTOR_TYPES[vector_type]
         self.redis = redis.Redis(
             host=redis_host,
             port=redis_port,
@@ -52,42 +149,493 @@ class RedisMemory(MemoryProviderSingleton):
         )
         self.cfg = cfg
         if cfg.wipe_redis_on_start:
-            self.redis.flushall()
-        try:
-            self.redis.ft(f"{cfg.memory_index}").create_index(
-                fields=SCHEMA,
-                definition=IndexDefinition(
-                    prefix=[f"{cfg.memory_index}:"], index_type=IndexType.HASH
-                ),
+            self._unlink_memories()
+        search = cfg.redis_search
+        if search == "auto":
+            search = "redisearch" if self._has_redisearch() else "local"
+        elif search not in ("redisearch", "local"):
+            raise ValueError(
+                f"Invalid Redis search {search!r}, expected 'auto', 'redisearch'"
+                " or 'local'"
             )
-        except Exception as e:
-            print("Error creating Redis search index: ", e)
+        # a copy of the index searched in process, without RediSearch
+        self.mirror: Optional[RedisMirror] = None
+        if search == "local":
+            self.mirror = RedisMirror(
+                self.redis, cfg.memory_index, self.dimension, self.vector_dtype
+            )
+        else:
+            # an existing index keeps the settings it was created with
+            try:
+                self.redis.ft(f"{cfg.memory_index}").create_index(
+                    fields=schema(
+                        self.dimension,
+                        self.algorithm,
+                        vector_type,
+                        cfg.redis_hnsw_m,
+                        cfg.redis_hnsw_ef_construction,
+                        cfg.redis_hnsw_ef_runtime,
+                    ),
+                    definition=IndexDefinition(
+                        prefix=[f"{cfg.memory_index}:"], index_type=IndexType.HASH
+                    ),
+                )
+            except Exception as e:
+                print("Error creating Redis search index: ", e)
+        # indexed metadata field -> "TAG" or "NUMERIC"
+        self.fields = self._indexed_fields()
         existing_vec_num = self.redis.get(f"{cfg.memory_index}-vec_num")
         self.vec_num = int(existing_vec_num.decode("utf-8")) if existing_vec_num else 0
+        self.duplicates = Deduplicator(cfg.memory_dedup, cfg.memory_dedup_distance)
+        self.evictor = evictor_from_config(cfg)
+        self.search_mode = check_mode(cfg.memory_search_mode)
+        self.reranker = reranker_from_config(cfg)
+        self._load_memories()
+
+    def _has_redisearch(self) -> bool:
+        """
+        Returns: Whether the server has the RediSearch module.
+        """
+        try:
+            self.redis.execute_command("FT._LIST")
+        except redis.ResponseError:
+            return False
+        return True
+
+    def _load_memories(self) -> None:
+        """
+        Reads the stored memories in one pass over the index: their
+        fingerprints and usage for the dedup and eviction policies and, without
+        RediSearch, the local copy of the index. Keys are read while they are
+        scanned, PIPELINE_CHUNK per pipeline, and the data is only read for
+        memories stored without fingerprints. Then the memories over the size
+        limit are evicted.
+
+        Returns: None
+        """
+        track = self.cfg.memory_dedup != "off" or self.evictor is not None
+        if self.mirror is not None:
+            self.mirror.load(self._track_memory if track else None)
+        elif track:
+            prefix = f"{self.cfg.memory_index}:"
+            pattern = key_pattern(self.cfg.memory_index)
+            memory_ids = []
+            for key in self.redis.scan_iter(match=pattern, count=PIPELINE_CHUNK):
+                memory_id = key.decode("utf-8")[len(prefix) :]
+                if memory_id.isdigit():
+                    memory_ids.append(int(memory_id))
+                if len(memory_ids) >= PIPELINE_CHUNK:
+                    self._track_memories(memory_ids)
+                    memory_ids = []
+            self._track_memories(memory_ids)
+        while self.evictor is not None and len(self.evictor) > self.evictor.capacity:
+            self._evict(self.evictor.victim())
+
+    def _track_memories(self, memory_ids: List[int]) -> None:
+        """
+        Reads the fingerprints and usage of memories with one pipeline, and
+        the data of the ones stored without fingerprints with another.
+
+        Returns: None
+        """
+        if not memory_ids:
+            return
+        keys = [f"{self.cfg.memory_index}:{memory_id}" for memory_id in memory_ids]
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hmget(key, *POLICY_FIELDS)
+        hashes = [dict(zip(POLICY_FIELDS, values)) for values in pipe.execute()]
+        unfingerprinted = [
+            i
+            for i, values in enumerate(hashes)
+            if values[b"exact"] is None or values[b"simhash"] is None
+        ]
+        if unfingerprinted:
+            pipe = self.redis.pipeline(transaction=False)
+            for i in unfingerprinted:
+                pipe.hget(keys[i], "data")
+            for i, data in zip(unfingerprinted, pipe.execute()):
+                hashes[i][b"data"] = data
+        for memory_id, values in zip(memory_ids, hashes):
+            self._track_memory(memory_id, values)
+
+    def _track_memory(self, memory_id: int, values: Dict[bytes, Any]) -> None:
+        """
+        Indexes the fingerprints and tracks the usage of a stored memory,
+        computing the fingerprints of memories stored without them.
+
+        Args:
+            memory_id: The id of the memory.
+            values: Its hash, missing fields absent or None.
+
+        Returns: None
+        """
+        exact, sim = values.get(b"exact"), values.get(b"simhash")
+        if exact is None or sim is None:
+            data = values.get(b"data")
+            if data is None:
+                # deleted since the scan
+                return
+            fingerprints = fingerprint(data.decode("utf-8"))
+        else:
+            fingerprints = (int(exact), int(sim))
+        self.duplicates.remember(memory_id, fingerprints)
+        if self.evictor is not None:
+            added = values.get(b"added")
+            last_used = values.get(b"last_used")
+            # memories stored without usage count as added before the others
+            self.evictor.track(
+                memory_id,
+                float(added or 0),
+                float(last_used or added or 0),
+                int(values.get(b"retrievals") or 0),
+            )
+
+    def _indexed_fields(self) -> Dict[str, str]:
+        """
+        Returns: The TAG and NUMERIC fields of the index, by name.
+        """
+        if self.mirror is not None:
+            self.mirror.load_fields()
+            return self.mirror.fields
+        try:
+            attributes = self.redis.ft(f"{self.cfg.memory_index}").info()["attributes"]
+        except Exception as e:
+            print("Error reading the Redis search index: ", e)
+            return {}
+        fields = {}
+        for attribute in attributes:
+            items = [
+                item.decode("utf-8") if isinstance(item, bytes) else item
+                for item in attribute
+            ]
+            info = dict(zip(items[::2], items[1::2]))
+            if info.get("type") in ("TAG", "NUMERIC"):
+                fields[info["attribute"]] = info["type"]
+        return fields
+
+    def _index_fields(self, metadata: Metadata) -> None:
+        """
+        Adds the metadata fields the index does not have yet to it, numbers
+        as NUMERIC fields and strings and booleans as TAG fields.
+
+        Returns: None
+        """
+        for name, value in metadata.items():
+            kind = "NUMERIC" if is_number(value) else "TAG"
+            if name not in self.fields and self.mirror is not None:
+                # another process may have added the field with another type
+                self.mirror.add_field(name, kind)
+            elif name not in self.fields:
+                field = NumericField(name) if kind == "NUMERIC" else TagField(name)
+                try:
+                    self.redis.ft(f"{self.cfg.memory_index}").alter_schema_add([field])
+                except Exception as e:
+                    print("Error adding a field to the Redis search index: ", e)
+                self.fields[name] = kind
+            if self.fields[name] == "NUMERIC" and kind == "TAG":
+                # the index would drop the memory
+                raise ValueError(f"Metadata field {name!r} is numeric in the index")
+
+    def _filter_query(self, where: Optional[Metadata]) -> Optional[str]:
+        """
+        Translates a metadata filter into RediSearch query clauses.
+
+        Args:
+            where: A metadata filter, see memories.metadata.
+
+        Returns: The clauses, empty for no filter, or None if no memory can
+            match, as for a field that is not indexed.
+        """
+        clauses = []
+        for name, kind, values in parse_where(where):
+            field = self.fields.get(name)
+            if kind == "range":
+                if field != "NUMERIC":
+                    return None
+                low, low_inclusive, high, high_inclusive = values
+                clauses.append(
+                    f"@{name}:[{_bound(low, low_inclusive)}"
+                    f" {_bound(high, high_inclusive)}]"
+                )
+            elif field == "NUMERIC":
+                numbers = [value for value in values if is_number(value)]
+                if not numbers:
+                    return None
+                clauses.append(
+                    "(" + " | ".join(f"@{name}:[{n} {n}]" for n in numbers) + ")"
+                )
+            elif field == "TAG":
+                tags = [_tag(value) for value in values if not is_number(value)]
+                if not tags:
+                    return None
+                escaped = " | ".join(TAG_SPECIAL.sub(r"\\\1", tag) for tag in tags)
+                clauses.append(f"@{name}:{{{escaped}}}")
+            else:
+                return None
+        return " ".join(clauses)
+
+    def _evict(self, memory_id: int, pipe=None) -> None:
+        (pipe or self.redis).delete(f"{self.cfg.memory_index}:{memory_id}")
+        self.duplicates.forget(memory_id)
+        if self.mirror is not None:
+            self.mirror.remove(memory_id)
 
-    def add(self, data: str) -> str:
+    def add(self, data: str, metadata: Optional[Metadata] = None) -> str:
         """
         Adds a data point to the memory.
 
         Args:
             data: The data to add.
+            metadata: The metadata queries can filter the data by.
 
         Returns: Message indicating that the data has been added.
         """
-        if "Command Error:" in data:
-            return ""
-        vector = get_ada_embedding(data)
-        vector = np.array(vector).astype(np.float32).tobytes()
-        data_dict = {b"data": data, "embedding": vector}
-        pipe = self.redis.pipeline()
-        pipe.hset(f"{self.cfg.memory_index}:{self.vec_num}", mapping=data_dict)
-        _text = (
-            f"Inserting data into memory at index: {self.vec_num}:\n" f"data: {data}"
+        return self.write_many([data], [metadata])[0][1]
+
+    def add_many(
+        self, texts: List[str], metadata: Optional[List[Metadata]] = None
+    ) -> List[str]:
+        """
+        Adds several data points, embedding them with one request and writing
+        them with one pipeline per PIPELINE_CHUNK data points.
+
+        Args:
+            texts: The data to add.
+            metadata: The metadata of every data point, or None.
+
+        Returns: The messages of the single adds.
+        """
+        return [message for _, message, _ in self.write_many(texts, metadata)]
+
+    def write_many(
+        self, texts: List[str], metadata: Optional[List[Metadata]] = None
+    ) -> List[Tuple[str, str, Optional[np.ndarray]]]:
+        """
+        Adds several data points like add_many, reporting what was stored.
+
+        Args:
+            texts: The data to add.
+            metadata: The metadata of every data point, or None.
+
+        Returns: For every data point, the dedup action, the message of add
+            and the float32 embedding it was stored with, None unless it was
+            added or merged.
+        """
+        return self._store(texts, metadata, get_ada_embeddings)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: List[List[float]],
+        metadata: Optional[List[Metadata]] = None,
+    ) -> List[str]:
+        """
+        Adds data points with embeddings computed before, writing them with
+        one pipeline per PIPELINE_CHUNK data points.
+
+        Args:
+            texts: The data to add.
+            embeddings: One embedding per text.
+            metadata: The metadata of every data point, or None.
+
+        Returns: The data that was inserted or merged.
+        """
+        vectors = dict(zip(texts, embeddings))
+        results = self._store(
+            texts, metadata, lambda stored: [vectors[text] for text in stored]
         )
-        self.vec_num += 1
-        pipe.set(f"{self.cfg.memory_index}-vec_num", self.vec_num)
-        pipe.execute()
-        return _text
+        return [
+            data
+            for data, (action, _, _) in zip(texts, results)
+            if action in ("add", "merge")
+        ]
+
+    def watermark(self) -> int:
+        """
+        Returns: The vec_num counter, the ids reserved by every process.
+        """
+        return int(self.redis.get(f"{self.cfg.memory_index}-vec_num") or 0)
+
+    def _reserve_ids(self, count: int) -> int:
+        """
+        Reserves memory ids with one INCRBY of the vec_num counter, so that
+        processes sharing the index never hand out the same id.
+
+        Returns: The first of count consecutive ids.
+        """
+        self.vec_num = self.redis.incrby(f"{self.cfg.memory_index}-vec_num", count)
+        return self.vec_num - count
+
+    def _store(
+        self, texts: List[str], metadata: Optional[List[Metadata]], embed
+    ) -> List[Tuple[str, str, Optional[np.ndarray]]]:
+        """
+        Applies the dedup and eviction policies to data points and writes them.
+        New memories get placeholder ids while the batch is deduplicated, then
+        ids reserved all at once.
+
+        Args:
+            texts: The data to add.
+            metadata: The metadata of every data point, or None.
+            embed: Returns the embeddings of a list of data.
+
+        Returns: For every data point, the dedup action, a message describing
+            it and the float32 embedding of added or merged data, None for the
+            others. Command errors get "error" and an empty message.
+        """
+        now = time.time()
+        # [action, memory id, data, fingerprints, metadata]
+        writes = []
+        # placeholder id -> the fingerprints it is indexed by
+        placeholders: Dict[int, Tuple[int, int]] = {}
+        for data, fields in zip(texts, metadata or [None] * len(texts)):
+            if "Command Error:" in data:
+                writes.append(["error", None, data, (None, None), None])
+                continue
+            fingerprints = fingerprint(data)
+            action, memory_id = self.duplicates.decide(fingerprints)
+            if action in ("add", "merge"):
+                fields = check_metadata(fields, now)
+                self._index_fields(fields)
+                if action == "add":
+                    memory_id = -len(placeholders) - 1
+                if memory_id < 0:
+                    placeholders[memory_id] = fingerprints
+                self.duplicates.remember(memory_id, fingerprints)
+            writes.append([action, memory_id, data, fingerprints, fields])
+
+        first = self._reserve_ids(len(placeholders)) if placeholders else 0
+        for placeholder, fingerprints in placeholders.items():
+            self.duplicates.forget(placeholder)
+            self.duplicates.remember(first - placeholder - 1, fingerprints)
+        for write in writes:
+            if write[1] is not None and write[1] < 0:
+                write[1] = first - write[1] - 1
+
+        stored = [
+            data for action, _, data, _, _ in writes if action in ("add", "merge")
+        ]
+        vectors = iter(embed(stored) if stored else [])
+        results = []
+        # the added memories to store in the local copy of the index
+        mirrored = []
+        pipe = self.redis.pipeline(transaction=False)
+        for action, memory_id, data, (exact, sim), fields in writes:
+            key = f"{self.cfg.memory_index}:{memory_id}"
+            if action == "error":
+                results.append((action, "", None))
+                continue
+            if action == "skip":
+                message = f"Skipping data already in memory at index: {memory_id}"
+                results.append((action, message, None))
+                continue
+            if action == "bump":
+                pipe.hincrby(key, "count", 1)
+                pipe.hset(key, "last_seen", now)
+                message = f"Data already in memory at index: {memory_id}"
+                results.append((action, message, None))
+            else:
+                embedding = np.asarray(next(vectors), dtype=np.float32)
+                vector = embedding.astype(self.vector_dtype)
+                tags = {name: _tag(value) for name, value in fields.items()}
+                data_dict = {
+                    b"data": data,
+                    "embedding": vector.tobytes(),
+                    "exact": exact,
+                    "simhash": sim,
+                    "last_seen": now,
+                    **tags,
+                }
+                if self.mirror is not None and action == "add":
+                    mirrored.append((memory_id, data, vector, tags))
+                if action == "merge":
+                    message = (
+                        f"Merging data into memory at index: {memory_id}:\n"
+                        f"data: {data}"
+                    )
+                else:
+                    if self.evictor is not None:
+                        victim = self.evictor.victim()
+                        if victim is not None:
+                            self._evict(victim, pipe)
+                        self.evictor.track(memory_id, fields["added"])
+                        data_dict["last_used"] = fields["added"]
+                        data_dict["retrievals"] = 0
+                    message = (
+                        f"Inserting data into memory at index: {memory_id}:\n"
+                        f"data: {data}"
+                    )
+                pipe.hset(key, mapping=data_dict)
+                pipe.hincrby(key, "count", 1)
+                results.append((action, message, embedding))
+            if len(pipe) >= PIPELINE_CHUNK:
+                pipe.execute()
+        if len(pipe):
+            pipe.execute()
+        if self.mirror is not None:
+            for memory_id, data, vector, tags in mirrored:
+                self.mirror.set(memory_id, data, vector, tags)
+            # merged hashes keep the metadata fields the merge does not set
+            self.mirror.read(
+                memory_id for action, memory_id, _, _, _ in writes if action == "merge"
+            )
+        return results
+
+    def iter_embeddings(
+        self, start: int = 0, batch_size: int = 1024
+    ) -> Iterator[Tuple[int, List[str], np.ndarray, List[Metadata]]]:
+        """
+        Streams the stored data with its embeddings and metadata in the order
+        of the memory ids, reading each batch with one pipeline. Evicted ids
+        are skipped. Booleans in the metadata come back as "true" or "false",
+        the TAG values they are stored as.
+
+        Args:
+            start: The memory id to start from, a cursor yielded before.
+            batch_size: The number of memory ids to read per batch.
+
+        Returns: An iterator of (cursor, texts, embeddings, metadata) batches.
+        """
+        # other processes may have added memories and metadata fields
+        stored = self.redis.get(f"{self.cfg.memory_index}-vec_num")
+        self.vec_num = max(self.vec_num, int(stored or 0))
+        self.fields = self._indexed_fields()
+        names = list(self.fields)
+        for first in range(start, self.vec_num, batch_size):
+            pipe = self.redis.pipeline(transaction=False)
+            for memory_id in range(first, min(first + batch_size, self.vec_num)):
+                pipe.hmget(
+                    f"{self.cfg.memory_index}:{memory_id}", "data", "embedding", *names
+                )
+            texts, vectors, metadata = [], [], []
+            for data, embedding, *values in pipe.execute():
+                if data is None or embedding is None:
+                    continue
+                texts.append(data.decode("utf-8"))
+                vectors.append(np.frombuffer(embedding, dtype=self.vector_dtype))
+                metadata.append(
+                    {
+                        name: float(value)
+                        if self.fields[name] == "NUMERIC"
+                        else value.decode("utf-8")
+                        for name, value in zip(names, values)
+                        if value is not None
+                    }
+                )
+            vectors = np.array(vectors, dtype=np.float32).reshape(-1, self.dimension)
+            yield first + batch_size, texts, vectors, metadata
+
+    def texts_to_embed(self, texts: List[str]) -> List[str]:
+        """
+        Returns: The texts that add would embed, the dedup policy drops or
+            bumps the others without an embedding.
+        """
+        return [
+            text
+            for text in texts
+            if "Command Error:" not in text and self.duplicates.needs_embedding(text)
+        ]
 
     def get(self, data: str) -> Optional[List[Any]]:
         """
@@ -102,43 +650,409 @@ class RedisMemory(MemoryProviderSingleton):
 
     def clear(self) -> str:
         """
-        Clears the redis server.
+        Clears the memories of the index, the other keys and databases of the
+        server are kept.
 
         Returns: A message indicating that the memory has been cleared.
         """
-        self.redis.flushall()
+        self._unlink_memories()
+        self.vec_num = 0
+        self.duplicates.clear()
+        if self.mirror is not None:
+            self.mirror.clear()
+        if self.evictor is not None:
+            self.evictor.clear()
         return "Obliviated"
 
-    def get_relevant(self, data: str, num_relevant: int = 5) -> Optional[List[Any]]:
+    def _unlink_memories(self) -> None:
+        """
+        Deletes the memories of the index and its vec_num counter, scanning
+        and unlinking PIPELINE_CHUNK keys per command so that no command blocks
+        the server for long. UNLINK leaves freeing the values to the server's
+        lazy-free thread, but the scan runs in the caller, one round trip per
+        PIPELINE_CHUNK keys: ids restart from 0 after a clear, a scan still
+        running in the background would delete the new memories. The search
+        index and its fields are kept.
+
+        Returns: None
+        """
+        index = self.cfg.memory_index
+        # other processes see the clear, the local copies of the index reset
+        self.redis.unlink(f"{index}-vec_num")
+        keys = []
+        for key in self.redis.scan_iter(match=key_pattern(index), count=PIPELINE_CHUNK):
+            keys.append(key)
+            if len(keys) >= PIPELINE_CHUNK:
+                self.redis.unlink(*keys)
+                keys = []
+        if keys:
+            self.redis.unlink(*keys)
+
+    def get_relevant(
+        self,
+        data: str,
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+        ef_runtime: Optional[int] = None,
+    ) -> Optional[List[Any]]:
         """
         Returns all the data in the memory that is relevant to the given data.
         Args:
             data: The data to compare to.
             num_relevant: The number of relevant data to return.
+            mode: "vector", "lexical" or "hybrid", defaults to MEMORY_SEARCH_MODE.
+            where: A metadata filter, see memories.metadata.
+            max_tokens: The most tokens of all returned data, None for no limit.
+            ef_runtime: The HNSW candidate list size of the query, defaults to
+                REDIS_HNSW_EF_RUNTIME.
 
         Returns: A list of the most relevant data.
         """
-        query_embedding = get_ada_embedding(data)
-        base_query = f"*=>[KNN {num_relevant} @embedding $vector AS vector_score]"
+        return [
+            memory
+            for memory, _ in self.get_relevant_batch(
+                [data], num_relevant, mode, where, max_tokens, ef_runtime
+            )[0]
+        ]
+
+    def get_relevant_batch(
+        self,
+        texts: List[str],
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+        ef_runtime: Optional[int] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Returns the data relevant to each of several queries, embedding all the
+        queries with one request. Lexical queries are not embedded, hybrid
+        queries fuse the vector and BM25 rankings by reciprocal rank. A
+        metadata filter becomes TAG and NUMERIC pre-filters of the queries.
+        With re-ranking on or a token budget, a larger pool of candidates is
+        re-ranked by recency and diversity, see memories.rerank.
+        Args:
+            texts: The data to compare to.
+            num_relevant: The number of relevant data to return per query.
+            mode: "vector", "lexical" or "hybrid", defaults to MEMORY_SEARCH_MODE.
+            where: A metadata filter, see memories.metadata.
+            max_tokens: The most tokens of the data returned per query, None
+                for no limit.
+            ef_runtime: The HNSW candidate list size of the queries, higher
+                finds more of the true nearest memories, more slowly. Defaults
+                to REDIS_HNSW_EF_RUNTIME, ignored by FLAT indexes and local
+                search, which are exact.
+
+        Returns: For every query, (data, score) pairs, best first. Scores are
+            cosine similarities, BM25 scores or fused reciprocal ranks, or
+            decayed relevances scaled to a best of 1 when re-ranked.
+        """
+        return [
+            [(data, score) for data, score, _, _ in results]
+            for results in self._search(
+                texts, num_relevant, mode, where, max_tokens, ef_runtime, False
+            )
+        ]
+
+    def search_many(
+        self,
+        texts: List[str],
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[List[Tuple[str, float, np.ndarray, float]]]:
+        """
+        Searches like get_relevant_batch, reading the embeddings and added
+        times of the results with one pipeline per query.
+
+        Returns: For every query, (data, score, float32 embedding, added)
+            results, best first. added is NaN for memories stored without it.
+        """
+        return self._search(texts, num_relevant, mode, where, max_tokens, None, True)
+
+    def _search(
+        self,
+        texts: List[str],
+        num_relevant: int,
+        mode: Optional[str],
+        where: Optional[Metadata],
+        max_tokens: Optional[int],
+        ef_runtime: Optional[int],
+        stored: bool,
+    ) -> List[List[Tuple[str, float, Optional[np.ndarray], Optional[float]]]]:
+        """
+        Runs the queries of get_relevant_batch and search_many.
+
+        Args:
+            stored: Whether to read the embeddings and added times of the
+                results, they are None otherwise.
+
+        Returns: For every query, (data, score, embedding, added) results.
+        """
+        if not texts:
+            return []
+        mode = check_mode(mode or self.search_mode)
+        if self.mirror is not None:
+            self.mirror.sync()
+        filter_query = self._filter_query(where)
+        if filter_query is None:
+            return [[] for _ in texts]
+        pool = self.reranker.pool_size(num_relevant, max_tokens)
+        depth = pool if mode == "vector" else FUSION_DEPTH * pool
+        if mode == "lexical":
+            query_embeddings = [None] * len(texts)
+        else:
+            query_embeddings = get_ada_embeddings(texts)
+        batch = []
+        for text, query_embedding in zip(texts, query_embeddings):
+            try:
+                hits = self._rank(
+                    text, query_embedding, mode, depth, where, ef_runtime
+                )[:pool]
+            except Exception as e:
+                print("Error calling Redis search: ", e)
+                batch.append([])
+                continue
+            if self.mirror is not None:
+                found = self._read_back(hits)
+                if len(found) < len(hits):
+                    # the deleted memories are out of the copy now
+                    ranked = self._rank(
+                        text, query_embedding, mode, depth, where, ef_runtime
+                    )
+                    found = self._read_back(ranked[:pool])
+                hits = found
+            vectors = added = [None] * len(hits)
+            if stored or pool > num_relevant:
+                vectors, added = self._read_stored(hits)
+            if pool > num_relevant:
+                picked = self._rerank(hits, vectors, added, num_relevant, max_tokens)
+                hits = [(hits[i][0], score) for i, score in picked]
+                vectors = vectors[[i for i, _ in picked]]
+                added = added[[i for i, _ in picked]]
+            self._touch([doc for doc, _ in hits])
+            batch.append(
+                [
+                    (doc.data, score, vector, stamp)
+                    for (doc, score), vector, stamp in zip(hits, vectors, added)
+                ]
+            )
+        return batch
+
+    def _read_stored(self, hits) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reads the embeddings and added times of results with one pipeline.
+
+        Args:
+            hits: The (document, score) results.
+
+        Returns: The float32 embeddings, zeros for deleted memories, and the
+            added times, NaN for memories stored without one.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        for doc, _ in hits:
+            pipe.hmget(doc.id, "embedding", "added")
+        vectors = np.zeros((len(hits), self.dimension), dtype=np.float32)
+        added = np.full(len(hits), np.nan)
+        for i, (embedding, stamp) in enumerate(pipe.execute() if hits else []):
+            if embedding is not None:
+                vectors[i] = np.frombuffer(embedding, dtype=self.vector_dtype)
+            if stamp is not None:
+                added[i] = float(stamp)
+        return vectors, added
+
+    def _rerank(
+        self,
+        hits,
+        vectors: np.ndarray,
+        added: np.ndarray,
+        num_relevant: int,
+        max_tokens: Optional[int],
+    ) -> List[Tuple[int, float]]:
+        """
+        Picks the results of a query from its candidates.
+
+        Args:
+            hits: The (document, score) candidates, best first.
+            vectors: The embeddings of the candidates.
+            added: When every candidate was added, NaN if unknown.
+            num_relevant: The most results.
+            max_tokens: The most tokens of all results, None for no limit.
+
+        Returns: The (index in hits, score) results.
+        """
+        token_counts = None
+        if max_tokens is not None:
+            token_counts = [count_tokens(doc.data) for doc, _ in hits]
+        return self.reranker.select(
+            [(i, score) for i, (_, score) in enumerate(hits)],
+            vectors,
+            num_relevant,
+            added=added,
+            token_counts=token_counts,
+            max_tokens=max_tokens,
+        )
+
+    def _touch(self, docs) -> None:
+        """
+        Records the retrieval of memories for eviction.
+
+        Args:
+            docs: The retrieved documents.
+
+        Returns: None
+        """
+        if self.evictor is None or not docs:
+            return
+        now = time.time()
+        prefix = f"{self.cfg.memory_index}:"
+        memory_ids = [int(doc.id[len(prefix) :]) for doc in docs]
+        self.evictor.touch(memory_ids, now)
+        pipe = self.redis.pipeline()
+        for doc in docs:
+            pipe.hset(doc.id, "last_used", now)
+            pipe.hincrby(doc.id, "retrievals", 1)
+        pipe.execute()
+
+    def _rank(
+        self,
+        text: str,
+        query_embedding,
+        mode: str,
+        depth: int,
+        where: Metadata,
+        ef_runtime: Optional[int] = None,
+    ):
+        """
+        Ranks the memories matching a filter for one query.
+
+        Args:
+            text: The query text.
+            query_embedding: The query embedding, None for lexical queries.
+            mode: "vector", "lexical" or "hybrid".
+            depth: The number of results of every ranking.
+            where: A metadata filter that some memory can match.
+            ef_runtime: The HNSW candidate list size, None for the default.
+
+        Returns: The (document, score) results, best first.
+        """
+        filter_query = self._filter_query(where)
+        allowed = None
+        if self.mirror is not None:
+            allowed = self.mirror.allowed(_tag_filter(where))
+        rankings = []
+        if mode != "lexical":
+            rankings.append(
+                self._knn(query_embedding, depth, filter_query, allowed, ef_runtime)
+            )
+        if mode != "vector":
+            rankings.append(self._bm25(text, depth, filter_query, allowed))
+        if mode != "hybrid":
+            return rankings[0]
+        docs = {doc.id: doc for ranking in rankings for doc, _ in ranking}
+        fused = reciprocal_rank_fusion(
+            [doc.id for doc, _ in ranking] for ranking in rankings
+        )
+        return [(docs[doc_id], score) for doc_id, score in fused]
+
+    def _read_back(self, hits):
+        """
+        Reads the results found in the local copy of the index again, with one
+        pipeline, dropping the memories other processes deleted and updating
+        the ones they merged.
+
+        Returns: The (document, score) results that are still stored.
+        """
+        prefix = f"{self.cfg.memory_index}:"
+        memory_ids = [int(doc.id[len(prefix) :]) for doc, _ in hits]
+        missing = set(self.mirror.read(memory_ids))
+        stored = []
+        for (doc, score), memory_id in zip(hits, memory_ids):
+            if memory_id not in missing:
+                doc.data = self.mirror.texts[self.mirror.rows[memory_id]]
+                stored.append((doc, score))
+        return stored
+
+    def _knn(
+        self,
+        query_embedding,
+        num_relevant: int,
+        filter_query: str = "",
+        allowed: Optional[np.ndarray] = None,
+        ef_runtime: Optional[int] = None,
+    ):
+        """
+        Ranks the memories by the cosine similarity of their embedding to the
+        query, in the local copy of the index when there is one.
+
+        Returns: The documents, best first, with their similarity.
+        """
+        if self.mirror is not None:
+            return self.mirror.knn(query_embedding, num_relevant, allowed)
+        ef = ""
+        if ef_runtime is not None and self.algorithm == "HNSW":
+            ef = f" EF_RUNTIME {int(ef_runtime)}"
+        base_query = (
+            f"({filter_query or '*'})"
+            f"=>[KNN {num_relevant} @embedding $vector{ef} AS vector_score]"
+        )
         query = (
             Query(base_query)
             .return_fields("data", "vector_score")
             .sort_by("vector_score")
             .dialect(2)
         )
-        query_vector = np.array(query_embedding).astype(np.float32).tobytes()
+        query_vector = np.array(query_embedding).astype(self.vector_dtype).tobytes()
+        results = self.redis.ft(f"{self.cfg.memory_index}").search(
+            query, query_params={"vector": query_vector}
+        )
+        return [(doc, 1 - float(doc.vector_score)) for doc in results.docs]
 
-        try:
-            results = self.redis.ft(f"{self.cfg.memory_index}").search(
-                query, query_params={"vector": query_vector}
-            )
-        except Exception as e:
-            print("Error calling Redis search: ", e)
-            return None
-        return [result.data for result in results.docs]
+    def _bm25(
+        self,
+        text: str,
+        num_relevant: int,
+        filter_query: str = "",
+        allowed: Optional[np.ndarray] = None,
+    ):
+        """
+        Ranks the memories sharing a word with the text by BM25.
+
+        Args:
+            text: The query text.
+            num_relevant: The number of results.
+            filter_query: The clauses of a metadata filter.
+            allowed: The rows of the local copy of the index matching the
+                filter, when there is one.
+
+        Returns: The documents, best first, with their score.
+        """
+        if self.mirror is not None:
+            return self.mirror.bm25(text, num_relevant, allowed)
+        words = sorted(set(WORD.findall(text.lower())))
+        if not words:
+            return []
+        query = (
+            Query(f"@data:({'|'.join(words)}) {filter_query}".strip())
+            .scorer("BM25")
+            .with_scores()
+            .return_fields("data")
+            .paging(0, num_relevant)
+            .dialect(2)
+        )
+        docs = self.redis.ft(f"{self.cfg.memory_index}").search(query).docs
+        return [(doc, float(doc.score)) for doc in docs]
 
     def get_stats(self):
         """
-        Returns: The stats of the memory index.
+        Returns: The stats of the memory index and of the embedding cache.
         """
-        return self.redis.ft(f"{self.cfg.memory_index}").info()
+        if self.mirror is not None:
+            stats = {"search": "local", "num_docs": len(self.mirror)}
+        else:
+            stats = self.redis.ft(f"{self.cfg.memory_index}").info()
+        stats["embedding_cache"] = get_embedding_cache().stats()
+        return stats
@@ -0,0 +1,314 @@
+"""
+A local copy of a Redis memory index, for Redis servers without RediSearch.
+
+Without the RediSearch module the server cannot rank memories, so RedisMemory
+keeps the texts, embeddings and metadata of its index in process and scores
+queries with NumPy, like the local memory. The copy is loaded with SCAN and
+pipelined HGETALL, then kept in sync through the vec_num counter: memory ids
+are reserved in increasing order, so before a query only the ids between the
+last one read and the counter are read. An id that is reserved but not written
+yet is read again by the syncs of the next PENDING_SECONDS.
+
+Merges and evictions do not move the counter. Those of this process update the
+copy directly, those of other processes are caught when the results of a query
+are read back: deleted memories are dropped and merged ones are read again, so
+only their rank may be stale.
+"""
+import re
+import time
+from array import array
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+from redis.commands.search.document import Document
+
+from memories.lexical import BM25Index
+from memories.local import EmbeddingMatrix
+from memories.metadata import Metadata
+from memories.metadata import MetadataColumns
+from memories.metadata import RESERVED
+from memories.search import top_k
+
+PENDING_SECONDS = 60
+# the keys scanned and the hashes read per round trip
+READ_CHUNK = 1000
+
+GLOB_SPECIAL = re.compile(r"([*?\[\]\\])")
+
+
+def key_pattern(index: str) -> str:
+    """Returns: The SCAN pattern of the memory keys of an index."""
+    return GLOB_SPECIAL.sub(r"\\\1", index) + ":*"
+
+
+class RedisMirror:
+    def __init__(self, redis, index: str, dimension: int, dtype=np.float32) -> None:
+        """
+        Creates an empty copy of an index.
+
+        Args:
+            redis: The Redis client.
+            index: The memory index, its memories are stored at "index:id".
+            dimension: The dimension of the embeddings.
+            dtype: The dtype of the embeddings stored in the hashes.
+
+        Returns: None
+        """
+        self.redis = redis
+        self.prefix = f"{index}:"
+        self.pattern = key_pattern(index)
+        self.counter = f"{index}-vec_num"
+        self.fields_key = f"{index}-fields"
+        self.dimension = dimension
+        self.dtype = dtype
+        # metadata field -> "TAG" or "NUMERIC", for all processes
+        self.fields: Dict[str, str] = {"added": "NUMERIC"}
+        self.clear()
+
+    def clear(self) -> None:
+        self.embeddings = EmbeddingMatrix(self.dimension)
+        # the memory id of every row, -1 for a free row
+        self.ids = array("q")
+        self.rows: Dict[int, int] = {}
+        self.texts: List[str] = []
+        self.free_rows: List[int] = []
+        self.metadata = MetadataColumns()
+        # built on the first lexical or hybrid query
+        self.lexical: Optional[BM25Index] = None
+        # the ids below were read
+        self.synced = 0
+        # one more than the highest id in the copy
+        self.top = 0
+        # id -> when it was first found reserved but not written
+        self.pending: Dict[int, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add_field(self, name: str, kind: str) -> str:
+        """
+        Records the type of a metadata field for all processes.
+
+        Returns: The type the field has, the first process to see it sets it.
+        """
+        self.redis.hsetnx(self.fields_key, name, kind)
+        kind = self.redis.hget(self.fields_key, name).decode("utf-8")
+        self.fields[name] = kind
+        return kind
+
+    def load(self, visit: Optional[Callable[[int, Dict[bytes, bytes]], None]] = None):
+        """
+        Reads every memory of the index while scanning it, READ_CHUNK keys per
+        round trip.
+
+        Args:
+            visit: Called with the id and the hash of every memory read, so
+                that the same pass loads the dedup and eviction state.
+
+        Returns: None
+        """
+        self.clear()
+        self.load_fields()
+        # memories added while scanning are read again by the next sync
+        synced = int(self.redis.get(self.counter) or 0)
+        memory_ids = []
+        for key in self.redis.scan_iter(match=self.pattern, count=READ_CHUNK):
+            memory_id = key.decode("utf-8")[len(self.prefix) :]
+            if memory_id.isdigit():
+                memory_ids.append(int(memory_id))
+            if len(memory_ids) >= READ_CHUNK:
+                self.read(memory_ids, visit)
+                memory_ids = []
+        self.read(memory_ids, visit)
+        self.synced = synced
+
+    def sync(self) -> None:
+        """
+        Reads the memories added since the last sync, with one round trip when
+        there are none.
+
+        Returns: None
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.counter)
+        pipe.hgetall(self.fields_key)
+        counter, fields = pipe.execute()
+        self._set_fields(fields)
+        end = int(counter or 0)
+        if end < max(self.synced, self.top):
+            # the index was cleared
+            self.clear()
+        now = time.time()
+        self.pending = {
+            memory_id: since
+            for memory_id, since in self.pending.items()
+            if now - since < PENDING_SECONDS
+        }
+        # the memories this process added are in the copy already
+        memory_ids = list(self.pending) + [
+            memory_id
+            for memory_id in range(self.synced, end)
+            if memory_id not in self.rows
+        ]
+        for memory_id in self.read(memory_ids):
+            self.pending.setdefault(memory_id, now)
+        self.synced = max(self.synced, end)
+
+    def load_fields(self) -> None:
+        """Reads the types of the metadata fields."""
+        self._set_fields(self.redis.hgetall(self.fields_key))
+
+    def _set_fields(self, fields: Dict[bytes, bytes]) -> None:
+        for name, kind in fields.items():
+            self.fields[name.decode("utf-8")] = kind.decode("utf-8")
+
+    def read(
+        self,
+        memory_ids: Iterable[int],
+        visit: Optional[Callable[[int, Dict[bytes, bytes]], None]] = None,
+    ) -> List[int]:
+        """
+        Reads memories into the copy, replacing the rows they had.
+
+        Args:
+            memory_ids: The ids to read.
+            visit: Called with the id and the hash of every stored memory.
+
+        Returns: The ids that are not stored.
+        """
+        memory_ids = list(memory_ids)
+        missing = []
+        for start in range(0, len(memory_ids), READ_CHUNK):
+            chunk = memory_ids[start : start + READ_CHUNK]
+            pipe = self.redis.pipeline(transaction=False)
+            for memory_id in chunk:
+                pipe.hgetall(f"{self.prefix}{memory_id}")
+            for memory_id, values in zip(chunk, pipe.execute()):
+                if b"data" in values and b"embedding" in values:
+                    self.put(memory_id, values)
+                    if visit is not None:
+                        visit(memory_id, values)
+                else:
+                    missing.append(memory_id)
+                    self.remove(memory_id)
+        for memory_id in memory_ids:
+            if memory_id in self.rows:
+                self.pending.pop(memory_id, None)
+        return missing
+
+    def put(self, memory_id: int, values: Dict[bytes, bytes]) -> None:
+        """
+        Stores the hash of a memory in the copy.
+
+        Returns: None
+        """
+        vector = np.frombuffer(values[b"embedding"], dtype=self.dtype)
+        text = values[b"data"].decode("utf-8")
+        metadata: Metadata = {}
+        for name, value in values.items():
+            name = name.decode("utf-8")
+            if name in RESERVED:
+                continue
+            value = value.decode("utf-8")
+            if self.fields.get(name) == "NUMERIC":
+                try:
+                    metadata[name] = float(value)
+                except ValueError:
+                    continue
+            else:
+                metadata[name] = value
+        self.set(memory_id, text, vector, metadata)
+
+    def set(
+        self, memory_id: int, text: str, vector: np.ndarray, metadata: Metadata
+    ) -> None:
+        """
+        Stores a memory in the copy, with its metadata as stored in its hash.
+
+        Returns: None
+        """
+        if len(vector) != self.dimension:
+            raise ValueError(
+                f"{self.prefix}{memory_id} holds a {len(vector)}-dimensional"
+                f" embedding, not a {self.dimension}-dimensional one"
+            )
+        self.top = max(self.top, memory_id + 1)
+        row = self.rows.get(memory_id)
+        if row is None and self.free_rows:
+            row = self.free_rows.pop()
+            self.ids[row] = memory_id
+        if row is None:
+            row = self.embeddings.append(vector)
+            self.ids.append(memory_id)
+            self.texts.append(text)
+        else:
+            self.embeddings[row] = vector
+            self.texts[row] = text
+            if self.lexical is not None:
+                self.lexical.remove(row)
+        self.rows[memory_id] = row
+        self.metadata.set(row, metadata)
+        if self.lexical is not None:
+            self.lexical.add(row, text)
+
+    def remove(self, memory_id: int) -> None:
+        row = self.rows.pop(memory_id, None)
+        if row is None:
+            return
+        self.embeddings[row] = np.zeros(self.dimension, dtype=np.float32)
+        self.ids[row] = -1
+        self.texts[row] = ""
+        self.metadata.set(row, {})
+        if self.lexical is not None:
+            self.lexical.remove(row)
+        self.free_rows.append(row)
+
+    def allowed(self, where: Optional[Metadata]) -> np.ndarray:
+        """
+        Returns: A boolean mask of the rows that hold a memory matching the
+            filter, with tags as they are stored.
+        """
+        allowed = np.frombuffer(self.ids, dtype=np.int64) >= 0
+        if where:
+            allowed &= self.metadata.mask(where)[: len(allowed)]
+        return allowed
+
+    def _documents(self, rows, scores) -> List[Tuple[Document, float]]:
+        return [
+            (Document(f"{self.prefix}{self.ids[row]}", data=self.texts[row]), score)
+            for row, score in zip(rows, scores)
+        ]
+
+    def knn(
+        self, query_embedding, k: int, allowed: np.ndarray
+    ) -> List[Tuple[Document, float]]:
+        """
+        Returns: The k allowed memories closest to the query, best first, with
+            their cosine similarity.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32)
+        if allowed.all():
+            rows, scores = top_k(self.embeddings.dot(query), k)
+        else:
+            candidates = np.flatnonzero(allowed)
+            found, scores = top_k(self.embeddings.take(candidates) @ query, k)
+            rows = candidates[found]
+        return self._documents(rows.tolist(), scores.tolist())
+
+    def bm25(self, text: str, k: int, allowed: np.ndarray):
+        """
+        Returns: The k allowed memories sharing a word with the text, best
+            first, with their BM25 score.
+        """
+        if self.lexical is None:
+            self.lexical = BM25Index()
+            self.lexical.add_many(
+                (row, text) for row, text in enumerate(self.texts) if self.ids[row] >= 0
+            )
+        hits = self.lexical.search(text, k, allowed)
+        return self._documents([row for row, _ in hits], [score for _, score in hits])
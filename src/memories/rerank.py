@@ -0,0 +1,122 @@
+"""
+Re-ranking of retrieved memories by recency and diversity.
+
+The agent repeats itself, so the memories most relevant to a query are often
+near duplicates of each other and fill the prompt with the same text. When
+re-ranking is on, a query first retrieves a pool of CANDIDATE_FACTOR times as
+many memories as requested, ranked by relevance alone, and Reranker.select
+picks the results from the pool:
+
+- the relevance of every candidate decays with its age, halving every
+  MEMORY_RECENCY_HALF_LIFE hours since the memory was added;
+- results are picked one at a time by Maximal Marginal Relevance, the candidate
+  maximizing ``lambda * relevance - (1 - lambda) * similarity`` where similarity
+  is the highest cosine similarity to the candidates picked so far, so a near
+  duplicate of a picked memory loses to a less relevant but new one;
+- with a token budget, candidates that no longer fit are skipped and picking
+  stops when none fits, so the results fill the budget instead of being a fixed
+  number.
+
+Every step is vectorized over the pool, a pick costs one matrix-vector product.
+"""
+import time
+from dataclasses import dataclass
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+
+# the candidates retrieved per requested result when re-ranking
+CANDIDATE_FACTOR = 4
+
+
+@dataclass
+class Reranker:
+    # 1 ranks by relevance alone, 0 by novelty alone
+    mmr_lambda: float = 1.0
+    # seconds after which the relevance of a memory has halved, 0 for no decay
+    half_life: float = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.mmr_lambda < 1 or self.half_life > 0
+
+    def pool_size(self, k: int, max_tokens: Optional[int] = None) -> int:
+        """
+        Returns: The number of candidates to retrieve for k results.
+        """
+        if self.enabled or max_tokens is not None:
+            return k * CANDIDATE_FACTOR
+        return k
+
+    def select(
+        self,
+        hits: Sequence[Tuple[int, float]],
+        vectors: np.ndarray,
+        k: int,
+        added: Optional[np.ndarray] = None,
+        token_counts: Optional[Sequence[int]] = None,
+        max_tokens: Optional[int] = None,
+        now: Optional[float] = None,
+    ) -> List[Tuple[int, float]]:
+        """
+        Picks the results of a query from its candidates.
+
+        Args:
+            hits: The (memory id, relevance) candidates, best first. Relevance
+                is scaled to a best of 1, so BM25 and fused scores weigh like
+                cosine similarities.
+            vectors: The embeddings of the candidates.
+            k: The most results to pick.
+            added: When every candidate was added, NaN if unknown.
+            token_counts: The tokens of every candidate, with max_tokens.
+            max_tokens: The most tokens of all results, None for no budget.
+            now: The time of the query, defaults to now.
+
+        Returns: Up to k (memory id, decayed relevance) pairs, in the order
+            they were picked.
+        """
+        if not len(hits):
+            return []
+        relevance = np.array([score for _, score in hits], dtype=np.float64)
+        best = relevance.max()
+        if best > 0:
+            relevance /= best
+        if self.half_life > 0 and added is not None:
+            now = time.time() if now is None else now
+            age = np.nan_to_num(now - np.asarray(added, dtype=np.float64), nan=0.0)
+            relevance *= 0.5 ** (np.maximum(age, 0) / self.half_life)
+
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(hits), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1)
+        available = np.ones(len(hits), dtype=bool)
+        if max_tokens is not None:
+            tokens = np.asarray(token_counts, dtype=np.int64)
+            remaining = max_tokens
+        similarity = np.zeros(len(hits), dtype=np.float64)
+        picked = []
+        while len(picked) < k:
+            if max_tokens is not None:
+                available &= tokens <= remaining
+            if not available.any():
+                break
+            scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * similarity
+            scores[~available] = -np.inf
+            i = int(np.argmax(scores))
+            picked.append(i)
+            available[i] = False
+            if max_tokens is not None:
+                remaining -= tokens[i]
+            if self.mmr_lambda < 1:
+                similarity = np.maximum(similarity, vectors @ vectors[i])
+        return [(hits[i][0], float(relevance[i])) for i in picked]
+
+
+def reranker_from_config(cfg) -> Reranker:
+    """
+    Returns: The re-ranking configured for memory providers.
+    """
+    return Reranker(cfg.memory_mmr_lambda, cfg.memory_recency_half_life * 3600)
@@ -0,0 +1,37 @@
+"""Helpers shared by the memory providers that score embeddings locally."""
+from typing import Tuple
+
+import numpy as np
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Selects the k highest scores of every row with a partial sort.
+
+    np.argpartition finds the k best candidates in O(n), only those k are then
+    sorted, instead of sorting all n scores.
+
+    Args:
+        scores: A (n,) or (queries, n) array.
+        k: The number of results per row.
+
+    Returns: The indices and the scores of the results, best first, with shape
+        (k,) or (queries, k). k is capped at n.
+    """
+    scores = np.asarray(scores)
+    squeeze = scores.ndim == 1
+    scores = np.atleast_2d(scores)
+    k = max(0, min(k, scores.shape[1]))
+    if k == 0:
+        indices = np.zeros((scores.shape[0], 0), dtype=np.int64)
+    elif k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.broadcast_to(np.arange(k), scores.shape).copy()
+    selected = np.take_along_axis(scores, indices, axis=1)
+    order = np.argsort(-selected, axis=1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=1)
+    selected = np.take_along_axis(selected, order, axis=1)
+    if squeeze:
+        return indices[0], selected[0]
+    return indices, selected
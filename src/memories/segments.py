@@ -0,0 +1,539 @@
+"""
+Append-only segmented storage used by LocalCache.
+
+A memory directory holds a sequence of segments. Every segment is a pair of files
+named after the sequence number of its first record:
+
+    000000000000.vec  fixed-width float32 embedding rows
+    000000000000.log  length-prefixed text records (row id, byte length, utf-8 text)
+
+The n-th embedding row belongs to the n-th text record, so appending a memory only
+writes one row and one record at the end of the active segment. Once a segment is
+full it is sealed and never written to again. A record whose row id is already
+taken replaces that row; the latest record of a row wins.
+
+A background compactor folds sealed segments into a binary snapshot directory named
+after the number of records it covers:
+
+    snapshot-000000004096/embeddings.npy  (n, dim) float32 matrix
+    snapshot-000000004096/texts.bin       utf-8 texts, back to back
+    snapshot-000000004096/offsets.npy     (n + 1,) int64 byte offsets into texts.bin
+
+Snapshots are opened with ``np.memmap`` in read-only mode, so loading them costs no
+parsing, pages are read lazily, and several processes opening the same snapshot
+share one copy in the page cache. Only the segments written after the snapshot are
+replayed on startup.
+"""
+import os
+import shutil
+import struct
+import threading
+from collections.abc import Sequence
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import numpy as np
+
+RECORD_HEADER = struct.Struct("<QI")
+SEGMENT_ROWS = 4096
+COMPACT_SEGMENTS = 8
+SNAPSHOT_PREFIX = "snapshot-"
+
+
+def _segment_name(seq: int) -> str:
+    return f"{seq:012d}"
+
+
+def copy_on_write(array: np.ndarray) -> np.ndarray:
+    """
+    Reopens a read-only memory map so that rows can be changed in memory without
+    writing to the file.
+
+    Args:
+        array: A memory map, or an array that is already writable.
+
+    Returns: A writable view of the same data.
+    """
+    if array.flags.writeable:
+        return array
+    return np.memmap(
+        array.filename,
+        dtype=array.dtype,
+        mode="c",
+        shape=array.shape,
+        offset=array.offset,
+    )
+
+
+def _final_rows(rows: List[int], first: int) -> Tuple[np.ndarray, int]:
+    """
+    Resolves the row ids of a run of records against rows [0, first).
+
+    Args:
+        rows: The row id of every record, in log order.
+        first: The number of rows before the first record.
+
+    Returns: For every record, its row if no later record replaces it and -1
+        otherwise, and the number of rows after the records.
+    """
+    latest = {}
+    size = first
+    for i, row in enumerate(rows):
+        if row > size:
+            raise ValueError(f"Memory record {i} skips to row {row} of {size}")
+        size += row == size
+        latest[row] = i
+    dest = np.full(len(rows), -1, dtype=np.int64)
+    if latest:
+        records = np.fromiter(latest.values(), dtype=np.int64, count=len(latest))
+        dest[records] = np.fromiter(latest.keys(), dtype=np.int64, count=len(latest))
+    return dest, size
+
+
+def _read_records(filename: str) -> Tuple[List[int], List[bytes], List[int]]:
+    """
+    Parses a text log.
+
+    Args:
+        filename: The path of the ``.log`` file.
+
+    Returns: The row ids, the encoded texts and the byte offset of the end of
+        every complete record. A truncated trailing record is ignored.
+    """
+    rows, texts, ends = [], [], []
+    with open(filename, "rb") as f:
+        buf = f.read()
+    pos = 0
+    while pos + RECORD_HEADER.size <= len(buf):
+        row, length = RECORD_HEADER.unpack_from(buf, pos)
+        start = pos + RECORD_HEADER.size
+        if start + length > len(buf):
+            break
+        rows.append(row)
+        texts.append(buf[start : start + length])
+        pos = start + length
+        ends.append(pos)
+    return rows, texts, ends
+
+
+class TextBlob(Sequence):
+    """
+    Read-only sequence of the texts of a snapshot. Texts are decoded from the
+    memory-mapped blob when they are accessed.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray) -> None:
+        self.blob = blob
+        self.offsets = offsets
+        # texts replaced by records written after the snapshot
+        self.replaced: Dict[int, str] = {}
+
+    @classmethod
+    def open(cls, path: str) -> "TextBlob":
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        blob_name = os.path.join(path, "texts.bin")
+        if os.path.getsize(blob_name):
+            blob = np.memmap(blob_name, dtype=np.uint8, mode="r")
+        else:
+            blob = np.zeros(0, dtype=np.uint8)
+        return cls(blob, offsets)
+
+    @classmethod
+    def empty(cls) -> "TextBlob":
+        return cls(np.zeros(0, dtype=np.uint8), np.zeros(1, dtype=np.int64))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("text index out of range")
+        if index in self.replaced:
+            return self.replaced[index]
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+    def __setitem__(self, index: int, text: str) -> None:
+        if not 0 <= index < len(self):
+            raise IndexError("text index out of range")
+        self.replaced[index] = text
+
+
+class SegmentLog:
+    def __init__(
+        self,
+        path: str,
+        dim: int,
+        segment_rows: int = SEGMENT_ROWS,
+        compact_segments: int = COMPACT_SEGMENTS,
+    ) -> None:
+        """
+        Opens (or creates) a segmented log in the given directory.
+
+        Args:
+            path: The directory holding the segments.
+            dim: The width of an embedding row.
+            segment_rows: The number of records after which a segment is sealed.
+            compact_segments: The number of sealed segments that triggers a
+                background compaction.
+
+        Returns: None
+        """
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * np.dtype(np.float32).itemsize
+        self.segment_rows = segment_rows
+        self.compact_segments = compact_segments
+        self._lock = threading.Lock()
+        self._compactor = None
+        # [start seq, record count] of every segment, the last one is active
+        self._segments: List[List[int]] = []
+        self._vec_file = None
+        self._log_file = None
+        self.snapshot_seq = 0
+        self.next_seq = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _files(self, seq: int) -> Tuple[str, str]:
+        name = os.path.join(self.path, _segment_name(seq))
+        return f"{name}.vec", f"{name}.log"
+
+    def _list_segments(self) -> List[int]:
+        starts = set()
+        for filename in os.listdir(self.path):
+            name, ext = os.path.splitext(filename)
+            if ext in (".vec", ".log") and name.isdigit():
+                starts.add(int(name))
+        return sorted(starts)
+
+    def _list_snapshots(self) -> List[int]:
+        seqs = []
+        for filename in os.listdir(self.path):
+            seq = filename[len(SNAPSHOT_PREFIX) :]
+            if filename.startswith(SNAPSHOT_PREFIX) and seq.isdigit():
+                seqs.append(int(seq))
+        return sorted(seqs)
+
+    def _snapshot_path(self, seq: int) -> str:
+        return os.path.join(self.path, f"{SNAPSHOT_PREFIX}{_segment_name(seq)}")
+
+    def _open_snapshot(self, seq: int) -> Tuple[TextBlob, np.ndarray]:
+        if not seq:
+            return TextBlob.empty(), np.zeros((0, self.dim), dtype=np.float32)
+        path = self._snapshot_path(seq)
+        embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        if embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f"{path} holds {embeddings.shape[1]}-dimensional embeddings, not"
+                f" {self.dim}-dimensional ones"
+            )
+        return TextBlob.open(path), embeddings
+
+    def is_empty(self) -> bool:
+        """
+        Returns: Whether the log holds neither a segment nor a snapshot.
+        """
+        return not self._list_segments() and not self._list_snapshots()
+
+    def load(self) -> Tuple[TextBlob, np.ndarray, List[str], np.ndarray]:
+        """
+        Maps the latest snapshot and replays the segments written after it,
+        repairing torn writes and dropping files that a finished compaction has
+        already folded into the snapshot.
+
+        Returns: The snapshot texts and memory-mapped embeddings, followed by the
+            texts and embeddings of the rows added after the snapshot. Row i of
+            either matrix belongs to text i of the matching texts. Snapshot rows
+            replaced by later records are patched in memory only, the snapshot
+            is then mapped copy-on-write.
+        """
+        snapshots = self._list_snapshots()
+        self.snapshot_seq = snapshots[-1] if snapshots else 0
+        for seq in snapshots[:-1]:
+            shutil.rmtree(self._snapshot_path(seq), ignore_errors=True)
+        for filename in os.listdir(self.path):
+            if filename.startswith(SNAPSHOT_PREFIX) and filename.endswith(".tmp"):
+                shutil.rmtree(os.path.join(self.path, filename), ignore_errors=True)
+        base_texts, base_embeddings = self._open_snapshot(self.snapshot_seq)
+
+        texts: List[str] = []
+        blocks: List[np.ndarray] = []
+        rows: List[int] = []
+        self._segments = []
+        self.next_seq = self.snapshot_seq
+        for start in self._list_segments():
+            vec_name, log_name = self._files(start)
+            if not (os.path.exists(vec_name) and os.path.exists(log_name)):
+                self._remove(start)
+                continue
+            seg_rows, seg_texts, ends = _read_records(log_name)
+            vectors = np.fromfile(vec_name, dtype=np.float32)
+            count = min(len(seg_rows), len(vectors) // self.dim)
+            if start + count <= self.next_seq:
+                # already part of the snapshot or of a merged segment
+                self._remove(start)
+                continue
+            if start > self.next_seq:
+                print(
+                    f"Warning: memory records {self.next_seq}-{start - 1} are missing"
+                    f" from {self.path}"
+                )
+            skip = max(self.next_seq - start, 0)
+            vectors = vectors[: count * self.dim].reshape(count, self.dim)
+            rows.extend(seg_rows[skip:count])
+            texts.extend(text.decode("utf-8") for text in seg_texts[skip:count])
+            blocks.append(vectors[skip:count])
+            # drop a torn trailing write so the next append starts on a boundary
+            self._truncate(start, count, ends[count - 1] if count else 0)
+            self._segments.append([start, count])
+            self.next_seq = start + count
+
+        embeddings = (
+            np.concatenate(blocks, axis=0)
+            if blocks
+            else np.zeros((0, self.dim), dtype=np.float32)
+        )
+        first = len(base_texts)
+        if rows != list(range(first, first + len(rows))):
+            try:
+                dest, _ = _final_rows(rows, first)
+            except ValueError as e:
+                raise ValueError(
+                    f"Memory log {self.path} does not continue its snapshot"
+                ) from e
+            replaced = np.flatnonzero((dest >= 0) & (dest < first))
+            if len(replaced):
+                base_embeddings = copy_on_write(base_embeddings)
+                base_embeddings[dest[replaced]] = embeddings[replaced]
+                for i in replaced.tolist():
+                    base_texts[int(dest[i])] = texts[i]
+            added = np.flatnonzero(dest >= first)
+            added = added[np.argsort(dest[added], kind="stable")]
+            texts = [texts[i] for i in added.tolist()]
+            embeddings = embeddings[added]
+        if len(self._segments) - 1 >= self.compact_segments:
+            self.compact_in_background()
+        return base_texts, base_embeddings, texts, embeddings
+
+    def _truncate(self, start: int, count: int, log_end: int) -> None:
+        vec_name, log_name = self._files(start)
+        if os.path.getsize(vec_name) != count * self.row_bytes:
+            os.truncate(vec_name, count * self.row_bytes)
+        if os.path.getsize(log_name) != log_end:
+            os.truncate(log_name, log_end)
+
+    def _remove(self, start: int) -> None:
+        for filename in self._files(start):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+    def _open_active(self) -> None:
+        if not self._segments or self._segments[-1][1] >= self.segment_rows:
+            self._seal()
+            self._segments.append([self.next_seq, 0])
+        vec_name, log_name = self._files(self._segments[-1][0])
+        self._vec_file = open(vec_name, "ab")
+        self._log_file = open(log_name, "ab")
+
+    def _seal(self) -> None:
+        for f in (self._vec_file, self._log_file):
+            if f is not None:
+                f.close()
+        self._vec_file = self._log_file = None
+
+    def append(self, row: int, text: str, vector: np.ndarray) -> None:
+        """
+        Appends one record to the active segment.
+
+        Args:
+            row: The row the record belongs to.
+            text: The text of the memory.
+            vector: The embedding of the memory.
+
+        Returns: None
+        """
+        self.extend(row, [text], np.asarray(vector).reshape(1, -1))
+
+    def extend(self, row: int, texts: List[str], vectors: np.ndarray) -> None:
+        """
+        Appends records for consecutive rows, rolling over to new segments as
+        they fill up.
+
+        Args:
+            row: The row of the first record.
+            texts: The texts of the memories.
+            vectors: The (len(texts), dim) embeddings of the memories.
+
+        Returns: None
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        done = 0
+        with self._lock:
+            while done < len(texts):
+                if self._vec_file is None or self._segments[-1][1] >= self.segment_rows:
+                    self._seal()
+                    self._open_active()
+                n = min(len(texts) - done, self.segment_rows - self._segments[-1][1])
+                records = []
+                for i in range(done, done + n):
+                    encoded = texts[i].encode("utf-8")
+                    records.append(RECORD_HEADER.pack(row + i, len(encoded)))
+                    records.append(encoded)
+                self._vec_file.write(vectors[done : done + n].tobytes())
+                self._log_file.write(b"".join(records))
+                self._vec_file.flush()
+                self._log_file.flush()
+                self._segments[-1][1] += n
+                self.next_seq += n
+                done += n
+            sealed = len(self._segments) - 1
+        if sealed >= self.compact_segments:
+            self.compact_in_background()
+
+    def compact_in_background(self) -> None:
+        """
+        Starts a compaction thread unless one is already running.
+
+        Returns: None
+        """
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            self._compactor = threading.Thread(target=self.compact, daemon=True)
+            self._compactor.start()
+
+    def compact(self, seal_active: bool = False) -> None:
+        """
+        Folds the snapshot and all sealed segments into a new snapshot.
+
+        Sealed segments and snapshots are immutable, so they are read without
+        holding the lock. The new snapshot is written to a temporary directory
+        that is renamed into place before the old files are removed, so a crash
+        at any point leaves a log that ``load`` can replay.
+
+        Args:
+            seal_active: Whether to seal and fold the active segment as well.
+
+        Returns: None
+        """
+        with self._lock:
+            if seal_active:
+                self._seal()
+                self._segments.append([self.next_seq, 0])
+            sealed = [list(segment) for segment in self._segments[:-1]]
+            base_seq = self.snapshot_seq
+        if not sealed or not sum(count for _, count in sealed):
+            return
+        end = sealed[-1][0] + sealed[-1][1]
+        base_texts, base_embeddings = self._open_snapshot(base_seq)
+        first = len(base_embeddings)
+
+        rows: List[int] = []
+        texts: List[bytes] = []
+        for start, count in sealed:
+            seg_rows, seg_texts, _ = _read_records(self._files(start)[1])
+            rows.extend(seg_rows[:count])
+            texts.extend(seg_texts[:count])
+        try:
+            dest, size = _final_rows(rows, first)
+        except ValueError as e:
+            raise ValueError(f"Memory log {self.path} is not contiguous") from e
+
+        tmp = f"{self._snapshot_path(end)}.tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        embeddings = np.lib.format.open_memmap(
+            os.path.join(tmp, "embeddings.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=(size, self.dim),
+        )
+        embeddings[:first] = base_embeddings
+        record = 0
+        for start, count in sealed:
+            vectors = np.fromfile(
+                self._files(start)[0], dtype=np.float32, count=count * self.dim
+            ).reshape(count, self.dim)
+            seg_dest = dest[record : record + count]
+            kept = seg_dest >= 0
+            embeddings[seg_dest[kept]] = vectors[kept]
+            record += count
+        embeddings.flush()
+        del embeddings
+
+        final_texts = {int(row): texts[i] for i, row in enumerate(dest) if row >= 0}
+        lengths = np.diff(base_texts.offsets)
+        replaced = sorted(row for row in final_texts if row < first)
+        with open(os.path.join(tmp, "texts.bin"), "wb") as blob:
+            if not replaced and base_seq:
+                with open(
+                    os.path.join(self._snapshot_path(base_seq), "texts.bin"), "rb"
+                ) as f:
+                    shutil.copyfileobj(f, blob)
+            elif base_seq:
+                # copy the unchanged runs of the old blob around replaced texts
+                offsets, done = base_texts.offsets, 0
+                for row in replaced:
+                    blob.write(base_texts.blob[offsets[done] : offsets[row]].tobytes())
+                    blob.write(final_texts[row])
+                    lengths[row] = len(final_texts[row])
+                    done = row + 1
+                blob.write(base_texts.blob[offsets[done] : offsets[first]].tobytes())
+            added = [final_texts[row] for row in range(first, size)]
+            blob.write(b"".join(added))
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(
+            np.concatenate([lengths, [len(text) for text in added]]), out=offsets[1:]
+        )
+        np.save(os.path.join(tmp, "offsets.npy"), offsets)
+        os.replace(tmp, self._snapshot_path(end))
+
+        with self._lock:
+            self._segments = self._segments[len(sealed) :]
+            self.snapshot_seq = end
+        for start, _ in sealed:
+            self._remove(start)
+        if base_seq:
+            # processes that still map the old snapshot keep reading it until
+            # they reopen, unlinking the files does not invalidate their pages
+            shutil.rmtree(self._snapshot_path(base_seq), ignore_errors=True)
+
+    def clear(self) -> None:
+        """
+        Deletes every segment.
+
+        Returns: None
+        """
+        self.wait()
+        with self._lock:
+            self._seal()
+            for start in self._list_segments():
+                self._remove(start)
+            for seq in self._list_snapshots():
+                shutil.rmtree(self._snapshot_path(seq), ignore_errors=True)
+            self._segments = []
+            self.snapshot_seq = 0
+            self.next_seq = 0
+
+    def wait(self) -> None:
+        """
+        Waits for a running compaction to finish.
+
+        Returns: None
+        """
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+
+    def close(self) -> None:
+        """
+        Waits for compaction and closes the active segment.
+
+        Returns: None
+        """
+        self.wait()
+        with self._lock:
+            self._seal()
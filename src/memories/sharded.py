@@ -0,0 +1,223 @@
+"""
+Multi-process exact search over an embedding matrix in shared memory.
+
+One matrix product over a large matrix runs on one core and is bound by the
+memory bandwidth that core can draw. ShardedSearch splits the rows over
+``workers`` shards, each in a multiprocessing.shared_memory segment, and a pool
+of worker processes scores one shard each and returns its top-k. Only the
+queries and the per-shard results are pickled, the rows are never copied
+between processes.
+
+Rows are dealt to the shards round-robin, row r going to shard r % workers, so
+the shards stay balanced as rows are appended and a replaced row is written to
+one known place. A shard doubles its segment when it is full; workers attach to
+the new segment the next time they score the shard.
+"""
+import atexit
+import contextlib
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import numpy as np
+
+from memories.search import top_k
+
+INITIAL_SHARD_ROWS = 1024
+# every worker is one process, its matrix products should not start threads
+THREAD_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+# shard number -> (segment name, segment, rows), in each worker
+_attached: Dict[int, Tuple[str, shared_memory.SharedMemory, np.ndarray]] = {}
+
+
+def _shard_rows(shard: int, name: str, capacity: int, dim: int) -> np.ndarray:
+    """
+    Returns: The rows of a shard in a worker, attaching to its segment if it is
+        new or was replaced by a larger one.
+    """
+    attached = _attached.get(shard)
+    if attached is None or attached[0] != name:
+        if attached is not None:
+            del _attached[shard]
+            attached[1].close()
+        # workers share the resource tracker of the parent, which unlinks the
+        # segments if the parent dies without doing so
+        segment = shared_memory.SharedMemory(name=name)
+        rows = np.ndarray((capacity, dim), dtype=np.float32, buffer=segment.buf)
+        attached = _attached[shard] = (name, segment, rows)
+    return attached[2]
+
+
+def _search_shard(
+    shard: int, name: str, capacity: int, size: int, queries: np.ndarray, k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scores the rows of one shard, in a worker.
+
+    Returns: The (queries, k) shard rows and scores of the best results.
+    """
+    rows = _shard_rows(shard, name, capacity, queries.shape[1])[:size]
+    return top_k(queries @ rows.T, k)
+
+
+@contextlib.contextmanager
+def _single_threaded_children():
+    saved = {name: os.environ.get(name) for name in THREAD_VARIABLES}
+    os.environ.update({name: "1" for name in THREAD_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+class SharedShard:
+    def __init__(self, dim: int, capacity: int = INITIAL_SHARD_ROWS) -> None:
+        """
+        Creates an empty shard.
+
+        Args:
+            dim: The dimension of the rows.
+            capacity: The number of rows the first segment holds.
+
+        Returns: None
+        """
+        self.dim = dim
+        self.size = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.segment = shared_memory.SharedMemory(
+            create=True, size=max(capacity * self.dim * 4, 1)
+        )
+        self.rows = np.ndarray(
+            (capacity, self.dim), dtype=np.float32, buffer=self.segment.buf
+        )
+
+    def append(self, rows: np.ndarray) -> None:
+        needed = self.size + len(rows)
+        if needed > self.capacity:
+            previous, filled = self.segment, self.rows[: self.size].copy()
+            self.rows = None
+            previous.close()
+            previous.unlink()
+            self._allocate(max(needed, 2 * self.capacity))
+            self.rows[: self.size] = filled
+        self.rows[self.size : needed] = rows
+        self.size = needed
+
+    def close(self) -> None:
+        self.rows = None
+        self.segment.close()
+        self.segment.unlink()
+
+
+class ShardedSearch:
+    def __init__(self, dim: int, workers: int) -> None:
+        """
+        Starts the worker processes. They are spawned, not forked, as the
+        parent may run other threads.
+
+        Args:
+            dim: The dimension of the rows.
+            workers: The number of shards and worker processes.
+
+        Returns: None
+        """
+        self.dim = dim
+        self.workers = workers
+        self.shards = [SharedShard(dim) for _ in range(workers)]
+        with _single_threaded_children():
+            self.pool = multiprocessing.get_context("spawn").Pool(workers)
+        atexit.register(self.close)
+
+    @property
+    def size(self) -> int:
+        return sum(shard.size for shard in self.shards)
+
+    def append(self, rows: np.ndarray) -> None:
+        """
+        Appends rows after the last one, dealing them to the shards.
+
+        Args:
+            rows: A (n, dim) array.
+
+        Returns: None
+        """
+        rows = np.asarray(rows, dtype=np.float32).reshape(-1, self.dim)
+        start = self.size
+        for shard_number, shard in enumerate(self.shards):
+            shard.append(rows[(shard_number - start) % self.workers :: self.workers])
+
+    def extend(self, matrix) -> None:
+        """Appends the rows of an EmbeddingMatrix, block by block."""
+        for _, rows in matrix.blocks():
+            self.append(rows)
+
+    def __setitem__(self, row: int, vector: np.ndarray) -> None:
+        self.shards[row % self.workers].rows[row // self.workers] = vector
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scores every row against a batch of queries, one shard per worker, and
+        merges the top-k of the shards.
+
+        Args:
+            queries: A (queries, dim) array.
+            k: The number of results per query.
+
+        Returns: The (queries, k) rows and scores of the results, best first.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.dim)
+        tasks = [
+            (number, shard.segment.name, shard.capacity, shard.size, queries, k)
+            for number, shard in enumerate(self.shards)
+            if shard.size
+        ]
+        if not tasks:
+            return top_k(np.zeros((len(queries), 0), np.float32), k)
+        indices: List[np.ndarray] = []
+        scores: List[np.ndarray] = []
+        for (number, *_), (shard_rows, shard_scores) in zip(
+            tasks, self.pool.starmap(_search_shard, tasks)
+        ):
+            indices.append(shard_rows * self.workers + number)
+            scores.append(shard_scores)
+        indices, scores = np.concatenate(indices, axis=1), np.concatenate(
+            scores, axis=1
+        )
+        best, scores = top_k(scores, k)
+        return np.take_along_axis(indices, best, axis=1), scores
+
+    def clear(self) -> None:
+        for shard in self.shards:
+            shard.close()
+        self.shards = [SharedShard(self.dim) for _ in range(self.workers)]
+
+    def close(self) -> None:
+        """
+        Stops the workers and frees the shared memory. Called at exit.
+
+        Returns: None
+        """
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        for shard in self.shards:
+            shard.close()
+        atexit.unregister(self.close)
@@ -0,0 +1,638 @@
+"""SQLite memory provider.
+
+SQLiteMemory stores every memory as a row of a SQLite file: the text, the
+float32 embedding packed into a BLOB, and the dedup and usage counters. An FTS5
+table over the texts, kept in sync by triggers, answers lexical queries with
+BM25. The embeddings are read into a NumPy matrix in chunks when the file is
+opened and scored in memory.
+
+The file is written in WAL mode with one transaction per batch of memories, so a
+crash never leaves a torn memory behind and other processes can read the file
+while the agent writes it. Rows other processes append are picked up before the
+next query. Only one process should write to a file.
+"""
+import os
+import sqlite3
+import time
+from array import array
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+import orjson
+
+from memories.base import count_tokens
+from memories.base import get_ada_embeddings
+from memories.base import get_embedding_provider
+from memories.base import MemoryProviderSingleton
+from memories.dedup import Deduplicator
+from memories.dedup import fingerprint
+from memories.embedding_cache import get_embedding_cache
+from memories.eviction import evictor_from_config
+from memories.lexical import check_mode
+from memories.lexical import FUSION_DEPTH
+from memories.lexical import reciprocal_rank_fusion
+from memories.lexical import WORD
+from memories.local import EmbeddingMatrix
+from memories.metadata import check_metadata
+from memories.metadata import Metadata
+from memories.metadata import MetadataColumns
+from memories.rerank import reranker_from_config
+from memories.search import top_k
+
+# rows read per fetch when the embeddings are loaded
+LOAD_CHUNK = 4096
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    exact INTEGER NOT NULL,
+    simhash INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    last_seen REAL NOT NULL,
+    added REAL NOT NULL,
+    last_used REAL NOT NULL,
+    retrievals INTEGER NOT NULL DEFAULT 0,
+    metadata TEXT NOT NULL DEFAULT '{}'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts
+    USING fts5(text, content='memories', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS memories_insert AFTER INSERT ON memories BEGIN
+    INSERT INTO memories_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS memories_delete AFTER DELETE ON memories BEGIN
+    INSERT INTO memories_fts (memories_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS memories_update AFTER UPDATE OF text ON memories BEGIN
+    INSERT INTO memories_fts (memories_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    INSERT INTO memories_fts (rowid, text) VALUES (new.id, new.text);
+END;
+"""
+
+
+def _to_sqlite(value: int) -> int:
+    """Maps an unsigned 64-bit fingerprint to a signed SQLite integer."""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _from_sqlite(value: int) -> int:
+    return value & ((1 << 64) - 1)
+
+
+class SQLiteMemory(MemoryProviderSingleton):
+    def __init__(self, cfg):
+        """
+        Opens or creates the SQLite file of the memory index and loads the
+        embeddings, fingerprints and usage of the stored memories.
+
+        Args:
+            cfg: The config object.
+
+        Returns: None
+        """
+        self.filename = f"{cfg.memory_index}.db"
+        self.dimension = get_embedding_provider().dimension
+        self.db = sqlite3.connect(self.filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(memories)")]
+        if "metadata" not in columns:
+            self.db.execute(
+                "ALTER TABLE memories ADD COLUMN metadata TEXT NOT NULL DEFAULT '{}'"
+            )
+        self.duplicates = Deduplicator(cfg.memory_dedup, cfg.memory_dedup_distance)
+        self.evictor = evictor_from_config(cfg)
+        self.search_mode = check_mode(cfg.memory_search_mode)
+        self.reranker = reranker_from_config(cfg)
+        self._reset()
+        self._load()
+        while self.evictor is not None and len(self.evictor) > self.evictor.capacity:
+            with self.db:
+                self._delete(self.evictor.victim())
+
+    def _reset(self) -> None:
+        self.embeddings = EmbeddingMatrix(self.dimension)
+        # the memory id of every matrix row, -1 for a free row
+        self.ids = array("q")
+        self.rows: Dict[int, int] = {}
+        self.free_rows: List[int] = []
+        # the metadata of every matrix row
+        self.metadata = MetadataColumns()
+        self.next_id = 1
+        self.duplicates.clear()
+        if self.evictor is not None:
+            self.evictor.clear()
+        self._data_version = None
+
+    def _load(self) -> None:
+        """
+        Reads the memories written since the last load, LOAD_CHUNK rows at a
+        time.
+
+        Returns: None
+        """
+        cursor = self.db.execute(
+            "SELECT id, embedding, metadata, exact, simhash, added, last_used,"
+            " retrievals FROM memories WHERE id >= ? ORDER BY id",
+            (self.next_id,),
+        )
+        while True:
+            chunk = cursor.fetchmany(LOAD_CHUNK)
+            if not chunk:
+                break
+            vectors = np.frombuffer(b"".join(row[1] for row in chunk), np.float32)
+            if len(vectors) != len(chunk) * self.dimension:
+                raise ValueError(
+                    f"{self.filename} holds embeddings of another dimension than"
+                    f" the {self.dimension} of the embedding provider"
+                )
+            start = self.embeddings.append(vectors.reshape(len(chunk), self.dimension))
+            for row, (memory_id, _, metadata, exact, sim, *usage) in enumerate(
+                chunk, start
+            ):
+                self.ids.append(memory_id)
+                self.rows[memory_id] = row
+                self.metadata.set(row, orjson.loads(metadata))
+                self.duplicates.remember(
+                    memory_id, (_from_sqlite(exact), _from_sqlite(sim))
+                )
+                if self.evictor is not None:
+                    self.evictor.track(memory_id, *usage)
+            self.next_id = chunk[-1][0] + 1
+        (self._data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+
+    def _refresh(self) -> None:
+        """Loads the memories other processes added since the last query."""
+        (data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+        if data_version != self._data_version:
+            self._load()
+
+    def _delete(self, memory_id: int) -> None:
+        """
+        Deletes an evicted memory and frees its matrix row. Runs inside the
+        transaction of the caller.
+
+        Returns: None
+        """
+        self.db.execute("DELETE FROM memories WHERE id = ?", (memory_id,))
+        self.duplicates.forget(memory_id)
+        row = self.rows.pop(memory_id, None)
+        if row is not None:
+            self.embeddings[row] = np.zeros(self.dimension, dtype=np.float32)
+            self.ids[row] = -1
+            self.metadata.set(row, {})
+            self.free_rows.append(row)
+
+    def add(self, data: str, metadata: Optional[Metadata] = None) -> str:
+        """
+        Adds a data point to the memory.
+
+        Args:
+            data: The data to add.
+            metadata: The metadata queries can filter the data by.
+
+        Returns: The data if it was added or merged into a memory.
+        """
+        if "Command Error:" in data:
+            return ""
+        return data if self.add_many([data], [metadata]) else ""
+
+    def add_many(
+        self, texts: List[str], metadata: Optional[List[Metadata]] = None
+    ) -> List[str]:
+        """
+        Adds several data points with one embedding request and one
+        transaction.
+
+        Args:
+            texts: The data to add.
+            metadata: The metadata of every data point, or None.
+
+        Returns: The data that was added or merged into a memory.
+        """
+        return self._store(texts, get_ada_embeddings, metadata)
+
+    def add_embeddings(
+        self,
+        texts: List[str],
+        embeddings: np.ndarray,
+        metadata: Optional[List[Metadata]] = None,
+    ) -> List[str]:
+        """
+        Adds data points with embeddings computed before, without embedding
+        them again.
+
+        Args:
+            texts: The data to add.
+            embeddings: One embedding per text.
+            metadata: The metadata of every data point, or None.
+
+        Returns: The data that was added or merged into a memory.
+        """
+        vectors = dict(zip(texts, np.asarray(embeddings, dtype=np.float32)))
+        return self._store(
+            texts, lambda stored: [vectors[text] for text in stored], metadata
+        )
+
+    def _store(
+        self, texts: List[str], embed, metadata: Optional[List[Metadata]] = None
+    ) -> List[str]:
+        """
+        Applies the dedup and eviction policies to texts, embeds the ones that
+        are stored and writes them in one transaction.
+
+        Args:
+            texts: The data to add.
+            embed: Returns the embeddings of a list of texts.
+            metadata: The metadata of every text, or None.
+
+        Returns: The data that was added or merged into a memory.
+        """
+        now = time.time()
+        # memory id -> [action, text, fingerprints, repeats, metadata]
+        writes: Dict[int, list] = {}
+        bumps: List[int] = []
+        evicted: List[int] = []
+        for text, fields in zip(texts, metadata or [None] * len(texts)):
+            if "Command Error:" in text:
+                continue
+            fields = check_metadata(fields, now)
+            fingerprints = fingerprint(text)
+            action, memory_id = self.duplicates.decide(fingerprints)
+            if action == "skip":
+                continue
+            if memory_id in writes:
+                # repeats a text of the same batch
+                writes[memory_id][3] += 1
+                if action == "merge":
+                    writes[memory_id][1:3] = text, fingerprints
+                    writes[memory_id][4] = fields
+                    self.duplicates.remember(memory_id, fingerprints)
+                continue
+            if action == "bump":
+                bumps.append(memory_id)
+                continue
+            if action == "add":
+                memory_id = self.next_id
+                self.next_id += 1
+                if self.evictor is not None:
+                    victim = self.evictor.victim()
+                    if victim is not None:
+                        # the victim may be a text of the same batch
+                        if writes.pop(victim, None) is None:
+                            evicted.append(victim)
+                        self.duplicates.forget(victim)
+                    self.evictor.track(memory_id)
+            writes[memory_id] = [action, text, fingerprints, 1, fields]
+            self.duplicates.remember(memory_id, fingerprints)
+        if not writes and not bumps and not evicted:
+            return []
+
+        ids = list(writes)
+        stored = [writes[memory_id][1] for memory_id in ids]
+        vectors = np.array(embed(stored) if stored else [], dtype=np.float32)
+        vectors = vectors.reshape(len(stored), self.dimension)
+        inserts, merges = [], []
+        for memory_id, vector in zip(ids, vectors):
+            action, text, (exact, sim), repeats, fields = writes[memory_id]
+            values = (
+                text,
+                vector.tobytes(),
+                orjson.dumps(fields).decode(),
+                _to_sqlite(exact),
+                _to_sqlite(sim),
+            )
+            if action == "add":
+                inserts.append((memory_id, *values, repeats, now, fields["added"], now))
+            else:
+                merges.append((*values, repeats, now, memory_id))
+        with self.db:
+            for memory_id in evicted:
+                self._delete(memory_id)
+            self.db.executemany(
+                "INSERT INTO memories (id, text, embedding, metadata, exact, simhash,"
+                " count, last_seen, added, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                inserts,
+            )
+            self.db.executemany(
+                "UPDATE memories SET text = ?, embedding = ?, metadata = ?, exact = ?,"
+                " simhash = ?, count = count + ?, last_seen = ? WHERE id = ?",
+                merges,
+            )
+            self.db.executemany(
+                "UPDATE memories SET count = count + 1, last_seen = ? WHERE id = ?",
+                [(now, memory_id) for memory_id in bumps],
+            )
+        for memory_id, vector in zip(ids, vectors):
+            row = self.rows.get(memory_id)
+            if row is None and self.free_rows:
+                row = self.free_rows.pop()
+            if row is None:
+                row = self.embeddings.append(vector)
+                self.ids.append(memory_id)
+            else:
+                self.embeddings[row] = vector
+                self.ids[row] = memory_id
+            self.rows[memory_id] = row
+            self.metadata.set(row, writes[memory_id][4])
+        (self._data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+        return stored
+
+    def texts_to_embed(self, texts: List[str]) -> List[str]:
+        """
+        Returns: The texts that add_many would embed, the dedup policy drops or
+            bumps the others without an embedding.
+        """
+        return [
+            text
+            for text in texts
+            if "Command Error:" not in text and self.duplicates.needs_embedding(text)
+        ]
+
+    def iter_embeddings(
+        self, start: int = 0, batch_size: int = 1024
+    ) -> Iterator[Tuple[int, List[str], np.ndarray, List[Metadata]]]:
+        """
+        Streams the stored data with its embeddings and metadata in the order
+        of the memory ids.
+
+        Args:
+            start: The memory id to start from, a cursor yielded before.
+            batch_size: The number of memories per batch.
+
+        Returns: An iterator of (cursor, texts, embeddings, metadata) batches.
+        """
+        while True:
+            batch = self.db.execute(
+                "SELECT id, text, embedding, metadata FROM memories WHERE id >= ?"
+                " ORDER BY id LIMIT ?",
+                (start, batch_size),
+            ).fetchall()
+            if not batch:
+                return
+            start = batch[-1][0] + 1
+            vectors = np.frombuffer(b"".join(row[2] for row in batch), np.float32)
+            yield (
+                start,
+                [row[1] for row in batch],
+                vectors.reshape(-1, self.dimension),
+                [orjson.loads(row[3]) for row in batch],
+            )
+
+    def get(self, data: str) -> Optional[List[Any]]:
+        """
+        Gets the data from the memory that is most relevant to the given data.
+
+        Args:
+            data: The data to compare to.
+
+        Returns: The most relevant data.
+        """
+        return self.get_relevant(data, 1)
+
+    def get_relevant(
+        self,
+        data: str,
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[Any]:
+        """
+        Returns all the data in the memory that is relevant to the given data.
+
+        Args:
+            data: The data to compare to.
+            num_relevant: The number of relevant data to return.
+            mode: "vector", "lexical" or "hybrid", defaults to MEMORY_SEARCH_MODE.
+            where: A metadata filter, see memories.metadata.
+            max_tokens: The most tokens of all returned data, None for no limit.
+
+        Returns: A list of the most relevant data.
+        """
+        return [
+            memory
+            for memory, _ in self.get_relevant_batch(
+                [data], num_relevant, mode, where, max_tokens
+            )[0]
+        ]
+
+    def get_relevant_batch(
+        self,
+        texts: List[str],
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Returns the data relevant to each of several queries. Vector queries
+        are embedded with one request and scored with one matrix product,
+        lexical queries are ranked by the FTS5 BM25 function, hybrid queries
+        fuse both rankings by reciprocal rank. A metadata filter is evaluated
+        on the in-memory metadata columns before the memories are ranked. With
+        re-ranking on or a token budget, a larger pool of candidates is
+        re-ranked by recency and diversity, see memories.rerank.
+
+        Args:
+            texts: The data to compare to.
+            num_relevant: The number of relevant data to return per query.
+            mode: "vector", "lexical" or "hybrid", defaults to MEMORY_SEARCH_MODE.
+            where: A metadata filter, see memories.metadata.
+            max_tokens: The most tokens of the data returned per query, None
+                for no limit.
+
+        Returns: For every query, (data, score) pairs, best first. Scores are
+            cosine similarities, BM25 scores or fused reciprocal ranks, or
+            decayed relevances scaled to a best of 1 when re-ranked.
+        """
+        if not texts:
+            return []
+        mode = check_mode(mode or self.search_mode)
+        self._refresh()
+        pool = self.reranker.pool_size(num_relevant, max_tokens)
+        depth = pool if mode == "vector" else FUSION_DEPTH * pool
+        allowed = None
+        if where:
+            self.metadata.grow(len(self.embeddings))
+            allowed = self.metadata.mask(where)
+        rankings = [[] for _ in texts]
+        if mode != "lexical":
+            queries = np.array(get_ada_embeddings(texts), dtype=np.float32)
+            if allowed is None:
+                indices, scores = top_k(self.embeddings.dot(queries.T).T, depth)
+            else:
+                rows = np.flatnonzero(allowed)
+                indices, scores = top_k(queries @ self.embeddings.take(rows).T, depth)
+                indices = rows[indices]
+            for ranking, rows, row_scores in zip(
+                rankings, indices.tolist(), scores.tolist()
+            ):
+                ranking.append(
+                    [
+                        (self.ids[row], score)
+                        for row, score in zip(rows, row_scores)
+                        if self.ids[row] >= 0
+                    ]
+                )
+        if mode != "vector":
+            for ranking, text in zip(rankings, texts):
+                ranking.append(self._bm25(text, depth, allowed))
+
+        hits = []
+        for ranking in rankings:
+            if mode == "hybrid":
+                fused = reciprocal_rank_fusion(
+                    [memory_id for memory_id, _ in ranked] for ranked in ranking
+                )
+                hits.append(fused[:pool])
+            else:
+                hits.append(ranking[0])
+        candidates = sorted({memory_id for query in hits for memory_id, _ in query})
+        found = dict(
+            self.db.execute(
+                "SELECT id, text FROM memories WHERE id IN"
+                f" ({', '.join('?' * len(candidates))})",
+                candidates,
+            ).fetchall()
+        )
+        if pool > num_relevant:
+            hits = [
+                self._rerank(
+                    [hit for hit in query if hit[0] in found],
+                    num_relevant,
+                    found,
+                    max_tokens,
+                )
+                for query in hits
+            ]
+        self._touch(sorted({memory_id for query in hits for memory_id, _ in query}))
+        return [
+            [
+                (found[memory_id], float(score))
+                for memory_id, score in query
+                if memory_id in found
+            ]
+            for query in hits
+        ]
+
+    def _rerank(
+        self,
+        hits: List[Tuple[int, float]],
+        num_relevant: int,
+        found: Dict[int, str],
+        max_tokens: Optional[int],
+    ) -> List[Tuple[int, float]]:
+        """
+        Returns: The (memory id, score) results picked from the candidates of
+            a query.
+        """
+        rows = [self.rows[memory_id] for memory_id, _ in hits]
+        token_counts = None
+        if max_tokens is not None:
+            token_counts = [count_tokens(found[memory_id]) for memory_id, _ in hits]
+        return self.reranker.select(
+            hits,
+            self.embeddings.take(rows),
+            num_relevant,
+            added=self.metadata.numbers_of("added", rows),
+            token_counts=token_counts,
+            max_tokens=max_tokens,
+        )
+
+    def _bm25(
+        self, text: str, num_relevant: int, allowed: Optional[np.ndarray] = None
+    ) -> List[Tuple[int, float]]:
+        """
+        Ranks the memories sharing a word with the text with the FTS5 BM25
+        function, whose scores are negative, lower being better.
+
+        Args:
+            text: The query text.
+            num_relevant: The number of results.
+            allowed: A boolean mask of the matrix rows to rank, None for all.
+
+        Returns: (memory id, BM25 score) pairs, best first.
+        """
+        words = sorted(set(WORD.findall(text.lower())))
+        if not words:
+            return []
+        match = " OR ".join(f'"{word}"' for word in words)
+        if allowed is None:
+            return [
+                (memory_id, -score)
+                for memory_id, score in self.db.execute(
+                    "SELECT rowid, bm25(memories_fts) FROM memories_fts WHERE"
+                    " memories_fts MATCH ? ORDER BY bm25(memories_fts) LIMIT ?",
+                    (match, num_relevant),
+                )
+            ]
+        hits = []
+        # the ranked matches are read until enough of them pass the filter
+        for memory_id, score in self.db.execute(
+            "SELECT rowid, bm25(memories_fts) FROM memories_fts"
+            " WHERE memories_fts MATCH ? ORDER BY bm25(memories_fts)",
+            (match,),
+        ):
+            row = self.rows.get(memory_id)
+            if row is not None and allowed[row]:
+                hits.append((memory_id, -score))
+                if len(hits) == num_relevant:
+                    break
+        return hits
+
+    def _touch(self, memory_ids: List[int]) -> None:
+        """
+        Records the retrieval of memories for eviction.
+
+        Returns: None
+        """
+        if self.evictor is None or not memory_ids:
+            return
+        now = time.time()
+        self.evictor.touch(memory_ids, now)
+        with self.db:
+            self.db.executemany(
+                "UPDATE memories SET last_used = ?, retrievals = retrievals + 1"
+                " WHERE id = ?",
+                [(now, memory_id) for memory_id in memory_ids],
+            )
+        (self._data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+
+    def clear(self) -> str:
+        """
+        Deletes every memory.
+
+        Returns: A message indicating that the memory has been cleared.
+        """
+        with self.db:
+            self.db.execute("DROP TABLE memories_fts")
+            self.db.execute("DROP TABLE memories")
+        self.db.executescript(SCHEMA)
+        self._reset()
+        (self._data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+        return "Obliviated"
+
+    def get_stats(self):
+        """
+        Returns: The number of memories, the size of the file and the stats of
+            the embedding cache.
+        """
+        (count,) = self.db.execute("SELECT COUNT(*) FROM memories").fetchone()
+        return {
+            "memories": count,
+            "file_bytes": os.path.getsize(self.filename),
+            "embedding_cache": get_embedding_cache().stats(),
+        }
+
+    def close(self) -> None:
+        self.db.close()
@@ -0,0 +1,310 @@
+"""
+A hot tier in front of remote memory providers.
+
+TieredMemory keeps the memories recently added to or retrieved from a remote
+provider that counts its memory ids, Redis, in a NumPy matrix in the agent
+process. A query is
+answered from this hot set, without a round trip, when its results there are
+all at least min_score similar to it: a memory that close is what the provider
+would return too, short of a closer one the hot set does not hold. Other
+queries fall through to the provider, and their results join the hot set with
+the embeddings and added times the provider stored, see search_many.
+
+Writes go through to the provider, the memories it added join the hot set with
+the embeddings it stored. The hot set is dropped whenever the vec_num watermark
+of the provider, the number of memory ids handed out, moves by more than the
+memories this process added: another process added memories or cleared the
+provider, and the hot set may miss better results. Reading the watermark is a
+round trip, so it is read at most every watermark_seconds, before a query: for
+that long, the hot set may answer without the memories of other processes or
+with memories they cleared.
+Hybrid queries fuse the vector ranking of the hot set with a BM25 ranking of
+its words by reciprocal rank, like the providers do, and are answered there on
+the same condition: its vector results are all min_score similar. Lexical and
+filtered queries always go to the provider, the hot set only ranks the words of
+its own memories and does not know the metadata of retrieved memories.
+"""
+import time
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+from memories.base import count_tokens
+from memories.base import get_ada_embeddings
+from memories.base import get_embedding_provider
+from memories.lexical import BM25Index
+from memories.lexical import check_mode
+from memories.lexical import FUSION_DEPTH
+from memories.lexical import reciprocal_rank_fusion
+from memories.metadata import check_metadata
+from memories.metadata import Metadata
+from memories.rerank import reranker_from_config
+from memories.search import top_k
+
+
+class TieredMemory:
+    def __init__(self, memory, cfg) -> None:
+        """
+        Puts a hot set in front of a memory provider.
+
+        Args:
+            memory: The provider, its watermark() must not be None.
+            cfg: The config object, with the size and threshold of the hot set.
+
+        Returns: None
+        """
+        self.memory = memory
+        self.capacity = cfg.memory_hot_entries
+        self.min_score = cfg.memory_hot_min_score
+        self.watermark_seconds = cfg.memory_hot_watermark_seconds
+        self.reranker = reranker_from_config(cfg)
+        dimension = get_embedding_provider().dimension
+        self.embeddings = np.zeros((self.capacity, dimension), dtype=np.float32)
+        self.texts: List[Optional[str]] = [None] * self.capacity
+        # when every memory was added, NaN if the provider does not know
+        self.added = np.full(self.capacity, np.nan)
+        # the tick of the last add or retrieval of every row, -1 for a free row
+        self.used = np.full(self.capacity, -1, dtype=np.int64)
+        self.rows: Dict[str, int] = {}
+        # the words of the hot set by row, for hybrid queries
+        self.lexical = BM25Index()
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.watermark = memory.watermark()
+        # when the watermark was read, and the ids this process added since
+        self.checked = time.monotonic()
+        self.own = 0
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def invalidate(self) -> None:
+        """Drops the hot set."""
+        self.texts = [None] * self.capacity
+        self.added[:] = np.nan
+        self.used[:] = -1
+        self.rows = {}
+        self.lexical.clear()
+
+    def _check_watermark(self) -> None:
+        """
+        Drops the hot set if the provider handed out more memory ids than this
+        process added since the last check, or went back. The watermark is
+        read at most every watermark_seconds.
+
+        Returns: None
+        """
+        now = time.monotonic()
+        if now - self.checked < self.watermark_seconds:
+            return
+        watermark = self.memory.watermark()
+        if not 0 <= watermark - self.watermark <= self.own:
+            self.invalidate()
+        self.watermark = watermark
+        self.checked = now
+        self.own = 0
+
+    def _remember(self, texts: List[str], vectors, added) -> None:
+        """
+        Puts memories in the hot set, replacing the least recently used ones.
+
+        Returns: None
+        """
+        for text, vector, stamp in zip(texts, vectors, added):
+            self.tick += 1
+            row = self.rows.get(text)
+            if row is None:
+                row = int(np.argmin(self.used))
+                if self.used[row] >= 0:
+                    del self.rows[self.texts[row]]
+                    self.lexical.remove(row)
+                self.rows[text] = row
+                self.lexical.add(row, text)
+                self.texts[row] = text
+                self.embeddings[row] = vector
+                self.added[row] = stamp
+            elif not np.isnan(stamp):
+                self.added[row] = stamp
+            self.used[row] = self.tick
+
+    def add(self, data: str, metadata: Optional[Metadata] = None) -> str:
+        return self.add_many([data], [metadata])[0]
+
+    def add_many(
+        self, texts: List[str], metadata: Optional[List[Metadata]] = None
+    ) -> List[str]:
+        """
+        Writes memories through to the provider and puts the ones it added in
+        the hot set. Skipped, bumped and merged memories take no new id and
+        are left out.
+
+        Returns: The messages of the provider.
+        """
+        results = self.memory.write_many(texts, metadata)
+        now = time.time()
+        stored, vectors, added = [], [], []
+        for text, fields, (action, _, vector) in zip(
+            texts, metadata or [None] * len(texts), results
+        ):
+            if action == "add":
+                stored.append(text)
+                vectors.append(vector)
+                added.append(check_metadata(fields, now)["added"])
+        self.own += len(stored)
+        if stored:
+            self._remember(stored, vectors, added)
+        return [message for _, message, _ in results]
+
+    def texts_to_embed(self, texts: List[str]) -> List[str]:
+        return self.memory.texts_to_embed(texts)
+
+    def get(self, data: str) -> Optional[List[Any]]:
+        return self.get_relevant(data, 1)
+
+    def get_relevant(
+        self,
+        data: str,
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[Any]:
+        return [
+            memory
+            for memory, _ in self.get_relevant_batch(
+                [data], num_relevant, mode, where, max_tokens
+            )[0]
+        ]
+
+    def get_relevant_batch(
+        self,
+        texts: List[str],
+        num_relevant: int = 5,
+        mode: Optional[str] = None,
+        where: Optional[Metadata] = None,
+        max_tokens: Optional[int] = None,
+    ) -> List[List[Tuple[str, float]]]:
+        """
+        Answers the queries the hot set covers and sends the others to the
+        provider with one batch.
+
+        Args:
+            texts: The queries.
+            num_relevant: The number of relevant data to return per query.
+            mode: "vector", "lexical" or "hybrid", defaults to the search mode
+                of the provider.
+            where: A metadata filter, see memories.metadata.
+            max_tokens: The most tokens of the data returned per query, None
+                for no limit.
+
+        Returns: For every query, (data, score) pairs, best first. Scores of
+            the hot set are cosine similarities or, for hybrid queries, fused
+            reciprocal ranks, or decayed relevances scaled to a best of 1 when
+            re-ranked.
+        """
+        if not texts:
+            return []
+        mode = check_mode(mode or getattr(self.memory, "search_mode", "vector"))
+        if mode == "lexical" or where:
+            return self.memory.get_relevant_batch(
+                texts, num_relevant, mode, where, max_tokens
+            )
+        self._check_watermark()
+        queries = np.array(get_ada_embeddings(texts), dtype=np.float32)
+        batch = [
+            self._answer(text, query, mode, num_relevant, max_tokens)
+            for text, query in zip(texts, queries)
+        ]
+        missed = [i for i, results in enumerate(batch) if results is None]
+        self.hits += len(texts) - len(missed)
+        self.misses += len(missed)
+        if missed:
+            fetched = self.memory.search_many(
+                [texts[i] for i in missed], num_relevant, mode, where, max_tokens
+            )
+            # the results join the hot set as the provider stored them
+            retrieved = {
+                data: (vector, added)
+                for results in fetched
+                for data, _, vector, added in results
+            }
+            if retrieved:
+                vectors, added = zip(*retrieved.values())
+                self._remember(list(retrieved), vectors, added)
+            for i, results in zip(missed, fetched):
+                batch[i] = [(data, score) for data, score, _, _ in results]
+        return batch
+
+    def _answer(
+        self,
+        text: str,
+        query: np.ndarray,
+        mode: str,
+        num_relevant: int,
+        max_tokens: Optional[int],
+    ) -> Optional[List[Tuple[str, float]]]:
+        """
+        Returns: The results of a query from the hot set, None if the hot set
+            holds fewer than num_relevant memories at least min_score similar
+            to the query.
+        """
+        if len(self) < num_relevant:
+            return None
+        pool = self.reranker.pool_size(num_relevant, max_tokens)
+        depth = pool if mode == "vector" else FUSION_DEPTH * pool
+        live = self.used >= 0
+        scores = np.where(live, self.embeddings @ query, -np.inf)
+        rows, scores = top_k(scores, min(depth, len(self)))
+        if num_relevant and scores[num_relevant - 1] < self.min_score:
+            return None
+        hits = list(zip(rows.tolist(), scores.tolist()))
+        if mode == "hybrid":
+            words = self.lexical.search(text, depth)
+            hits = reciprocal_rank_fusion(
+                [[row for row, _ in hits], [row for row, _ in words]]
+            )
+        hits = hits[:pool]
+        rows = np.array([row for row, _ in hits], dtype=np.int64)
+        if pool > num_relevant:
+            token_counts = None
+            if max_tokens is not None:
+                token_counts = [count_tokens(self.texts[row]) for row, _ in hits]
+            hits = self.reranker.select(
+                hits,
+                self.embeddings[rows],
+                num_relevant,
+                added=self.added[rows],
+                token_counts=token_counts,
+                max_tokens=max_tokens,
+            )
+        self.tick += 1
+        self.used[[row for row, _ in hits]] = self.tick
+        return [(self.texts[row], score) for row, score in hits]
+
+    def clear(self) -> str:
+        message = self.memory.clear()
+        self.invalidate()
+        self.watermark = self.memory.watermark()
+        self.checked = time.monotonic()
+        self.own = 0
+        return message
+
+    def get_stats(self):
+        """
+        Returns: The stats of the provider and of the hot set.
+        """
+        stats = self.memory.get_stats()
+        stats["hot_cache"] = {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+        return stats
+
+    def close(self) -> None:
+        self.memory.close()
@@ -0,0 +1,120 @@
+"""
+Memory maintenance commands.
+
+Copy every memory from the local backend to Redis, reusing the stored embeddings:
+
+    python memory.py migrate --source local --target redis
+"""
+import copy
+import os
+
+import typer
+
+import memories
+from configs import Config
+from configs import Singleton
+from memories import get_memory
+from memories.migrate import migrate as migrate_memories
+
+app = typer.Typer()
+
+PROVIDERS = {
+    "local": "LocalCache",
+    "sqlite": "SQLiteMemory",
+    "redis": "RedisMemory",
+    "pinecone": "PineconeMemory",
+}
+
+
+def open_memory(cfg, backend: str, index: str):
+    """
+    Opens a memory backend for bulk access, without a write-behind queue or a
+    hot tier and without wiping Redis.
+
+    Args:
+        cfg: The config object.
+        backend: "local", "sqlite", "redis" or "pinecone".
+        index: The memory index, defaults to MEMORY_INDEX.
+
+    Returns: The memory provider.
+    """
+    if backend not in PROVIDERS:
+        raise typer.BadParameter(f"{backend}, expected one of {list(PROVIDERS)}")
+    memory_cfg = copy.copy(cfg)
+    memory_cfg.memory_backend = backend
+    memory_cfg.memory_index = index or cfg.memory_index
+    memory_cfg.memory_write_behind = False
+    memory_cfg.memory_hot_entries = 0
+    memory_cfg.wipe_redis_on_start = False
+    # providers are singletons, a migration between two indexes of a backend
+    # opens it twice
+    Singleton._instances.pop(getattr(memories, PROVIDERS[backend]), None)
+    memory = get_memory(memory_cfg)
+    if type(memory).__name__ != PROVIDERS[backend]:
+        # get_memory falls back to the local backend
+        raise typer.BadParameter(f"the {backend} memory backend is not available")
+    return memory
+
+
+@app.callback()
+def memory():
+    """Manage the long-term memory of the agent."""
+
+
+@app.command()
+def migrate(
+    source: str = typer.Option(
+        ..., help="Backend to read: local, sqlite, redis, pinecone"
+    ),
+    target: str = typer.Option(
+        ..., help="Backend to write: local, sqlite, redis, pinecone"
+    ),
+    source_index: str = typer.Option(None, help="Index to read, MEMORY_INDEX"),
+    target_index: str = typer.Option(None, help="Index to write, MEMORY_INDEX"),
+    batch_size: int = typer.Option(1024, help="Memories read and written at once"),
+    checkpoint: str = typer.Option(
+        "memory-migration.json", help="Progress file an interrupted run resumes from"
+    ),
+):
+    """Copy every memory with its embedding from one backend to another."""
+    cfg = Config()
+    source_name = f"{source}:{source_index or cfg.memory_index}"
+    target_name = f"{target}:{target_index or cfg.memory_index}"
+    if source_name == target_name:
+        raise typer.BadParameter(f"source and target are both {source_name}")
+    if source == target == "pinecone":
+        # PineconeMemory ignores MEMORY_INDEX
+        raise typer.BadParameter("Pinecone memories are all in one index")
+    source_memory = open_memory(cfg, source, source_index)
+    target_memory = open_memory(cfg, target, target_index)
+    if os.path.exists(checkpoint):
+        print(f"Resuming from {checkpoint}")
+
+    def report(stats):
+        print(
+            f"\r{stats.read} memories read, {stats.written} written,"
+            f" {stats.rate:.0f} items/s",
+            end="",
+            flush=True,
+        )
+
+    stats = migrate_memories(
+        source_memory,
+        target_memory,
+        checkpoint=checkpoint,
+        batch_size=batch_size,
+        names=(source_name, target_name),
+        progress=report,
+    )
+    target_memory.close()
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    print(
+        f"\nMigrated {stats.read} memories from {source} to {target}"
+        f" ({stats.written} stored after dedup) in {stats.seconds:.1f}s,"
+        f" {stats.rate:.0f} items/s"
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from memories import base
+from memories import embedding_cache
+
+
+@pytest.fixture
+def requests(monkeypatch):
+    requests = []
+
+    def create(input, model):
+        requests.append(input)
+        return {
+            "data": [
+                {"index": i, "embedding": [float(len(text)), 1.0]}
+                for i, text in reversed(list(enumerate(input)))
+            ]
+        }
+
+    # one token per character
+    encoding = SimpleNamespace(encode=list, decode="".join)
+    monkeypatch.setattr(base, "_encoding", lambda: encoding)
+    monkeypatch.setattr("openai.Embedding.create", create)
+    monkeypatch.setattr(embedding_cache, "_cache", embedding_cache.EmbeddingCache())
+    return requests
+
+
+def test_get_ada_embeddings_keeps_order(requests):
+    assert base.get_ada_embeddings(["a", "bbb", "cc"]) == [
+        [1.0, 1.0],
+        [3.0, 1.0],
+        [2.0, 1.0],
+    ]
+    assert requests == [["a", "bbb", "cc"]]
+
+
+def test_repeated_texts_are_served_from_the_cache(requests):
+    base.get_ada_embedding("same\ntext")
+    base.get_ada_embeddings(["same text", "other", "other"])
+    assert requests == [["same text"], ["other"]]
+    stats = embedding_cache.get_embedding_cache().stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 3
+
+
+def test_requests_are_split_by_token_budget(requests, monkeypatch):
+    monkeypatch.setattr(base, "MAX_REQUEST_TOKENS", 5)
+    monkeypatch.setattr(base, "MAX_REQUEST_INPUTS", 3)
+    monkeypatch.setattr(base, "MAX_INPUT_TOKENS", 4)
+    texts = ["aa", "bb", "c", "d", "e", "f", "gggggg"]
+    embeddings = base.get_ada_embeddings(texts)
+    assert requests == [["aa", "bb", "c"], ["d", "e", "f"], ["gggg"]]
+    # the truncated text is cached under its full text
+    assert embeddings[-1] == [4.0, 1.0]
+    assert base.get_ada_embedding("gggggg") == [4.0, 1.0]
+    assert len(requests) == 3
+
+
+def test_concurrent_single_calls_share_a_request(requests, monkeypatch):
+    coalescer = base.Coalescer(base._request_embeddings, window=0.05)
+    monkeypatch.setattr(base, "_coalescer", coalescer)
+    with ThreadPoolExecutor(8) as pool:
+        texts = [("x" * n) for n in range(1, 9)]
+        embeddings = list(pool.map(base.get_ada_embedding, texts))
+    assert embeddings == [[float(n), 1.0] for n in range(1, 9)]
+    assert coalescer.batches < 8
+    assert sorted(sum(requests, [])) == sorted(texts)
@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from memories.coalesce import Coalescer
+
+
+def test_single_call_is_a_batch_of_one():
+    calls = []
+
+    def double(items):
+        calls.append(items)
+        return [item * 2 for item in items]
+
+    coalescer = Coalescer(double, window=0)
+    assert coalescer.submit(21) == 42
+    assert calls == [[21]]
+
+
+def test_concurrent_calls_are_merged():
+    calls = []
+
+    def double(items):
+        calls.append(items)
+        return [item * 2 for item in items]
+
+    coalescer = Coalescer(double, window=0.05, max_batch=4)
+    results = {}
+
+    def call(i):
+        results[i] = coalescer.submit(i)
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {i: i * 2 for i in range(10)}
+    assert all(len(items) <= 4 for items in calls)
+    assert coalescer.batches == len(calls) < 10
+
+
+def test_errors_reach_every_caller_of_the_batch():
+    def fail(items):
+        raise RuntimeError("rate limited")
+
+    coalescer = Coalescer(fail, window=0)
+    with pytest.raises(RuntimeError, match="rate limited"):
+        coalescer.submit("text")
+    # the leader handed over, the next call does not hang
+    with pytest.raises(RuntimeError):
+        coalescer.submit("text")
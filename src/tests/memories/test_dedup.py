@@ -0,0 +1,69 @@
+import pytest
+
+from memories.dedup import Deduplicator
+from memories.dedup import DuplicateIndex
+from memories.dedup import DuplicateRecords
+from memories.dedup import fingerprint
+from memories.dedup import hamming
+from memories.dedup import new_records
+from memories.dedup import simhash
+
+RESULT = (
+    'Command google returned: [{"title": "Python docs", "href":'
+    ' "https://docs.python.org", "body": "Documentation for Python 3.11"},'
+    ' {"title": "Python tutorial", "href": "https://docs.python.org/3/tutorial",'
+    ' "body": "An informal introduction to Python"}, {"title": "Python downloads",'
+    ' "href": "https://www.python.org/downloads", "body": "Download the latest'
+    ' version for Windows"}]'
+)
+
+
+def test_simhash_is_close_for_small_edits():
+    assert simhash(RESULT) == simhash(RESULT.replace("\n", " "))
+    assert hamming(simhash(RESULT), simhash(RESULT.replace("3.11", "3.12"))) <= 3
+    assert hamming(simhash(RESULT), simhash("Command read_file returned: ok")) > 3
+    assert simhash("...") == 0
+
+
+def test_index_finds_exact_and_near_duplicates():
+    index = DuplicateIndex(max_distance=3)
+    index.add(0, *fingerprint(RESULT))
+    index.add(1, *fingerprint("Command read_file returned: hello world"))
+    assert index.find(*fingerprint(RESULT)) == (0, True)
+    assert index.find(*fingerprint(RESULT.replace("3.11", "3.12"))) == (0, False)
+    assert index.find(*fingerprint("something new")) == (None, False)
+
+    index.remove(0)
+    assert index.find(*fingerprint(RESULT)) == (None, False)
+    assert len(index) == 1
+
+
+def test_deduplicator_policies():
+    near = RESULT.replace("3.11", "3.12")
+    for policy, expected in (("skip", "skip"), ("bump", "bump"), ("merge", "merge")):
+        duplicates = Deduplicator(policy)
+        duplicates.remember(7, fingerprint(RESULT))
+        assert duplicates.decide(fingerprint(near)) == (expected, 7)
+        assert duplicates.needs_embedding(near) == (policy == "merge")
+    # an exact repeat has nothing to merge
+    assert Deduplicator("merge").decide(fingerprint(RESULT)) == ("add", None)
+    merge = Deduplicator("merge")
+    merge.remember(7, fingerprint(RESULT))
+    assert merge.decide(fingerprint(RESULT)) == ("bump", 7)
+    assert Deduplicator("off").decide(fingerprint(RESULT)) == ("add", None)
+    with pytest.raises(ValueError):
+        Deduplicator("drop")
+
+
+def test_records_are_rewritten_in_place(tmp_path):
+    filename = str(tmp_path / "dedup.bin")
+    records = DuplicateRecords(filename)
+    records.write(0, new_records([fingerprint(f"text {i}") for i in range(5)]))
+    records.bump(3)
+    records.write(5, new_records([fingerprint("text 5")]))
+
+    reopened = DuplicateRecords(filename)
+    assert reopened.records["count"].tolist() == [1, 1, 1, 2, 1, 1]
+    assert reopened.records["exact"][5] == fingerprint("text 5")[0]
+    reopened.truncate(4)
+    assert len(DuplicateRecords(filename)) == 4
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from configs import Singleton
+from memories import base
+from memories.embedders import HashingEmbeddings
+from memories.local import LocalCache
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    monkeypatch.setattr(base, "_provider", base.OpenAIEmbeddings())
+
+    def no_requests(**kwargs):
+        raise AssertionError("local embeddings are not requested")
+
+    monkeypatch.setattr("openai.Embedding.create", no_requests)
+
+
+def test_hashing_embeddings():
+    embeddings = HashingEmbeddings(256)
+    vectors = embeddings.embed(
+        ["read the file main.py", "Read the file MAIN.py", "browse a website", ""]
+    )
+    assert vectors.shape == (4, 256) and vectors.dtype == np.float32
+    assert np.allclose(vectors[0], vectors[1])
+    assert vectors[0] @ vectors[0] == pytest.approx(1.0)
+    assert vectors[0] @ vectors[2] < 0.5
+    assert not vectors[3].any()
+    # no salted hash(), the same texts get the same embeddings in every process
+    assert np.array_equal(
+        HashingEmbeddings(256).embed(["browse a website"])[0], vectors[2]
+    )
+
+
+def test_configure_embedding_provider(provider):
+    cfg = SimpleNamespace(embedding_provider="hashing", embedding_dimension=0)
+    assert base.configure_embedding_provider(cfg).dimension == 1024
+    cfg.embedding_dimension = 64
+    hashing = base.configure_embedding_provider(cfg)
+    assert base.get_embedding_provider() is hashing
+    assert np.array(base.get_ada_embeddings(["a b", "c"])).shape == (2, 64)
+    assert len(base.get_ada_embedding("a b")) == 64
+
+    cfg.embedding_provider = "openai"
+    with pytest.raises(ValueError):
+        base.configure_embedding_provider(cfg)
+    cfg.embedding_dimension = 0
+    assert base.configure_embedding_provider(cfg).dimension == 1536
+    cfg.embedding_provider = "word2vec"
+    with pytest.raises(ValueError):
+        base.configure_embedding_provider(cfg)
+
+
+def test_local_cache_with_hashing_embeddings(provider, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfg = SimpleNamespace(
+        embedding_provider="hashing",
+        embedding_dimension=64,
+        memory_index="test-index",
+        memory_ann_index="none",
+        memory_dedup="off",
+        memory_dedup_distance=3,
+        memory_max_entries=0,
+        memory_eviction="lru",
+        memory_importance_half_life=24,
+        memory_search_mode="vector",
+        memory_mmr_lambda=1.0,
+        memory_recency_half_life=0,
+        memory_search_workers=0,
+        memory_shard_min_rows=100000,
+    )
+    base.configure_embedding_provider(cfg)
+    Singleton._instances.pop(LocalCache, None)
+    cache = LocalCache(cfg)
+    cache.add_many(["opened src/main.py", "searched for cats", "wrote notes.txt"])
+    assert cache.data.embeddings.shape == (3, 64)
+    assert cache.get_relevant("cats", 1) == ["searched for cats"]
+    cache.log.compact(seal_active=True)
+    cache.close()
+
+    # the stored embeddings do not fit another dimension
+    cfg.embedding_dimension = 32
+    base.configure_embedding_provider(cfg)
+    Singleton._instances.pop(LocalCache, None)
+    with pytest.raises(ValueError):
+        LocalCache(cfg)
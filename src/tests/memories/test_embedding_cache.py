@@ -0,0 +1,48 @@
+import numpy as np
+
+from memories.embedding_cache import cache_key
+from memories.embedding_cache import EmbeddingCache
+
+
+def vector(i):
+    return np.full(4, i, dtype=np.float32)
+
+
+def test_key_depends_on_model_and_normalized_text():
+    assert cache_key("ada", "a\nb") == cache_key("ada", "a b")
+    assert cache_key("ada", "a b") != cache_key("other", "a b")
+
+
+def test_memory_tier_is_lru():
+    cache = EmbeddingCache(max_entries=2)
+    cache.put_many({b"a": vector(1), b"b": vector(2)})
+    cache.get_many([b"a"])
+    cache.put_many({b"c": vector(3)})
+    assert set(cache.get_many([b"a", b"b", b"c"])) == {b"a", b"c"}
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_tier_survives_restarts(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = EmbeddingCache(path)
+    cache.put_many({b"a": vector(1)})
+    cache.close()
+
+    cache = EmbeddingCache(path)
+    found = cache.get_many([b"a", b"b"])
+    assert np.array_equal(found[b"a"], vector(1))
+    assert cache.stats()["disk_hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_entries=1)
+    cache.max_disk_bytes = 10 * 16
+    for i in range(10):
+        cache.put_many({bytes([i]): vector(i)})
+    cache.get_many([bytes([0])])
+    cache.put_many({b"new": vector(10)})
+    assert cache.disk_bytes <= cache.max_disk_bytes
+    assert bytes([0]) in cache.get_many([bytes([0])])
+    assert bytes([1]) not in cache.get_many([bytes([1])])
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from memories.eviction import Evictor
+from memories.eviction import USAGE
+
+
+def test_fifo_evicts_the_oldest():
+    evictor = Evictor(3, "fifo")
+    for memory_id in range(3):
+        evictor.track(memory_id, added=memory_id)
+    evictor.touch([0], now=10)
+    assert evictor.victim() == 0
+    assert evictor.victim() is None
+    evictor.track(3, added=11)
+    assert evictor.victim() == 1
+
+
+def test_lru_evicts_the_least_recently_retrieved():
+    evictor = Evictor(3, "lru")
+    for memory_id in range(3):
+        evictor.track(memory_id, added=memory_id)
+    evictor.touch([0, 1], now=10)
+    evictor.touch([0], now=11)
+    assert evictor.victim() == 2
+    evictor.track(3, added=12)
+    assert evictor.victim() == 1
+    assert evictor.evictions == 2
+
+
+def test_importance_weighs_retrievals_against_age():
+    hour = 3600.0
+    evictor = Evictor(4, "importance", half_life=hour)
+    for memory_id in range(4):
+        evictor.track(memory_id, added=0)
+    evictor.touch([0] * 7, now=0.5 * hour)
+    evictor.touch([1], now=3 * hour)
+    evictor.touch([2], now=2 * hour)
+    evictor.touch([3] * 3, now=1 * hour)
+    # at 3 hours: 8 * 2 ** -2.5 = 1.41, 2 * 2 ** 0 = 2, 2 * 2 ** -1 = 1 and
+    # 4 * 2 ** -2 = 1
+    evictor.capacity = 0
+    assert [evictor.victim() for _ in range(4)] == [2, 3, 0, 1]
+
+
+def test_track_many_restores_usage():
+    usage = np.zeros(3, dtype=USAGE)
+    usage["added"] = [1, 2, 3]
+    usage["last_used"] = [9, 2, 3]
+    usage["retrievals"] = [1, 0, 0]
+    evictor = Evictor(3, "lru")
+    evictor.track_many([10, 11, 12], usage)
+    assert evictor.usage(10) == (1, 9, 1)
+    assert evictor.victim() == 11
+
+
+def test_heap_stays_bounded_under_retrievals():
+    evictor = Evictor(100, "lru")
+    for memory_id in range(100):
+        evictor.track(memory_id, added=memory_id)
+    for now in range(1000):
+        evictor.touch([now % 50], now=100 + now)
+    assert len(evictor._heap) <= 2 * len(evictor) + 64
+    assert evictor.victim() == 50
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Evictor(3, "random")
@@ -0,0 +1,244 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from memories import ingest
+from memories.ingest import WriteBehindMemory
+from memories.rerank import Reranker
+
+
+# set while the worker may embed, cleared to hold texts in the queue
+embedding_allowed = threading.Event()
+
+
+def fake_embeddings(texts):
+    if threading.current_thread().name == "memory-ingest":
+        embedding_allowed.wait()
+    # one axis per first letter, so "a..." texts match the query "a"
+    vectors = np.zeros((len(texts), 26), dtype=np.float32)
+    for row, text in enumerate(texts):
+        vectors[row, ord(text[0]) - ord("a")] = 1.0
+    return vectors.tolist()
+
+
+class ListMemory:
+    def __init__(self):
+        self.texts = []
+        self.metadata = []
+        self.batches = []
+
+    def texts_to_embed(self, texts):
+        # stored texts are bumped, not embedded again
+        return [text for text in texts if text not in self.texts]
+
+    def add_many(self, texts, metadata=None):
+        self.batches.append(list(texts))
+        self.texts.extend(texts)
+        self.metadata.extend(metadata or [{}] * len(texts))
+        return texts
+
+    def get_relevant_batch(
+        self, texts, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
+        queries = np.array(fake_embeddings(texts))
+        batch = []
+        for query in queries:
+            scored = [
+                (text, float(np.dot(query, vector)))
+                for text, vector in zip(self.texts, fake_embeddings(self.texts))
+            ]
+            scored.sort(key=lambda x: -x[1])
+            batch.append(scored[:num_relevant])
+        return batch
+
+    def clear(self):
+        self.texts = []
+        return "Obliviated"
+
+    def get_stats(self):
+        return len(self.texts)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def memory(monkeypatch):
+    monkeypatch.setattr(ingest, "get_ada_embeddings", fake_embeddings)
+    embedding_allowed.set()
+    memory = WriteBehindMemory(ListMemory(), batch_size=3)
+    yield memory
+    embedding_allowed.set()
+    memory.close()
+
+
+def test_flush_stores_queued_texts_in_batches(memory):
+    embedding_allowed.clear()
+    texts = [f"{letter} memory" for letter in "abcdefg"]
+    for text in texts:
+        memory.add(text)
+    embedding_allowed.set()
+    memory.flush()
+    assert memory.memory.texts == texts
+    assert all(len(batch) <= 3 for batch in memory.memory.batches)
+    assert len(memory.memory.batches) < len(texts)
+
+
+def test_pending_texts_are_visible_to_queries(memory):
+    memory.add("apple")
+    memory.flush()
+    embedding_allowed.clear()
+    memory.add("avocado")
+    memory.add("banana")
+    assert memory.memory.texts == ["apple"]
+    results = memory.get_relevant_batch(["a", "b"], 2)
+    assert sorted(text for text, _ in results[0]) == ["apple", "avocado"]
+    assert results[1][0] == ("banana", 1.0)
+    embedding_allowed.set()
+    memory.flush()
+    assert memory.memory.texts == ["apple", "avocado", "banana"]
+
+
+def test_close_stores_pending_texts_and_rejects_adds(memory):
+    memory.add("cherry")
+    memory.add("Command Error: nothing")
+    memory.close()
+    assert memory.memory.texts == ["cherry"]
+    with pytest.raises(RuntimeError):
+        memory.add("date")
+
+
+class FlakyMemory(ListMemory):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+        self.attempts = 0
+
+    def add_many(self, texts, metadata=None):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("rate limited")
+        return super().add_many(texts, metadata)
+
+
+@pytest.fixture
+def flaky(monkeypatch):
+    monkeypatch.setattr(ingest, "get_ada_embeddings", fake_embeddings)
+    monkeypatch.setattr(ingest, "RETRY_SECONDS", 0.01)
+    embedding_allowed.set()
+    memories = []
+
+    def flaky(failures):
+        memories.append(WriteBehindMemory(FlakyMemory(failures), batch_size=3))
+        return memories[-1]
+
+    yield flaky
+    for memory in memories:
+        memory.close()
+
+
+def test_failed_batches_are_retried_in_order(flaky):
+    memory = flaky(ingest.MAX_ATTEMPTS - 1)
+    for text in ["apple", "banana", "cherry", "date"]:
+        memory.add(text)
+    memory.flush()
+    assert memory.memory.texts == ["apple", "banana", "cherry", "date"]
+    assert memory.failed == 0
+
+
+def test_batches_are_dropped_after_repeated_failures(flaky):
+    memory = flaky(ingest.MAX_ATTEMPTS)
+    memory.add("apple")
+    memory.flush()
+    assert memory.memory.attempts == ingest.MAX_ATTEMPTS
+    assert memory.failed == 1
+    memory.add("banana")
+    memory.flush()
+    assert memory.memory.texts == ["banana"]
+
+
+def test_close_drops_a_failing_batch(flaky, monkeypatch):
+    monkeypatch.setattr(ingest, "RETRY_SECONDS", 60.0)
+    memory = flaky(ingest.MAX_ATTEMPTS)
+    memory.add("apple")
+    while memory.memory.attempts == 0:
+        time.sleep(0.01)
+    started = time.monotonic()
+    memory.close()
+    assert time.monotonic() - started < 10
+    assert memory.memory.attempts == 2
+    assert memory.failed == 1
+
+
+def test_clear_drops_queued_texts(memory):
+    memory.add("elderberry")
+    memory.flush()
+    embedding_allowed.clear()
+    memory.add("fig")
+    memory.add("grape")
+    memory.add("honeydew")
+    memory.add("kiwi")
+    embedding_allowed.set()
+    assert memory.clear() == "Obliviated"
+    assert memory.get_relevant("kiwi", 5) == []
+
+
+def test_pending_texts_are_ranked_lexically(memory):
+    embedding_allowed.clear()
+    memory.add("apple pie recipe")
+    memory.add("apple juice")
+    results = memory.get_relevant_batch(["pie"], 2, mode="lexical")
+    assert [text for text, _ in results[0]] == ["apple pie recipe"]
+    embedding_allowed.set()
+
+
+def test_pending_texts_are_filtered_by_metadata(memory):
+    embedding_allowed.clear()
+    memory.add("apple", {"command": "google"})
+    memory.add("avocado", {"command": "browse_website"})
+    results = memory.get_relevant_batch(["a"], 2, where={"command": "browse_website"})
+    assert [text for text, _ in results[0]] == ["avocado"]
+    embedding_allowed.set()
+    memory.flush()
+    assert [fields["command"] for fields in memory.memory.metadata] == [
+        "google",
+        "browse_website",
+    ]
+    assert all("added" in fields for fields in memory.memory.metadata)
+
+
+def test_pending_texts_are_not_returned_twice(memory):
+    memory.add("apple")
+    memory.flush()
+    embedding_allowed.clear()
+    memory.add("apple")
+    memory.add("avocado")
+    memory.add("avocado")
+    results = memory.get_relevant_batch(["a"], 5)
+    assert sorted(text for text, _ in results[0]) == ["apple", "avocado"]
+    embedding_allowed.set()
+
+
+def test_pending_texts_are_reranked_with_the_results(memory, monkeypatch):
+    # one token per word
+    encoding = SimpleNamespace(encode=str.split)
+    monkeypatch.setattr("memories.base._encoding", lambda: encoding)
+    memory.memory.reranker = Reranker(0.4, 0)
+    memory.add("apple")
+    memory.flush()
+    embedding_allowed.clear()
+    memory.add("avocado")
+    memory.add("banana")
+    # "avocado" is as relevant as "apple" but embedded the same, MMR picks
+    # "banana" second
+    results = memory.get_relevant_batch(["a"], 2)
+    assert [text for text, _ in results[0]][1] == "banana"
+    assert [score for _, score in results[0]] == [1.0, 0.0]
+    results = memory.get_relevant_batch(["banana"], 2, "lexical", max_tokens=2)
+    assert sorted(text for text, _ in results[0]) == ["apple", "banana"]
+    results = memory.get_relevant_batch(["banana"], 2, "lexical", max_tokens=1)
+    assert [score for _, score in results[0]] == [1.0]
+    embedding_allowed.set()
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from memories.ivf import IVFIndex
+from memories.local import EmbeddingMatrix
+from memories.search import top_k
+
+DIM = 32
+
+
+def clustered(rng, n, centers=20):
+    means = rng.standard_normal((centers, DIM))
+    vectors = means[rng.integers(centers, size=n)] + 0.3 * rng.standard_normal((n, DIM))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors.astype(np.float32)
+
+
+@pytest.fixture
+def matrix():
+    matrix = EmbeddingMatrix(DIM)
+    matrix.append(clustered(np.random.default_rng(0), 5000))
+    return matrix
+
+
+def recall(index, matrix, queries, k, nprobe):
+    found, _ = index.search(matrix, queries, k, nprobe=nprobe)
+    exact, _ = top_k(queries @ matrix.array.T, k)
+    hits = sum(len(set(f) & set(e)) for f, e in zip(found, exact))
+    return hits / exact.size
+
+
+def test_probing_every_list_is_exact(tmp_path, matrix):
+    index = IVFIndex(str(tmp_path), DIM, nlist=16)
+    index.train(matrix)
+    queries = clustered(np.random.default_rng(1), 20)
+    assert recall(index, matrix, queries, 10, nprobe=16) == 1.0
+    assert recall(index, matrix, queries, 10, nprobe=4) > 0.8
+
+
+def test_incremental_add_and_reload(tmp_path, matrix):
+    index = IVFIndex(str(tmp_path), DIM, nlist=16, nprobe=16)
+    index.train(matrix)
+    extra = clustered(np.random.default_rng(2), 10)
+    start = matrix.append(extra)
+    index.add(start, extra)
+    index.add(start, extra)  # replayed rows are ignored
+    assert index.size == 5010
+    index.close()
+
+    reopened = IVFIndex(str(tmp_path), DIM, nprobe=16)
+    assert reopened.is_trained
+    assert reopened.size == 5010
+    indices, scores = reopened.search(matrix, extra, 1)
+    assert indices[:, 0].tolist() == list(range(5000, 5010))
+
+
+def test_clear(tmp_path, matrix):
+    index = IVFIndex(str(tmp_path), DIM, nlist=8)
+    index.train(matrix)
+    index.clear()
+    assert not index.is_trained
+    assert not IVFIndex(str(tmp_path), DIM).is_trained
+
+
+def test_update_moves_replaced_rows(tmp_path, matrix):
+    index = IVFIndex(str(tmp_path), DIM, nlist=16, nprobe=1)
+    index.train(matrix)
+    replacement = -matrix.array[7].copy()
+    matrix[7] = replacement
+    index.update([7], replacement[None])
+    assert index.search(matrix, replacement[None], 1)[0][0, 0] == 7
+    index.close()
+
+    reopened = IVFIndex(str(tmp_path), DIM, nprobe=1)
+    assert reopened.search(matrix, replacement[None], 1)[0][0, 0] == 7
@@ -0,0 +1,66 @@
+import pytest
+
+from memories.lexical import BM25Index
+from memories.lexical import check_mode
+from memories.lexical import reciprocal_rank_fusion
+from memories.lexical import tokenize
+
+
+def test_tokenize_keeps_identifiers_whole():
+    assert tokenize('Read "src/main.py", then ERR_42.') == [
+        "read",
+        "src",
+        "main",
+        "py",
+        "src/main.py",
+        "then",
+        "err_42",
+    ]
+
+
+def test_rare_terms_rank_first():
+    index = BM25Index()
+    index.add_many(
+        enumerate(
+            [
+                "the agent wrote the file",
+                "the agent read the file",
+                "the agent opened src/main.py and read the file",
+                "the agent browsed the web",
+            ]
+        )
+    )
+    results = index.search("main.py", 3)
+    assert [memory_id for memory_id, _ in results] == [2]
+    assert [memory_id for memory_id, _ in index.search("read file", 4)][:2] == [1, 2]
+
+
+def test_shorter_memories_win_ties():
+    index = BM25Index()
+    index.add(0, "error code E1234 " + "padding " * 20)
+    index.add(1, "error code E1234")
+    assert [memory_id for memory_id, _ in index.search("E1234", 2)] == [1, 0]
+
+
+def test_add_replaces_and_remove_forgets():
+    index = BM25Index()
+    index.add(0, "apple banana")
+    index.add(1, "banana cherry")
+    index.add(0, "date")
+    assert [memory_id for memory_id, _ in index.search("banana", 5)] == [1]
+    assert index.search("apple", 5) == []
+    index.remove(1)
+    assert index.search("banana", 5) == []
+    assert len(index) == 1
+    assert index._postings.keys() == {"date"}
+
+
+def test_reciprocal_rank_fusion_favours_agreement():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "b", "d"]])
+    assert [item for item, _ in fused] == ["c", "b", "a", "d"]
+    assert fused[1][1] == pytest.approx(2 / 62)
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        check_mode("fuzzy")
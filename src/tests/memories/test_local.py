@@ -0,0 +1,400 @@
+import os
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import orjson
+import pytest
+
+from configs import Singleton
+from memories import base
+from memories import local
+from memories.embedders import HashingEmbeddings
+from memories.local import EmbeddingMatrix
+from memories.local import LocalCache
+
+
+def fake_embedding(text):
+    rng = np.random.default_rng(zlib.crc32(text.encode()))
+    dimension = base.get_embedding_provider().dimension
+    vector = rng.standard_normal(dimension).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        local, "get_ada_embeddings", lambda texts: [fake_embedding(t) for t in texts]
+    )
+    return SimpleNamespace(
+        memory_index="test-index",
+        memory_ann_index="none",
+        memory_ann_nlist=0,
+        memory_ann_nprobe=16,
+        memory_ann_min_rows=20000,
+        memory_dedup="off",
+        memory_dedup_distance=3,
+        memory_max_entries=0,
+        memory_eviction="lru",
+        memory_importance_half_life=24,
+        memory_search_mode="vector",
+        memory_mmr_lambda=1.0,
+        memory_recency_half_life=0,
+        memory_search_workers=0,
+        memory_shard_min_rows=100000,
+    )
+
+
+def open_cache(cfg):
+    Singleton._instances.pop(LocalCache, None)
+    return LocalCache(cfg)
+
+
+def test_add_persists_across_restarts(cfg):
+    cache = open_cache(cfg)
+    for i in range(5):
+        cache.add(f"memory {i}")
+    cache.close()
+
+    cache = open_cache(cfg)
+    assert list(cache.data.texts) == [f"memory {i}" for i in range(5)]
+    assert cache.get_relevant("memory 3", 1) == ["memory 3"]
+
+
+def test_add_skips_command_errors(cfg):
+    cache = open_cache(cfg)
+    assert cache.add("Command Error: boom") == ""
+    assert cache.get_stats()[0] == 0
+
+
+def test_json_file_is_converted(cfg):
+    texts = ["first", "second", "third"]
+    # the JSON format stored the newest embedding first
+    embeddings = np.stack([fake_embedding(t) for t in reversed(texts)])
+    with open("test-index.json", "wb") as f:
+        f.write(
+            orjson.dumps(
+                {"texts": texts, "embeddings": embeddings},
+                option=orjson.OPT_SERIALIZE_NUMPY,
+            )
+        )
+
+    cache = open_cache(cfg)
+    assert not os.path.exists("test-index.json")
+    assert os.path.exists("test-index.json.bak")
+    assert list(cache.data.texts) == texts
+    for text in texts:
+        assert cache.get_relevant(text, 1) == [text]
+
+
+def test_embedding_matrix_grows_by_doubling():
+    matrix = EmbeddingMatrix(4, capacity=2)
+    for i in range(5):
+        assert matrix.append(np.full(4, i)) == i
+    assert matrix.size == 5
+    assert matrix.capacity == 8
+    assert np.array_equal(matrix.array[:, 0], np.arange(5))
+
+    matrix.append(np.ones((20, 4)))
+    assert matrix.shape == (25, 4)
+    assert matrix.capacity == 25
+
+
+def test_rows_stay_aligned_with_texts_at_100k_rows(cfg, monkeypatch):
+    # a provider of small embeddings, fake_embedding still embeds the texts
+    monkeypatch.setattr(base, "_provider", HashingEmbeddings(16))
+    cache = open_cache(cfg)
+    texts = [f"memory {i}" for i in range(100_000)]
+    cache.add_many(texts[:50_000])
+    for text in texts[50_000:50_100]:
+        cache.add(text)
+    cache.add_many(texts[50_100:])
+
+    expected = np.stack([fake_embedding(text) for text in texts])
+    assert list(cache.data.texts) == texts
+    assert np.array_equal(cache.data.embeddings.array, expected)
+    for i in (0, 49_999, 50_050, 99_999):
+        assert cache.get_relevant(texts[i], 1) == [texts[i]]
+    cache.close()
+
+    reloaded = open_cache(cfg)
+    assert list(reloaded.data.texts) == texts
+    assert np.array_equal(reloaded.data.embeddings.array, expected)
+
+
+def test_reopen_maps_the_snapshot(cfg):
+    cache = open_cache(cfg)
+    cache.add_many([f"memory {i}" for i in range(10)])
+    cache.log.compact(seal_active=True)
+    cache.close()
+
+    cache = open_cache(cfg)
+    assert isinstance(cache.data.embeddings.base, np.memmap)
+    cache.add("memory 10")
+    assert cache.get_stats()[:2] == (11, (11, local.EMBED_DIM))
+    assert cache.get_relevant("memory 4", 1) == ["memory 4"]
+    assert cache.get_relevant("memory 10", 1) == ["memory 10"]
+
+
+def test_get_relevant_batch_returns_scores(cfg):
+    cache = open_cache(cfg)
+    cache.add_many([f"memory {i}" for i in range(50)])
+
+    batch = cache.get_relevant_batch(["memory 7", "memory 42"], 3)
+    assert [results[0][0] for results in batch] == ["memory 7", "memory 42"]
+    for results in batch:
+        scores = [score for _, score in results]
+        assert len(results) == 3
+        assert scores == sorted(scores, reverse=True)
+        assert scores[0] == pytest.approx(1.0, abs=1e-5)
+    assert cache.get_relevant_batch([], 3) == []
+
+
+def test_ivf_index_is_trained_and_used(cfg, monkeypatch):
+    # a provider of small embeddings, fake_embedding still embeds the texts
+    monkeypatch.setattr(base, "_provider", HashingEmbeddings(16))
+    cfg.memory_ann_index = "ivf"
+    cfg.memory_ann_min_rows = 500
+    cfg.memory_ann_nprobe = 1000
+    cache = open_cache(cfg)
+    cache.add_many([f"memory {i}" for i in range(600)])
+    cache.close()
+    assert cache.index.is_trained
+    cache.add("memory 600")
+    assert cache.index.size == 601
+    assert cache.get_relevant("memory 600", 1) == ["memory 600"]
+    cache.close()
+
+    cache = open_cache(cfg)
+    assert cache.index.is_trained
+    assert cache.get_relevant("memory 17", 1) == ["memory 17"]
+
+
+def test_clear_truncates_log(cfg):
+    cache = open_cache(cfg)
+    cache.add("forget me")
+    cache.clear()
+    cache.close()
+    assert len(open_cache(cfg).data.texts) == 0
+
+
+def test_exact_repeats_are_bumped(cfg, monkeypatch):
+    cfg.memory_dedup = "bump"
+    embedded = []
+
+    def embeddings(texts):
+        embedded.extend(texts)
+        return [fake_embedding(text) for text in texts]
+
+    monkeypatch.setattr(local, "get_ada_embeddings", embeddings)
+    cache = open_cache(cfg)
+    cache.add_many(["searched for cats", "read file notes.txt", "searched for cats"])
+    assert cache.add("read file notes.txt") == ""
+    assert cache.texts_to_embed(["searched for cats", "new"]) == ["new"]
+    assert list(cache.data.texts) == ["searched for cats", "read file notes.txt"]
+    assert embedded == ["searched for cats", "read file notes.txt"]
+    assert cache.seen.records["count"].tolist() == [2, 2]
+    cache.close()
+
+    cache = open_cache(cfg)
+    assert cache.add("searched for cats") == ""
+    assert cache.seen.records["count"].tolist() == [3, 2]
+
+
+def test_near_duplicates_are_merged(cfg):
+    cfg.memory_dedup = "merge"
+    cache = open_cache(cfg)
+    first = " ".join(
+        f"line {i} of the google results for autonomous agents" for i in range(20)
+    )
+    second = first + " updated"
+    cache.add_many(["unrelated memory", first])
+    assert cache.add(second) == second
+    assert list(cache.data.texts) == ["unrelated memory", second]
+    assert cache.get_relevant(second, 1) == [second]
+    assert cache.seen.records["count"].tolist() == [1, 2]
+    cache.close()
+
+    cache = open_cache(cfg)
+    assert list(cache.data.texts) == ["unrelated memory", second]
+    assert np.allclose(cache.data.embeddings.take([1])[0], fake_embedding(second))
+
+
+def test_skip_policy_drops_near_duplicates(cfg):
+    cfg.memory_dedup = "skip"
+    cache = open_cache(cfg)
+    first = " ".join(f"step {i} browse website and summarize" for i in range(30))
+    cache.add(first)
+    assert cache.add(first + " again") == ""
+    assert cache.add("something else entirely") == "something else entirely"
+    assert cache.get_stats()[0] == 2
+
+
+def test_bounded_memory_reuses_evicted_rows(cfg):
+    cfg.memory_max_entries = 3
+    cfg.memory_eviction = "lru"
+    cache = open_cache(cfg)
+    cache.add_many(["memory 0", "memory 1", "memory 2"])
+    assert cache.get_relevant("memory 0", 1) == ["memory 0"]
+    cache.add("memory 3")
+    assert list(cache.data.texts) == ["memory 0", "memory 3", "memory 2"]
+    cache.add_many(["memory 4", "memory 5"])
+    assert list(cache.data.texts) == ["memory 5", "memory 3", "memory 4"]
+    assert cache.evictor.evictions == 3
+    cache.close()
+
+    cache = open_cache(cfg)
+    assert list(cache.data.texts) == ["memory 5", "memory 3", "memory 4"]
+    assert cache.get_relevant("memory 3", 1) == ["memory 3"]
+    cache.add("memory 6")
+    assert list(cache.data.texts) == ["memory 5", "memory 3", "memory 6"]
+    assert cache.get_stats()[0] == 3
+
+
+def test_lowering_the_capacity_releases_rows(cfg):
+    cfg.memory_max_entries = 5
+    cfg.memory_eviction = "fifo"
+    cache = open_cache(cfg)
+    cache.add_many([f"memory {i}" for i in range(5)])
+    cache.close()
+
+    cfg.memory_max_entries = 2
+    cache = open_cache(cfg)
+    assert [text for text in cache.data.texts if text] == ["memory 3", "memory 4"]
+    assert sorted(cache.get_relevant("memory 0", 5)) == ["memory 3", "memory 4"]
+    cache.add("memory 5")
+    assert len(cache.data.texts) == 5
+    assert sorted(text for text in cache.data.texts if text) == [
+        "memory 4",
+        "memory 5",
+    ]
+
+
+def test_lexical_search_does_not_embed_the_query(cfg, monkeypatch):
+    cache = open_cache(cfg)
+    cache.add_many(["opened src/main.py", "wrote notes.txt", "error ENOENT: no file"])
+
+    def no_embeddings(texts):
+        raise AssertionError("lexical queries are not embedded")
+
+    monkeypatch.setattr(local, "get_ada_embeddings", no_embeddings)
+    assert cache.get_relevant("ENOENT", 2, mode="lexical") == ["error ENOENT: no file"]
+    assert cache.get_relevant("main.py", 1, mode="lexical") == ["opened src/main.py"]
+
+
+def test_hybrid_search_finds_identifiers(cfg):
+    cfg.memory_search_mode = "hybrid"
+    cache = open_cache(cfg)
+    texts = [f"memory {i}" for i in range(20)] + ["the build failed with E1234"]
+    cache.add_many(texts)
+    results = cache.get_relevant_batch(["which code was E1234?", "memory 3"], 2)
+    # the vector ranking of the fake embeddings is random
+    assert "the build failed with E1234" in [text for text, _ in results[0]]
+    # both rankings agree on exact matches
+    assert results[1][0][0] == "memory 3"
+
+
+def test_lexical_index_follows_replaced_rows(cfg):
+    cfg.memory_max_entries = 2
+    cfg.memory_eviction = "fifo"
+    cache = open_cache(cfg)
+    cache.add_many(["alpha one", "beta two"])
+    assert cache.get_relevant("alpha", 2, mode="lexical") == ["alpha one"]
+    cache.add("gamma three")
+    assert cache.get_relevant("alpha", 2, mode="lexical") == []
+    assert cache.get_relevant("gamma", 2, mode="lexical") == ["gamma three"]
+    cache.clear()
+    assert cache.get_relevant("gamma", 2, mode="lexical") == []
+
+
+def test_sharded_search(cfg):
+    cfg.memory_search_workers = 2
+    cfg.memory_shard_min_rows = 8
+    cache = open_cache(cfg)
+    cache.add_many([f"memory {i}" for i in range(6)])
+    assert cache.get_relevant("memory 4", 1) == ["memory 4"]
+    assert cache.shards is None
+    cache.add_many([f"memory {i}" for i in range(6, 12)])
+    assert cache.get_relevant("memory 4", 1) == ["memory 4"]
+    assert cache.shards.size == 12
+    cache.add("memory 12")
+    assert cache.get_relevant("memory 12", 1) == ["memory 12"]
+    cache.close()
+    assert cache.shards is None
+
+
+def test_embeddings_are_exported_and_imported(cfg, monkeypatch):
+    cfg.memory_max_entries = 3
+    cache = open_cache(cfg)
+    cache.add_many(
+        [f"memory {i}" for i in range(4)],
+        [{"added": i, "command": "google", "step": i} for i in range(4)],
+    )
+    batches = list(cache.iter_embeddings(batch_size=2))
+    # row 0 was reused by memory 3
+    assert [(cursor, texts) for cursor, texts, _, _ in batches] == [
+        (2, ["memory 3", "memory 1"]),
+        (4, ["memory 2"]),
+    ]
+    assert np.allclose(batches[0][2][0], fake_embedding("memory 3"))
+    assert batches[0][3] == [
+        {"added": 3.0, "step": 3.0, "command": "google"},
+        {"added": 1.0, "step": 1.0, "command": "google"},
+    ]
+    assert [batch[1] for batch in cache.iter_embeddings(start=2)] == [["memory 2"]]
+
+    def no_embeddings(texts):
+        raise AssertionError("imported texts are not embedded")
+
+    monkeypatch.setattr(local, "get_ada_embeddings", no_embeddings)
+    vectors = np.stack([fake_embedding("x"), fake_embedding("y")])
+    assert cache.add_embeddings(["x", "y"], vectors, [{"added": 5}, None]) == [
+        "x",
+        "y",
+    ]
+    query = fake_embedding("y")[None]
+    assert cache.data.texts[cache.search(query, 1)[0][0, 0]] == "y"
+    assert cache.get_relevant("x", 2, "lexical", where={"added": 5}) == ["x"]
+
+
+def test_metadata_filters_are_applied_before_ranking(cfg):
+    cfg.memory_search_mode = "hybrid"
+    cache = open_cache(cfg)
+    cache.add_many(
+        [f"google result {i}" for i in range(10)] + ["browsed example.com"],
+        [{"command": "google", "added": i} for i in range(10)]
+        + [{"command": "browse_website", "added": 10}],
+    )
+    where = {"command": "browse_website"}
+    assert cache.get_relevant("google result 3", 3, where=where) == [
+        "browsed example.com"
+    ]
+    assert cache.get_relevant("result", 3, "lexical", where=where) == []
+    recent = {"added": {"gte": 8}}
+    assert sorted(cache.get_relevant("google result 3", 5, where=recent)) == [
+        "browsed example.com",
+        "google result 8",
+        "google result 9",
+    ]
+    cache.close()
+
+    cache = open_cache(cfg)
+    assert cache.get_relevant("result 9", 1, "vector", where={"added": 9}) == [
+        "google result 9"
+    ]
+    assert cache.get_relevant("memory", 5, where={"agent": "other"}) == []
+
+
+def test_results_are_reranked_under_a_token_budget(cfg, monkeypatch):
+    # one token per word
+    encoding = SimpleNamespace(encode=str.split)
+    monkeypatch.setattr("memories.base._encoding", lambda: encoding)
+    cfg.memory_recency_half_life = 1
+    cache = open_cache(cfg)
+    old = {"added": 0}
+    cache.add_many(["memory 1", "memory 2 " + "long " * 50, "memory 3"], [old, {}, {}])
+    # memory 1 is decayed below memory 3, memory 2 does not fit
+    assert cache.get_relevant("memory 1", 2, max_tokens=20) == ["memory 3", "memory 1"]
+    assert cache.get_relevant("memory 1", 2, max_tokens=3) == ["memory 3"]
+    assert len(cache.get_relevant("memory 1", 2)) == 2
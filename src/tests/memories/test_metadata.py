@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from memories.metadata import check_metadata
+from memories.metadata import MetadataColumns
+from memories.metadata import MetadataFile
+from memories.metadata import parse_where
+
+
+def test_check_metadata_stamps_the_time():
+    assert check_metadata(None, now=5.0) == {"added": 5.0}
+    assert check_metadata({"command": "google", "added": 1}, now=5.0) == {
+        "command": "google",
+        "added": 1,
+    }
+    for invalid in ({"data": "x"}, {"two words": 1}, {"tags": ["a"]}, {"added": "x"}):
+        with pytest.raises(ValueError):
+            check_metadata(invalid)
+
+
+def test_parse_where():
+    assert parse_where({"command": "google", "step": [1, 2]}) == [
+        ("command", "in", ("google",)),
+        ("step", "in", (1, 2)),
+    ]
+    assert parse_where({"added": {"gt": 1, "gte": 2, "lt": 9}}) == [
+        ("added", "range", (2, True, 9, False))
+    ]
+    with pytest.raises(ValueError):
+        parse_where({"added": {"after": 1}})
+
+
+def test_masks():
+    columns = MetadataColumns()
+    columns.set_many(
+        range(5),
+        [
+            {"command": "google", "added": 1.0},
+            {"command": "browse_website", "added": 2.0, "ok": True},
+            {"command": "google", "added": 3.0, "ok": False, "step": 1},
+            {"added": 4.0, "step": "1"},
+            {},
+        ],
+    )
+    assert columns.mask(None).tolist() == [True] * 5
+    assert np.flatnonzero(columns.mask({"command": "google"})).tolist() == [0, 2]
+    assert np.flatnonzero(
+        columns.mask({"command": ["google", "browse_website"], "added": {"gte": 2}})
+    ).tolist() == [1, 2]
+    assert np.flatnonzero(columns.mask({"added": {"gt": 1, "lt": 4}})).tolist() == [
+        1,
+        2,
+    ]
+    assert np.flatnonzero(columns.mask({"ok": True})).tolist() == [1]
+    # numbers, strings and booleans do not match each other
+    assert np.flatnonzero(columns.mask({"step": 1})).tolist() == [2]
+    assert np.flatnonzero(columns.mask({"step": "1"})).tolist() == [3]
+    assert not columns.mask({"unknown": "x"}).any()
+
+    columns.set(2, {})
+    columns.grow(7)
+    assert np.flatnonzero(columns.mask({"command": "google"})).tolist() == [0]
+    assert len(columns.mask(None)) == 7
+
+
+def test_metadata_file_replays_and_compacts(tmp_path, monkeypatch):
+    monkeypatch.setattr("memories.metadata.INITIAL_ROWS", 4)
+    filename = str(tmp_path / "metadata.jsonl")
+    metadata = MetadataFile(filename)
+    metadata.load(0)
+    metadata.write([0, 1], [{"command": "a"}, {"command": "b"}])
+    for i in range(10):
+        metadata.write([1], [{"command": f"b{i}"}])
+    metadata.write([2], [{"command": "lost"}])
+    with open(filename, "ab") as f:
+        f.write(b'[3, {"comm')
+
+    metadata = MetadataFile(filename)
+    metadata.load(2)
+    assert metadata.lines == 2
+    assert np.flatnonzero(metadata.columns.mask({"command": "b9"})).tolist() == [1]
+    assert not metadata.columns.mask({"command": "lost"}).any()
+    with open(filename, "rb") as f:
+        assert len(f.readlines()) == 2
+
+
+def test_torn_line_is_truncated_before_the_next_write(tmp_path):
+    filename = str(tmp_path / "metadata.jsonl")
+    metadata = MetadataFile(filename)
+    metadata.load(0)
+    metadata.write([0], [{"command": "a"}])
+    with open(filename, "ab") as f:
+        f.write(b'[1, {"command": "b"}]')
+
+    metadata = MetadataFile(filename)
+    metadata.load(3)
+    metadata.write([1, 2], [{"command": "b"}, {"command": "c"}])
+    metadata = MetadataFile(filename)
+    metadata.load(3)
+    assert metadata.lines == 3
+    for row, command in enumerate("abc"):
+        assert np.flatnonzero(metadata.columns.mask({"command": command})).tolist() == [
+            row
+        ]
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from memories.migrate import load_checkpoint
+from memories.migrate import migrate
+
+
+class ArrayMemory:
+    def __init__(self, texts=(), fail_after=None):
+        self.texts = list(texts)
+        self.embeddings = [np.full(4, i, dtype=np.float32) for i in range(len(texts))]
+        self.metadata = [{"added": float(i)} for i in range(len(texts))]
+        self.fail_after = fail_after
+
+    def iter_embeddings(self, start=0, batch_size=1024):
+        for first in range(start, len(self.texts), batch_size):
+            end = first + batch_size
+            yield (
+                end,
+                self.texts[first:end],
+                np.array(self.embeddings[first:end]),
+                self.metadata[first:end],
+            )
+
+    def add_embeddings(self, texts, embeddings, metadata=None):
+        if self.fail_after is not None and len(self.texts) >= self.fail_after:
+            raise ConnectionError("target went away")
+        self.texts.extend(texts)
+        self.embeddings.extend(embeddings)
+        self.metadata.extend(metadata)
+        return texts
+
+
+def test_migrate_copies_embeddings():
+    source = ArrayMemory([f"memory {i}" for i in range(10)])
+    target = ArrayMemory()
+    reported = []
+    stats = migrate(source, target, batch_size=4, progress=reported.append)
+    assert target.texts == source.texts
+    assert np.array_equal(np.array(target.embeddings)[:, 0], np.arange(10))
+    assert target.metadata == source.metadata
+    assert (stats.read, stats.written, stats.cursor) == (10, 10, 12)
+    assert len(reported) == 3
+    assert stats.rate > 0
+
+
+def test_interrupted_migration_resumes(tmp_path):
+    checkpoint = str(tmp_path / "migration.json")
+    source = ArrayMemory([f"memory {i}" for i in range(10)])
+    target = ArrayMemory(fail_after=4)
+    with pytest.raises(ConnectionError):
+        migrate(source, target, checkpoint, batch_size=2, names=("a", "b"))
+    assert load_checkpoint(checkpoint, "a", "b").cursor == 4
+
+    target.fail_after = None
+    stats = migrate(source, target, checkpoint, batch_size=2, names=("a", "b"))
+    assert target.texts == source.texts
+    assert stats.read == 10
+
+
+def test_checkpoint_of_another_migration(tmp_path):
+    checkpoint = str(tmp_path / "migration.json")
+    source = ArrayMemory(["memory"])
+    migrate(source, ArrayMemory(), checkpoint, names=("a", "b"))
+    with pytest.raises(ValueError):
+        migrate(source, ArrayMemory(), checkpoint, names=("a", "c"))
@@ -1,11 +1,57 @@
+import importlib
+import sys
+import time
+from types import SimpleNamespace
+
 import pytest
 
-from memories.pinecone import PineconeMemory
+from benchmarks.memory.fake_pinecone import FakePinecone
+from configs import Singleton
+from memories import base
+from memories.embedders import HashingEmbeddings
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakePinecone()
+    monkeypatch.setitem(sys.modules, "pinecone", fake)
+    module = importlib.import_module("memories.pinecone")
+    monkeypatch.setattr(module, "pinecone", fake)
+    monkeypatch.setattr(module, "_indexes", None)
+    monkeypatch.setattr(base, "_provider", HashingEmbeddings(64))
+    return fake
+
+
+@pytest.fixture
+def cfg():
+    return SimpleNamespace(
+        pinecone_api_key="key",
+        pinecone_region="region",
+        pinecone_upsert_batch=3,
+        pinecone_flush_seconds=60,
+        pinecone_query_workers=4,
+        memory_dedup="off",
+        memory_dedup_distance=3,
+        memory_max_entries=0,
+        memory_eviction="lru",
+        memory_importance_half_life=24,
+        memory_mmr_lambda=1.0,
+        memory_recency_half_life=0,
+    )
+
+
+def open_memory(cfg):
+    from memories.pinecone import PineconeMemory
+
+    Singleton._instances.pop(PineconeMemory, None)
+    return PineconeMemory(cfg)
 
 
 @pytest.fixture
-def memory_provider():
-    return PineconeMemory()
+def memory_provider(fake, cfg):
+    memory = open_memory(cfg)
+    yield memory
+    memory.close()
 
 
 def test_add(memory_provider):
@@ -28,3 +74,208 @@ def test_clear(memory_provider):
 def test_get_stats(memory_provider):
     result = memory_provider.get_stats()
     assert isinstance(result, dict)
+
+
+def test_results_are_best_first(memory_provider):
+    # without re-ranking, get_relevant takes the single query path
+    assert not memory_provider.reranker.enabled
+    memory_provider.add_many(["cats", "cats and dogs", "birds"])
+    assert memory_provider.get_relevant("cats", 2) == ["cats", "cats and dogs"]
+
+
+def test_upserts_are_buffered(fake, memory_provider):
+    memory_provider.add("opened main.py")
+    memory_provider.add("searched for cats")
+    assert fake.requests["upsert"] == 0
+    # the third vector fills the buffer
+    memory_provider.add("wrote notes.txt", {"command": "write_to_file"})
+    assert fake.requests["upsert"] == 1
+    memory_provider.add_many(["browsed a website", "read the news"])
+    assert fake.requests["upsert"] == 1
+    memory_provider.close()
+    assert fake.requests["upsert"] == 2
+    assert len(fake.Index("agi").vectors) == 5
+    assert memory_provider.get_relevant("cats", 1) == ["searched for cats"]
+    assert memory_provider.get_relevant(
+        "notes", 5, where={"command": "write_to_file"}
+    ) == ["wrote notes.txt"]
+
+
+def test_buffer_is_flushed_after_flush_seconds(fake, cfg):
+    cfg.pinecone_flush_seconds = 0.05
+    memory = open_memory(cfg)
+    memory.add("opened main.py")
+    deadline = time.time() + 5
+    while not fake.requests["upsert"] and time.time() < deadline:
+        time.sleep(0.01)
+    assert fake.requests["upsert"] == 1
+    memory.close()
+
+
+def test_queries_read_buffered_writes(fake, memory_provider):
+    memory_provider.add("opened main.py")
+    assert memory_provider.get_relevant("main.py", 1) == ["opened main.py"]
+    # the buffer is scored in process, queries do not flush it
+    assert fake.requests["upsert"] == 0
+
+
+def test_buffered_matches_are_merged_with_the_index(fake, memory_provider):
+    memory_provider.add_many(
+        ["cats", "dogs", "birds"], [{"step": 1}, {"step": 2}, {"step": 3}]
+    )
+    memory_provider.add("cats and dogs", {"step": 4})
+    assert fake.requests["upsert"] == 1
+    assert memory_provider.get_relevant("cats", 2) == ["cats", "cats and dogs"]
+    assert memory_provider.get_relevant("dogs", 2, where={"step": {"gte": 3}}) == [
+        "cats and dogs",
+        "birds",
+    ]
+    batch = memory_provider.get_relevant_batch(["dogs", "birds"], 1)
+    assert [[text for text, _ in results] for results in batch] == [
+        ["dogs"],
+        ["birds"],
+    ]
+    assert fake.requests["upsert"] == 1
+
+    memory_provider.reranker.mmr_lambda = 0.5
+    assert "cats and dogs" in memory_provider.get_relevant("cats", 2)
+    assert fake.requests["upsert"] == 1
+
+
+def test_buffered_vector_replaces_its_stored_match(fake, cfg):
+    cfg.memory_dedup = "merge"
+    memory = open_memory(cfg)
+    memory.add("searched the web for cats and found many pictures of them today")
+    memory.flush()
+    memory.add("searched the web for cats and found many pictures of them today!")
+    assert memory.get_relevant("cats", 5) == [
+        "searched the web for cats and found many pictures of them today!"
+    ]
+    memory.close()
+
+
+def test_repeats_and_evictions_of_buffered_vectors(fake, cfg):
+    cfg.memory_dedup = "bump"
+    cfg.memory_max_entries = 2
+    memory = open_memory(cfg)
+    memory.add("opened main.py")
+    assert memory.add("opened main.py").startswith("Data already in memory")
+    memory.add("searched for cats")
+    # evicts a vector that was never upserted
+    memory.add("wrote notes.txt")
+    memory.close()
+    vectors = fake.Index("agi").vectors
+    assert sorted(metadata["raw_text"] for _, metadata in vectors.values()) == [
+        "searched for cats",
+        "wrote notes.txt",
+    ]
+    assert fake.requests["update"] == 0
+
+
+def test_repeats_and_evictions_within_add_many(fake, cfg):
+    cfg.memory_dedup = "bump"
+    cfg.memory_max_entries = 2
+    memory = open_memory(cfg)
+    memory.add_many(
+        ["opened main.py", "opened main.py", "searched for cats", "wrote notes.txt"]
+    )
+    memory.close()
+    vectors = fake.Index("agi").vectors
+    assert sorted(metadata["raw_text"] for _, metadata in vectors.values()) == [
+        "searched for cats",
+        "wrote notes.txt",
+    ]
+    assert fake.requests["update"] == 0
+    memory = open_memory(cfg)
+    memory.clear()
+    memory.add_many(["opened main.py", "opened main.py"])
+    memory.close()
+    assert fake.Index("agi").vectors["0"][1]["count"] == 2
+
+
+def test_no_hot_tier_without_a_shared_watermark(memory_provider):
+    memory_provider.add("opened main.py")
+    # vec_num is only counted in this process
+    assert memory_provider.watermark() is None
+
+
+def test_indexes_are_listed_once(fake, cfg):
+    open_memory(cfg).close()
+    open_memory(cfg).close()
+    assert fake.requests["list_indexes"] == 1
+    assert fake.requests["create_index"] == 1
+
+
+def test_batched_queries_run_in_parallel(fake, memory_provider):
+    memory_provider.add_many([f"memory number {i}" for i in range(8)])
+    queries = [f"number {i}" for i in range(8)]
+    sequential = [memory_provider.get_relevant(query, 2) for query in queries]
+    fake.latency = 0.05
+    batch = memory_provider.get_relevant_batch(queries, 2)
+    assert fake.max_in_flight > 1
+    assert [[text for text, _ in results] for results in batch] == sequential
+
+
+def test_embeddings_are_streamed_past_evicted_ids(fake, cfg):
+    cfg.memory_max_entries = 3
+    cfg.memory_eviction = "fifo"
+    memory = open_memory(cfg)
+    for i in range(10):
+        memory.add(f"memory number {i}", {"added": i, "command": "google"})
+    batches = list(memory.iter_embeddings(batch_size=2))
+    # ids 0 to 6 were evicted, the stream does not stop at their batches
+    assert [text for _, texts, _, _ in batches for text in texts] == [
+        "memory number 7",
+        "memory number 8",
+        "memory number 9",
+    ]
+    assert batches[-1][2].shape == (2, 64)
+    assert batches[-1][3] == [
+        {"added": 8, "command": "google"},
+        {"added": 9, "command": "google"},
+    ]
+    cursor = batches[-2][0]
+    assert [batch[1] for batch in memory.iter_embeddings(cursor, 2)] == [
+        ["memory number 8", "memory number 9"]
+    ]
+    memory.close()
+
+
+def test_embeddings_stream_ends_past_other_ids(fake, cfg):
+    memory = open_memory(cfg)
+    memory.add_many(["opened main.py", "searched for cats"])
+    memory.close()
+    index = fake.Index("agi")
+    index.upsert([("not-a-memory", [1.0] * 64, {"raw_text": "other data"})])
+    # another process, which counted no ids
+    other = open_memory(cfg)
+    batches = list(other.iter_embeddings(batch_size=1))
+    assert [texts for _, texts, _, _ in batches] == [
+        ["opened main.py"],
+        ["searched for cats"],
+    ]
+    empty_fetches = importlib.import_module("memories.pinecone").EMPTY_FETCHES
+    assert fake.requests["fetch"] == 2 + empty_fetches
+
+
+def test_imports_resume_after_the_stored_memories(fake, cfg):
+    cfg.memory_dedup = "bump"
+    vectors = [[1.0] + [0.0] * 63, [0.0, 1.0] + [0.0] * 62, [0.0] * 63 + [1.0]]
+    memory = open_memory(cfg)
+    assert memory.add_embeddings(["opened main.py", "searched for cats"], vectors[:2])
+    memory.close()
+    # an interrupted migration loads its last batch again
+    resumed = open_memory(cfg)
+    assert resumed.add_embeddings(
+        ["opened main.py", "searched for cats", "wrote notes.txt"], vectors
+    ) == ["wrote notes.txt"]
+    resumed.close()
+    stored = fake.Index("agi").vectors
+    assert {
+        memory_id: fields["raw_text"] for memory_id, (_, fields) in stored.items()
+    } == {
+        "0": "opened main.py",
+        "1": "searched for cats",
+        "2": "wrote notes.txt",
+    }
+    assert stored["0"][1]["count"] == 2
@@ -0,0 +1,416 @@
+from types import SimpleNamespace
+
+import fakeredis
+import numpy as np
+import pytest
+
+from configs import Singleton
+from memories import base
+from memories import redismem
+from memories.embedders import HashingEmbeddings
+from memories.redismem import RedisMemory
+from memories.tiered import TieredMemory
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(
+        redismem.redis, "Redis", lambda **kwargs: fakeredis.FakeRedis(server=server)
+    )
+    monkeypatch.setattr(base, "_provider", HashingEmbeddings(64))
+    return server
+
+
+@pytest.fixture
+def cfg():
+    return SimpleNamespace(
+        redis_host="localhost",
+        redis_port="6379",
+        redis_password="",
+        redis_search="auto",
+        redis_vector_algorithm="HNSW",
+        redis_vector_type="FLOAT32",
+        redis_hnsw_m=16,
+        redis_hnsw_ef_construction=200,
+        redis_hnsw_ef_runtime=10,
+        wipe_redis_on_start=False,
+        memory_index="test-index",
+        memory_dedup="bump",
+        memory_dedup_distance=3,
+        memory_max_entries=0,
+        memory_eviction="lru",
+        memory_importance_half_life=24,
+        memory_search_mode="vector",
+        memory_mmr_lambda=1.0,
+        memory_recency_half_life=0,
+    )
+
+
+class SearchIndex:
+    """Records the RediSearch calls of a memory, fakeredis has no RediSearch."""
+
+    def __init__(self):
+        self.created = None
+        self.queries = []
+
+    def create_index(self, fields, definition):
+        self.created = (fields, definition)
+
+    def info(self):
+        return {"attributes": []}
+
+    def search(self, query, query_params=None):
+        self.queries.append((query, query_params))
+        return SimpleNamespace(docs=[])
+
+
+@pytest.fixture
+def search_index(server, monkeypatch):
+    index = SearchIndex()
+    monkeypatch.setattr(fakeredis.FakeRedis, "ft", lambda self, name: index, False)
+    return index
+
+
+def record_pipelines(monkeypatch):
+    """
+    Returns: The (transaction, commands) of every pipeline executed from now.
+    """
+    executed = []
+    pipeline = fakeredis.FakeRedis.pipeline
+
+    def recording(self, transaction=True, shard_hint=None):
+        pipe = pipeline(self, transaction, shard_hint)
+        execute = pipe.execute
+
+        def run(*args, **kwargs):
+            commands = [
+                tuple(arg.decode() if isinstance(arg, bytes) else arg for arg in args)
+                for args, _ in pipe.command_stack
+            ]
+            executed.append((transaction, commands))
+            return execute(*args, **kwargs)
+
+        pipe.execute = run
+        return pipe
+
+    monkeypatch.setattr(fakeredis.FakeRedis, "pipeline", recording)
+    return executed
+
+
+def open_memory(cfg):
+    Singleton._instances.pop(RedisMemory, None)
+    return RedisMemory(cfg)
+
+
+def test_embeddings_are_exported_with_metadata(server, cfg):
+    memory = open_memory(cfg)
+    memory.add_many(
+        ["opened main.py", "searched for cats"],
+        [{"command": "read_file", "step": 1, "added": 10}, {"command": "google"}],
+    )
+    batches = list(memory.iter_embeddings(batch_size=1))
+    assert [(cursor, texts) for cursor, texts, _, _ in batches] == [
+        (1, ["opened main.py"]),
+        (2, ["searched for cats"]),
+    ]
+    assert batches[0][2].shape == (1, 64)
+    assert batches[0][3] == [{"command": "read_file", "step": 1.0, "added": 10.0}]
+    assert batches[1][3][0]["command"] == "google"
+
+    vector = np.ones((1, 64), dtype=np.float32)
+    assert memory.add_embeddings(["x"], vector, [{"command": "browse"}]) == ["x"]
+    assert memory.get_relevant("x", 3, where={"command": "browse"}) == ["x"]
+
+
+def test_processes_reserve_distinct_ids(server, cfg):
+    first = open_memory(cfg)
+    first.add_many(["opened main.py", "searched for cats", "wrote notes.txt"])
+    second = open_memory(cfg)
+    second.add_many(["browsed the docs", "ran the tests"])
+    first.add("fixed the bug")
+
+    client = fakeredis.FakeRedis(server=server)
+    assert int(client.get("test-index-vec_num")) == 6
+    texts = [client.hget(f"test-index:{i}", "data") for i in range(6)]
+    assert texts == [
+        b"opened main.py",
+        b"searched for cats",
+        b"wrote notes.txt",
+        b"browsed the docs",
+        b"ran the tests",
+        b"fixed the bug",
+    ]
+
+
+def test_add_many_writes_in_pipeline_chunks(server, cfg, monkeypatch):
+    monkeypatch.setattr(redismem, "PIPELINE_CHUNK", 4)
+    memory = open_memory(cfg)
+    texts = [f"memory number {i}" for i in range(7)]
+    messages = memory.add_many(texts + ["memory number 3", "Command Error: oops"])
+    assert (
+        messages[0] == "Inserting data into memory at index: 0:\ndata: memory number 0"
+    )
+    assert messages[7] == "Data already in memory at index: 3"
+    assert messages[8] == ""
+
+    client = fakeredis.FakeRedis(server=server)
+    assert int(client.get("test-index-vec_num")) == 7
+    assert int(client.hget("test-index:3", "count")) == 2
+    assert not client.exists("test-index:7")
+
+
+def test_memories_are_searched_locally_without_redisearch(server, cfg):
+    memory = open_memory(cfg)
+    assert memory.mirror is not None
+    memory.add_many(["opened main.py", "searched for cats", "wrote notes.txt"])
+    assert memory.get_relevant("searched for cats", 1) == ["searched for cats"]
+    assert memory.get_stats()["search"] == "local"
+
+
+def test_mirror_syncs_memories_of_other_processes(server, cfg):
+    first = open_memory(cfg)
+    first.add_many(["opened main.py", "searched for cats"])
+    second = open_memory(cfg)
+    assert len(second.mirror) == 2
+
+    read = []
+    original = second.mirror.read
+
+    def spy(memory_ids):
+        memory_ids = list(memory_ids)
+        read.append(memory_ids)
+        return original(memory_ids)
+
+    second.mirror.read = spy
+    first.add("wrote notes.txt")
+    assert second.get_relevant("wrote notes.txt", 1) == ["wrote notes.txt"]
+    # the sync reads the new memory only, then the results are read back
+    assert read == [[2], [2]]
+
+    client = fakeredis.FakeRedis(server=server)
+    client.delete("test-index:2")
+    assert sorted(second.get_relevant("wrote notes.txt", 3)) == [
+        "opened main.py",
+        "searched for cats",
+    ]
+    assert 2 not in second.mirror.rows
+
+    first.clear()
+    assert second.get_relevant("opened main.py", 3) == []
+    assert len(second.mirror) == 0
+
+
+def test_mirror_filters_lexical_queries_by_metadata(server, cfg):
+    cfg.memory_search_mode = "lexical"
+    memory = open_memory(cfg)
+    memory.add_many(
+        [
+            "searched the web for cats",
+            "searched the web for dogs",
+            "read the cats file",
+            "read the logs",
+        ],
+        [
+            {"command": "google", "step": 1},
+            {"command": "google", "step": 2},
+            {"command": "read_file", "step": 3},
+            {"command": "read_file", "step": 4},
+        ],
+    )
+    assert sorted(memory.get_relevant("cats", 5)) == [
+        "read the cats file",
+        "searched the web for cats",
+    ]
+    assert memory.get_relevant("cats", 5, where={"command": "read_file"}) == [
+        "read the cats file"
+    ]
+    assert memory.get_relevant("searched", 5, where={"step": {"gte": 2}}) == [
+        "searched the web for dogs"
+    ]
+    assert memory.get_relevant("cats", 5, where={"command": "browse"}) == []
+
+    # another process sees the fields and filters the same way
+    other = open_memory(cfg)
+    assert other.mirror.fields["step"] == "NUMERIC"
+    assert other.get_relevant("read", 5, where={"step": {"lt": 4}}) == [
+        "read the cats file"
+    ]
+    assert other.get_relevant("cats", 5, mode="hybrid", where={"step": 1}) == [
+        "searched the web for cats"
+    ]
+
+
+def test_vector_index_settings_reach_redisearch(search_index, cfg):
+    cfg.redis_search = "redisearch"
+    cfg.redis_vector_type = "float16"
+    cfg.redis_hnsw_m = 32
+    cfg.redis_hnsw_ef_construction = 400
+    cfg.redis_hnsw_ef_runtime = 20
+    memory = open_memory(cfg)
+    fields, definition = search_index.created
+    assert fields[-1].redis_args() == [
+        "embedding",
+        "VECTOR",
+        "HNSW",
+        12,
+        "TYPE",
+        "FLOAT16",
+        "DIM",
+        64,
+        "DISTANCE_METRIC",
+        "COSINE",
+        "M",
+        32,
+        "EF_CONSTRUCTION",
+        400,
+        "EF_RUNTIME",
+        20,
+    ]
+    assert definition.args[:5] == ["ON", "HASH", "PREFIX", 1, "test-index:"]
+
+    memory.get_relevant("searched for cats", 3, ef_runtime=50)
+    memory.get_relevant("searched for cats", 3)
+    (with_ef, params), (default, _) = search_index.queries
+    assert with_ef.query_string() == (
+        "(*)=>[KNN 3 @embedding $vector EF_RUNTIME 50 AS vector_score]"
+    )
+    assert default.query_string() == "(*)=>[KNN 3 @embedding $vector AS vector_score]"
+    assert len(params["vector"]) == 64 * 2
+
+
+def test_flat_index_ignores_hnsw_settings(search_index, cfg):
+    cfg.redis_search = "redisearch"
+    cfg.redis_vector_algorithm = "flat"
+    memory = open_memory(cfg)
+    fields, _ = search_index.created
+    assert fields[-1].redis_args() == [
+        "embedding",
+        "VECTOR",
+        "FLAT",
+        6,
+        "TYPE",
+        "FLOAT32",
+        "DIM",
+        64,
+        "DISTANCE_METRIC",
+        "COSINE",
+    ]
+    memory.get_relevant("searched for cats", 3, ef_runtime=50)
+    query, params = search_index.queries[0]
+    assert "EF_RUNTIME" not in query.query_string()
+    assert len(params["vector"]) == 64 * 4
+
+
+def test_clear_deletes_only_the_memories_of_the_index(
+    search_index, server, cfg, monkeypatch
+):
+    monkeypatch.setattr(redismem, "PIPELINE_CHUNK", 2)
+    cfg.redis_search = "redisearch"
+    cfg.memory_index = "agent[1]"
+    memory = open_memory(cfg)
+    memory.add_many([f"memory number {i}" for i in range(5)])
+    client = fakeredis.FakeRedis(server=server)
+    # "agent1:0" matches the index pattern unescaped
+    unrelated = ["agent1:0", "agent[1]-other", "agent[2]:0", "session"]
+    for key in unrelated:
+        client.set(key, "kept")
+    fakeredis.FakeRedis(server=server, db=1).set("agent[1]:0", "kept")
+
+    assert memory.clear() == "Obliviated"
+    assert sorted(key.decode() for key in client.keys()) == sorted(unrelated)
+    assert fakeredis.FakeRedis(server=server, db=1).get("agent[1]:0") == b"kept"
+    # SearchIndex has no dropindex, the search index is kept
+
+    memory.add("added after the clear")
+    assert client.get("agent[1]-vec_num") == b"1"
+    cfg.wipe_redis_on_start = True
+    open_memory(cfg)
+    assert sorted(key.decode() for key in client.keys()) == sorted(unrelated)
+
+
+def test_hot_tier_remembers_the_stored_embeddings(server, cfg):
+    cfg.memory_hot_entries = 8
+    cfg.memory_hot_min_score = 0.9
+    cfg.memory_hot_watermark_seconds = 0
+    redis_memory = open_memory(cfg)
+    results = redis_memory.write_many(["opened main.py", "opened main.py"])
+    assert [action for action, _, _ in results] == ["add", "bump"]
+    assert results[0][2].dtype == np.float32 and results[1][2] is None
+
+    memory = TieredMemory(redis_memory, cfg)
+
+    assert memory.add_many(["searched for cats", "opened main.py"]) == [
+        "Inserting data into memory at index: 1:\ndata: searched for cats",
+        "Data already in memory at index: 0",
+    ]
+    assert list(memory.rows) == ["searched for cats"]
+    vector = np.frombuffer(
+        fakeredis.FakeRedis(server=server).hget("test-index:1", "embedding"),
+        dtype=np.float32,
+    )
+    assert np.array_equal(memory.embeddings[memory.rows["searched for cats"]], vector)
+    assert memory.get_relevant("searched for cats", 1) == ["searched for cats"]
+    assert memory.hits == 1
+
+
+def test_search_reports_the_stored_embeddings(server, cfg):
+    cfg.redis_vector_type = "float16"
+    cfg.memory_mmr_lambda = 0.5
+    memory = open_memory(cfg)
+    memory.add_many(
+        ["opened main.py", "searched for cats"], [{"added": 10}, {"added": 20}]
+    )
+    (results,) = memory.search_many(["searched for cats"], 2)
+    assert [(data, added) for data, _, _, added in results] == [
+        ("searched for cats", 20.0),
+        ("opened main.py", 10.0),
+    ]
+    stored = fakeredis.FakeRedis(server=server).hget("test-index:1", "embedding")
+    vector = results[0][2]
+    assert vector.dtype == np.float32
+    assert np.array_equal(vector, np.frombuffer(stored, dtype=np.float16))
+    assert memory.get_relevant_batch(["searched for cats"], 2) == [
+        [(data, score) for data, score, _, _ in results]
+    ]
+
+
+def test_startup_reads_the_index_in_pipeline_chunks(
+    search_index, server, cfg, monkeypatch
+):
+    monkeypatch.setattr(redismem, "PIPELINE_CHUNK", 2)
+    cfg.redis_search = "redisearch"
+    open_memory(cfg).add_many([f"memory number {i}" for i in range(5)])
+    # stored before memories were fingerprinted
+    fakeredis.FakeRedis(server=server).hdel("test-index:3", "exact", "simhash")
+
+    executed = record_pipelines(monkeypatch)
+    memory = open_memory(cfg)
+    assert all(not transaction for transaction, _ in executed)
+    assert all(len(commands) <= 2 for _, commands in executed)
+    commands = [command for _, commands in executed for command in commands]
+    reads = [command for command in commands if command[0] == "HMGET"]
+    assert sorted(command[1] for command in reads) == [
+        f"test-index:{i}" for i in range(5)
+    ]
+    assert not [command for command in reads if "data" in command]
+    assert [command for command in commands if command[0] == "HGET"] == [
+        ("HGET", "test-index:3", "data")
+    ]
+    assert memory.add("memory number 3") == "Data already in memory at index: 3"
+
+
+def test_startup_scans_the_index_once_with_the_mirror(server, cfg, monkeypatch):
+    open_memory(cfg).add_many(["opened main.py", "searched for cats"])
+    scans = []
+    scan_iter = fakeredis.FakeRedis.scan_iter
+
+    def scanning(self, *args, **kwargs):
+        scans.append(kwargs["match"])
+        return scan_iter(self, *args, **kwargs)
+
+    monkeypatch.setattr(fakeredis.FakeRedis, "scan_iter", scanning)
+    memory = open_memory(cfg)
+    assert scans == ["test-index:*"]
+    assert len(memory.mirror) == 2
+    assert memory.add("searched for cats") == "Data already in memory at index: 1"
@@ -0,0 +1,41 @@
+import numpy as np
+
+from memories.rerank import Reranker
+
+
+def test_disabled_reranker_keeps_the_ranking():
+    reranker = Reranker()
+    assert not reranker.enabled
+    assert reranker.pool_size(5) == 5
+    assert reranker.pool_size(5, max_tokens=100) == 20
+    hits = [(7, 0.9), (3, 0.8), (5, 0.1)]
+    vectors = np.eye(3, dtype=np.float32)
+    assert reranker.select(hits, vectors, 2) == [(7, 1.0), (3, 0.8 / 0.9)]
+    assert reranker.select([], np.zeros((0, 3)), 2) == []
+
+
+def test_mmr_skips_near_duplicates():
+    hits = [(0, 0.9), (1, 0.89), (2, 0.6)]
+    vectors = np.array([[1, 0], [1, 0.01], [0, 1]], dtype=np.float32)
+    assert [i for i, _ in Reranker(1.0).select(hits, vectors, 2)] == [0, 1]
+    assert [i for i, _ in Reranker(0.5).select(hits, vectors, 2)] == [0, 2]
+
+
+def test_relevance_decays_with_age():
+    reranker = Reranker(half_life=10.0)
+    hits = [(0, 1.0), (1, 0.8), (2, 0.7)]
+    vectors = np.eye(3, dtype=np.float32)
+    added = np.array([80.0, 100.0, np.nan])
+    picked = reranker.select(hits, vectors, 3, added=added, now=100.0)
+    # memory 0 is two half lives old, an unknown time does not decay
+    assert picked == [(1, 0.8), (2, 0.7), (0, 0.25)]
+
+
+def test_token_budget_fills_with_what_fits():
+    hits = [(0, 1.0), (1, 0.9), (2, 0.8), (3, 0.7)]
+    vectors = np.eye(4, dtype=np.float32)
+    picked = Reranker().select(
+        hits, vectors, 4, token_counts=[60, 50, 30, 10], max_tokens=100
+    )
+    assert [i for i, _ in picked] == [0, 2, 3]
+    assert Reranker().select(hits, vectors, 4, token_counts=[9] * 4, max_tokens=5) == []
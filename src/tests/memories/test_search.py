@@ -0,0 +1,23 @@
+import numpy as np
+
+from memories.search import top_k
+
+
+def test_top_k_matches_full_sort():
+    rng = np.random.default_rng(0)
+    scores = rng.standard_normal((4, 1000))
+    indices, selected = top_k(scores, 10)
+    expected = np.argsort(-scores, axis=1)[:, :10]
+    assert np.array_equal(indices, expected)
+    assert np.array_equal(selected, np.take_along_axis(scores, expected, axis=1))
+
+
+def test_top_k_single_row_and_small_n():
+    indices, selected = top_k(np.array([0.1, 0.9, 0.5]), 5)
+    assert indices.tolist() == [1, 2, 0]
+    assert selected.tolist() == [0.9, 0.5, 0.1]
+
+
+def test_top_k_empty():
+    indices, selected = top_k(np.zeros((2, 0)), 3)
+    assert indices.shape == selected.shape == (2, 0)
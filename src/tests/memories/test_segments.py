@@ -0,0 +1,173 @@
+import os
+
+import numpy as np
+import pytest
+
+from memories.segments import SegmentLog
+
+DIM = 8
+
+
+def vector(i):
+    return np.full(DIM, i, dtype=np.float32)
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = SegmentLog(str(tmp_path / "index.mem"), DIM, segment_rows=4)
+    yield log
+    log.close()
+
+
+def fill(log, n, start=0):
+    for i in range(start, start + n):
+        log.append(i, f"text {i}", vector(i))
+
+
+def load(path):
+    base_texts, base_embeddings, texts, embeddings = SegmentLog(path, DIM).load()
+    return list(base_texts) + texts, np.concatenate([base_embeddings, embeddings])
+
+
+def test_append_and_load(log):
+    fill(log, 10)
+    log.close()
+
+    texts, embeddings = load(log.path)
+    assert texts == [f"text {i}" for i in range(10)]
+    assert embeddings.shape == (10, DIM)
+    assert np.array_equal(embeddings[:, 0], np.arange(10))
+
+
+def test_append_writes_constant_bytes(log):
+    fill(log, 1)
+    sizes = [os.path.getsize(os.path.join(log.path, f)) for f in os.listdir(log.path)]
+    fill(log, 2, start=1)
+    grown = [os.path.getsize(os.path.join(log.path, f)) for f in os.listdir(log.path)]
+    assert sum(grown) - sum(sizes) == 2 * (DIM * 4 + 12 + len("text 0"))
+
+
+def test_torn_write_is_truncated(log):
+    fill(log, 3)
+    log.close()
+    vec_name, log_name = log._files(0)
+    with open(vec_name, "ab") as f:
+        f.write(b"\0" * 5)
+    with open(log_name, "ab") as f:
+        f.write(b"\1\2\3")
+
+    reopened = SegmentLog(log.path, DIM, segment_rows=4)
+    _, _, texts, embeddings = reopened.load()
+    assert len(texts) == len(embeddings) == 3
+    reopened.append(3, "text 3", vector(3))
+    reopened.close()
+    texts, embeddings = load(log.path)
+    assert texts[-1] == "text 3"
+    assert embeddings[-1, 0] == 3
+
+
+def test_compaction_writes_a_mapped_snapshot(log):
+    fill(log, 17)
+    log.compact()
+    log.close()
+    assert sorted(os.listdir(log.path)) == [
+        "000000000016.log",
+        "000000000016.vec",
+        "snapshot-000000000016",
+    ]
+
+    base_texts, base_embeddings, texts, embeddings = SegmentLog(log.path, DIM).load()
+    assert isinstance(base_embeddings, np.memmap)
+    assert not base_embeddings.flags.writeable
+    assert list(base_texts) == [f"text {i}" for i in range(16)]
+    assert base_texts[-1] == "text 15"
+    assert np.array_equal(base_embeddings[:, 0], np.arange(16))
+    assert texts == ["text 16"]
+
+
+def test_compaction_extends_the_previous_snapshot(log):
+    fill(log, 9)
+    log.compact()
+    fill(log, 10, start=9)
+    log.compact(seal_active=True)
+    fill(log, 2, start=19)
+    log.close()
+    assert [f for f in os.listdir(log.path) if f.startswith("snapshot")] == [
+        "snapshot-000000000019"
+    ]
+
+    texts, embeddings = load(log.path)
+    assert texts == [f"text {i}" for i in range(21)]
+    assert np.array_equal(embeddings[:, 0], np.arange(21))
+
+
+def test_load_drops_segments_folded_before_crash(log):
+    fill(log, 9)
+    sealed = log._files(0) + log._files(4)
+    contents = [open(name, "rb").read() for name in sealed]
+    log.compact()
+    log.close()
+    # simulate a crash after the snapshot was renamed into place
+    for name, content in zip(sealed, contents):
+        with open(name, "wb") as f:
+            f.write(content)
+
+    texts, _ = load(log.path)
+    assert texts == [f"text {i}" for i in range(9)]
+    assert not any(os.path.exists(name) for name in sealed)
+
+
+def test_clear(log):
+    fill(log, 6)
+    log.compact()
+    log.clear()
+    assert log.is_empty()
+    log.append(0, "again", vector(0))
+    assert load(log.path)[0] == ["again"]
+
+
+def test_records_replace_earlier_rows(log):
+    fill(log, 10)
+    log.compact()
+    # row 2 is in the snapshot, row 9 is replayed from a segment
+    log.append(2, "new 2", vector(20))
+    log.append(9, "new 9", vector(90))
+    log.append(10, "text 10", vector(10))
+    log.append(10, "new 10", vector(100))
+    log.close()
+
+    base_texts, base_embeddings, texts, embeddings = SegmentLog(log.path, DIM).load()
+    assert base_texts[2] == "new 2"
+    assert base_embeddings[2, 0] == 20
+    # the file keeps the old row, the patch is private to the process
+    assert np.load(os.path.join(log._snapshot_path(8), "embeddings.npy"))[2, 0] == 2
+    assert texts == ["text 8", "new 9", "new 10"]
+    assert np.array_equal(embeddings[:, 0], [8, 90, 100])
+
+
+def test_compaction_folds_replaced_rows(log):
+    fill(log, 9)
+    log.compact()
+    log.append(1, "new 1", vector(10))
+    log.append(9, "text 9", vector(9))
+    log.append(5, "new 5", vector(50))
+    fill(log, 5, start=10)
+    log.append(12, "new 12", vector(120))
+    log.compact(seal_active=True)
+    log.close()
+
+    texts, embeddings = load(log.path)
+    expected = [f"text {i}" for i in range(15)]
+    expected[1], expected[5], expected[12] = "new 1", "new 5", "new 12"
+    assert texts == expected
+    assert np.array_equal(
+        embeddings[:, 0], [0, 10, 2, 3, 4, 50, 6, 7, 8, 9, 10, 11, 120, 13, 14]
+    )
+
+
+def test_records_cannot_skip_rows(log):
+    fill(log, 2)
+    log.append(5, "text 5", vector(5))
+    log.close()
+    with pytest.raises(ValueError):
+        load(log.path)
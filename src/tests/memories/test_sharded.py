@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from memories.search import top_k
+from memories.sharded import ShardedSearch
+
+DIM = 16
+
+
+@pytest.fixture(scope="module")
+def shards():
+    shards = ShardedSearch(DIM, 3)
+    yield shards
+    shards.close()
+
+
+def unit_vectors(rng, n):
+    vectors = rng.standard_normal((n, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def test_search_matches_exact_top_k(shards):
+    rng = np.random.default_rng(0)
+    matrix = unit_vectors(rng, 5000)
+    shards.clear()
+    # the shards grow past their first segments
+    for start in range(0, len(matrix), 1700):
+        shards.append(matrix[start : start + 1700])
+    assert [shard.size for shard in shards.shards] == [1667, 1667, 1666]
+    queries = unit_vectors(rng, 8)
+    indices, scores = shards.search(queries, 10)
+    expected_indices, expected_scores = top_k(queries @ matrix.T, 10)
+    assert np.array_equal(indices, expected_indices)
+    assert np.allclose(scores, expected_scores)
+
+
+def test_replaced_rows_are_searched(shards):
+    rng = np.random.default_rng(1)
+    matrix = unit_vectors(rng, 100)
+    shards.clear()
+    shards.append(matrix)
+    query = unit_vectors(rng, 1)
+    shards[41] = query[0]
+    assert shards.search(query, 1)[0][0, 0] == 41
+
+
+def test_fewer_rows_than_results(shards):
+    shards.clear()
+    assert shards.search(np.ones((2, DIM)), 3)[0].shape == (2, 0)
+    shards.append(np.eye(DIM, dtype=np.float32)[:2])
+    indices, _ = shards.search(np.eye(DIM, dtype=np.float32)[:1], 3)
+    assert indices.tolist() == [[0, 1]]
@@ -0,0 +1,203 @@
+import zlib
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from configs import Singleton
+from memories import base
+from memories import embedding_cache
+from memories import get_memory
+from memories import sqlitemem
+from memories.base import EMBEDDING_DIMENSION
+from memories.sqlitemem import SQLiteMemory
+
+
+def fake_embedding(text):
+    rng = np.random.default_rng(zlib.crc32(text.encode()))
+    vector = rng.standard_normal(EMBEDDING_DIMENSION).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(
+        sqlitemem,
+        "get_ada_embeddings",
+        lambda texts: [fake_embedding(t) for t in texts],
+    )
+    return SimpleNamespace(
+        memory_index="test-index",
+        memory_dedup="off",
+        memory_dedup_distance=3,
+        memory_max_entries=0,
+        memory_eviction="lru",
+        memory_importance_half_life=24,
+        memory_search_mode="vector",
+        memory_mmr_lambda=1.0,
+        memory_recency_half_life=0,
+    )
+
+
+def open_memory(cfg):
+    Singleton._instances.pop(SQLiteMemory, None)
+    return SQLiteMemory(cfg)
+
+
+def stored_texts(memory):
+    return [text for (text,) in memory.db.execute("SELECT text FROM memories")]
+
+
+def test_add_persists_across_restarts(cfg, monkeypatch):
+    monkeypatch.setattr(sqlitemem, "LOAD_CHUNK", 2)
+    memory = open_memory(cfg)
+    assert memory.add("Command Error: boom") == ""
+    memory.add_many([f"memory {i}" for i in range(5)])
+    memory.close()
+
+    memory = open_memory(cfg)
+    assert memory.db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+    assert len(memory.embeddings) == 5
+    assert memory.get_relevant("memory 3", 1) == ["memory 3"]
+    assert memory.get_stats()["memories"] == 5
+
+
+def test_rows_added_by_another_process_are_loaded(cfg):
+    memory = open_memory(cfg)
+    memory.add("memory 0")
+    # a second connection to the same file
+    writer = open_memory(cfg)
+    writer.add("memory 1")
+    assert memory.get_relevant("memory 1", 1) == ["memory 1"]
+    writer.close()
+
+
+def test_lexical_and_hybrid_search(cfg, monkeypatch):
+    memory = open_memory(cfg)
+    texts = [f"memory {i}" for i in range(20)] + ["the build failed with E1234"]
+    memory.add_many(texts)
+    results = memory.get_relevant_batch(
+        ["which code was E1234?", "memory 3"], 2, "hybrid"
+    )
+    assert "the build failed with E1234" in [text for text, _ in results[0]]
+    assert results[1][0][0] == "memory 3"
+
+    def no_embeddings(texts):
+        raise AssertionError("lexical queries are not embedded")
+
+    monkeypatch.setattr(sqlitemem, "get_ada_embeddings", no_embeddings)
+    assert memory.get_relevant("E1234", 2, mode="lexical") == [
+        "the build failed with E1234"
+    ]
+    assert memory.get_relevant("nothing", 2, mode="lexical") == []
+
+
+def test_exact_repeats_are_bumped(cfg):
+    cfg.memory_dedup = "bump"
+    memory = open_memory(cfg)
+    memory.add_many(["searched for cats", "read notes", "searched for cats"])
+    assert memory.add("read notes") == ""
+    memory.close()
+
+    memory = open_memory(cfg)
+    assert memory.add("searched for cats") == ""
+    assert memory.db.execute("SELECT text, count FROM memories").fetchall() == [
+        ("searched for cats", 3),
+        ("read notes", 2),
+    ]
+
+
+def test_bounded_memory_evicts_and_reuses_rows(cfg):
+    cfg.memory_max_entries = 3
+    memory = open_memory(cfg)
+    memory.add_many(["memory 0", "memory 1", "memory 2"])
+    assert memory.get_relevant("memory 0", 1) == ["memory 0"]
+    memory.add("memory 3")
+    assert stored_texts(memory) == ["memory 0", "memory 2", "memory 3"]
+    assert len(memory.embeddings) == 3
+    assert memory.get_relevant("alpha", 3, mode="lexical") == []
+    assert memory.get_relevant("1", 3, mode="lexical") == []
+    memory.close()
+
+    cfg.memory_max_entries = 1
+    memory = open_memory(cfg)
+    assert len(stored_texts(memory)) == 1
+    assert memory.get_stats()["memories"] == 1
+
+
+def test_embeddings_are_exported_and_imported(cfg, monkeypatch):
+    memory = open_memory(cfg)
+    memory.add_many(
+        [f"memory {i}" for i in range(3)],
+        [{"added": i, "command": "google"} for i in range(3)],
+    )
+    batches = list(memory.iter_embeddings(batch_size=2))
+    assert [(cursor, texts) for cursor, texts, _, _ in batches] == [
+        (3, ["memory 0", "memory 1"]),
+        (4, ["memory 2"]),
+    ]
+    assert np.allclose(batches[1][2][0], fake_embedding("memory 2"))
+    assert batches[1][3] == [{"added": 2, "command": "google"}]
+
+    def no_embeddings(texts):
+        raise AssertionError("imported texts are not embedded")
+
+    monkeypatch.setattr(sqlitemem, "get_ada_embeddings", no_embeddings)
+    assert memory.add_embeddings(
+        ["x"], fake_embedding("y")[None], [{"command": "browse"}]
+    ) == ["x"]
+    assert memory.get_relevant("x", 1, "lexical", where={"command": "browse"}) == ["x"]
+
+
+def test_clear(cfg):
+    memory = open_memory(cfg)
+    memory.add_many(["alpha", "beta"])
+    assert memory.clear() == "Obliviated"
+    assert memory.get_relevant("alpha", 2, mode="lexical") == []
+    memory.add("gamma")
+    assert stored_texts(memory) == ["gamma"]
+    assert memory.get_relevant("gamma", 2) == ["gamma"]
+
+
+def test_get_memory_clears_on_init(cfg, monkeypatch):
+    monkeypatch.setattr(base, "_provider", base.HashingEmbeddings(EMBEDDING_DIMENSION))
+    monkeypatch.setattr(embedding_cache, "_cache", embedding_cache.EmbeddingCache())
+    cfg.memory_backend = "sqlite"
+    cfg.embedding_provider = "hashing"
+    cfg.embedding_dimension = EMBEDDING_DIMENSION
+    cfg.embedding_cache_path = ""
+    cfg.embedding_cache_entries = 16
+    cfg.embedding_cache_size_mb = 1
+    cfg.memory_hot_entries = 0
+    cfg.memory_write_behind = False
+    open_memory(cfg).add("stale memory")
+    Singleton._instances.pop(SQLiteMemory, None)
+    memory = get_memory(cfg, init=True)
+    assert stored_texts(memory) == []
+    memory.close()
+
+
+def test_metadata_filters(cfg):
+    cfg.memory_max_entries = 3
+    memory = open_memory(cfg)
+    memory.add_many(
+        ["google cats", "google dogs", "browse cats"],
+        [{"command": "google"}, {"command": "google"}, {"command": "browse"}],
+    )
+    where = {"command": "google"}
+    assert memory.get_relevant("browse cats", 2, where=where) != []
+    assert "browse cats" not in memory.get_relevant("browse cats", 3, where=where)
+    assert memory.get_relevant("cats", 3, "lexical", where=where) == ["google cats"]
+    memory.add("google birds", {"command": "google"})
+    memory.close()
+
+    memory = open_memory(cfg)
+    # browse cats, retrieved least recently, was evicted
+    assert memory.get_relevant("browse", 3, "lexical") == []
+    assert sorted(memory.get_relevant("google", 3, "lexical", where=where)) == [
+        "google birds",
+        "google cats",
+        "google dogs",
+    ]
+    assert memory.get_relevant("cats", 3, where={"added": {"lt": 0}}) == []
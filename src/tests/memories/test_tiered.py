@@ -0,0 +1,250 @@
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from memories import base
+from memories.embedders import HashingEmbeddings
+from memories.tiered import TieredMemory
+
+
+class RemoteMemory:
+    search_mode = "vector"
+
+    def __init__(self):
+        self.texts = []
+        self.vectors = []
+        self.added = []
+        self.vec_num = 0
+        self.queries = 0
+        self.watermarks = 0
+
+    def add(self, data, metadata=None):
+        return self.add_many([data], [metadata])[0]
+
+    def add_many(self, texts, metadata=None):
+        return [message for _, message, _ in self.write_many(texts, metadata)]
+
+    def write_many(self, texts, metadata=None):
+        # skips repeats and command errors, like the dedup policy
+        results = []
+        for text in texts:
+            if "Command Error:" in text:
+                results.append(("error", "", None))
+            elif text in self.texts:
+                results.append(("skip", f"skipped {text}", None))
+            else:
+                vector = np.array(base.get_ada_embeddings([text])[0])
+                self.texts.append(text)
+                self.vectors.append(vector)
+                self.added.append(time.time())
+                self.vec_num += 1
+                results.append(("add", f"added {text}", vector))
+        return results
+
+    def get_relevant_batch(
+        self, texts, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
+        return [
+            [(data, score) for data, score, _, _ in results]
+            for results in self.search_many(texts, num_relevant)
+        ]
+
+    def search_many(
+        self, texts, num_relevant=5, mode=None, where=None, max_tokens=None
+    ):
+        self.queries += len(texts)
+        batch = []
+        for query in base.get_ada_embeddings(texts):
+            scores = np.array(self.vectors) @ query
+            best = np.argsort(-scores, kind="stable")[:num_relevant]
+            batch.append(
+                [
+                    (self.texts[i], float(scores[i]), self.vectors[i], self.added[i])
+                    for i in best
+                ]
+            )
+        return batch
+
+    def watermark(self):
+        self.watermarks += 1
+        return self.vec_num
+
+    def clear(self):
+        self.texts = []
+        self.vectors = []
+        self.added = []
+        self.vec_num = 0
+        return "Obliviated"
+
+    def get_stats(self):
+        return {"memories": len(self.texts)}
+
+    def close(self):
+        pass
+
+
+def spy(function, record):
+    def wrapper(arg, *args, **kwargs):
+        record(arg)
+        return function(arg, *args, **kwargs)
+
+    return wrapper
+
+
+@pytest.fixture
+def remote(monkeypatch):
+    monkeypatch.setattr(base, "_provider", HashingEmbeddings(256))
+    remote = RemoteMemory()
+    remote.add_many(
+        ["the cat sat on the mat", "dogs bark at night", "opened the file main.py"]
+    )
+    return remote
+
+
+def tiered(remote, entries=16, watermark_seconds=0):
+    cfg = SimpleNamespace(
+        memory_hot_entries=entries,
+        memory_hot_min_score=0.9,
+        memory_hot_watermark_seconds=watermark_seconds,
+        memory_mmr_lambda=1.0,
+        memory_recency_half_life=0,
+    )
+    return TieredMemory(remote, cfg)
+
+
+def test_repeated_queries_are_answered_from_the_hot_set(remote):
+    memory = tiered(remote)
+    assert memory.get_relevant("the cat sat on the mat", 1) == [
+        "the cat sat on the mat"
+    ]
+    assert remote.queries == 1
+    assert memory.get_relevant("The cat sat on the mat!", 1) == [
+        "the cat sat on the mat"
+    ]
+    assert remote.queries == 1
+    # no memory in the hot set is close to the query
+    assert memory.get_relevant("dogs bark at night", 1) == ["dogs bark at night"]
+    assert remote.queries == 2
+    assert memory.get_stats()["hot_cache"] == {"entries": 2, "hits": 1, "misses": 2}
+
+
+def test_writes_go_through_to_the_hot_set(remote):
+    memory = tiered(remote)
+    assert memory.add("wrote the notes to notes.txt") == (
+        "added wrote the notes to notes.txt"
+    )
+    assert remote.texts[-1] == "wrote the notes to notes.txt"
+    assert memory.get_relevant("wrote the notes to notes.txt", 1) == [
+        "wrote the notes to notes.txt"
+    ]
+    assert remote.queries == 0
+    assert memory.add_many(
+        ["Command Error: boom", "read the news", "the cat sat on the mat"]
+    ) == ["", "added read the news", "skipped the cat sat on the mat"]
+    # only the memories the provider added, not the skipped repeat
+    assert sorted(memory.rows) == ["read the news", "wrote the notes to notes.txt"]
+
+
+def test_writes_are_embedded_once(remote, monkeypatch):
+    memory = tiered(remote)
+    provider = base.get_embedding_provider()
+    embedded = []
+    monkeypatch.setattr(
+        provider, "embed", spy(provider.embed, lambda texts: embedded.extend(texts))
+    )
+    memory.add_many(["read the news", "wrote the notes to notes.txt"])
+    assert embedded == ["read the news", "wrote the notes to notes.txt"]
+
+
+def test_retrieved_memories_join_the_hot_set_as_stored(remote, monkeypatch):
+    memory = tiered(remote)
+    provider = base.get_embedding_provider()
+    embedded = []
+    monkeypatch.setattr(
+        provider, "embed", spy(provider.embed, lambda texts: embedded.extend(texts))
+    )
+    assert memory.get_relevant("dogs bark at night", 2) == [
+        "dogs bark at night",
+        "opened the file main.py",
+    ]
+    # only the query is embedded, by both tiers without an embedding cache,
+    # the results come with their embeddings
+    assert set(embedded) == {"dogs bark at night"}
+    row = memory.rows["dogs bark at night"]
+    assert memory.added[row] == remote.added[1]
+    assert np.array_equal(memory.embeddings[row], remote.vectors[1])
+
+
+def test_writes_of_other_processes_drop_the_hot_set(remote):
+    memory = tiered(remote)
+    memory.add("wrote the notes to notes.txt")
+    remote.add("wrote the notes to notes.md")
+    assert memory.get_relevant("wrote the notes to notes.txt", 1) == [
+        "wrote the notes to notes.txt"
+    ]
+    assert remote.queries == 1
+    remote.clear()
+    remote.add("wrote the notes to notes.txt")
+    memory.get_relevant("wrote the notes to notes.txt", 1)
+    assert remote.queries == 2
+
+
+def test_watermark_is_read_once_per_interval(remote, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    memory = tiered(remote, watermark_seconds=10)
+    reads = remote.watermarks
+    memory.add("wrote the notes to notes.txt")
+    for _ in range(3):
+        memory.get_relevant("wrote the notes to notes.txt", 1)
+    assert remote.watermarks == reads
+    assert remote.queries == 0
+
+    # another process adds a memory, the hot set is stale for the interval
+    remote.add("wrote the notes to notes.md")
+    clock[0] += 9
+    memory.get_relevant("wrote the notes to notes.txt", 1)
+    assert remote.queries == 0
+    clock[0] += 1
+    memory.get_relevant("wrote the notes to notes.txt", 1)
+    assert remote.watermarks == reads + 1
+    assert remote.queries == 1
+
+    # the memories this process added are accounted for
+    memory.add_many(["read the news", "dogs bark at night"])
+    clock[0] += 10
+    memory.get_relevant("read the news", 1)
+    assert remote.queries == 1
+
+
+def test_lexical_and_filtered_queries_go_to_the_provider(remote):
+    memory = tiered(remote)
+    memory.add("wrote the notes to notes.txt")
+    memory.get_relevant("wrote the notes to notes.txt", 1, mode="lexical")
+    memory.get_relevant("wrote the notes to notes.txt", 1, where={"command": "a"})
+    assert remote.queries == 2
+
+
+def test_hybrid_queries_fuse_the_words_of_the_hot_set(remote):
+    memory = tiered(remote)
+    memory.get_relevant("opened the file main.py", 1)
+    assert remote.queries == 1
+    # the memory leads both rankings of the hot set
+    assert memory.get_relevant_batch(["opened the file main.py"], 1, "hybrid") == [
+        [("opened the file main.py", 2 / 61)]
+    ]
+    assert remote.queries == 1
+    hits = memory.lexical.search("main.py", 5)
+    assert [row for row, _ in hits] == [memory.rows["opened the file main.py"]]
+
+
+def test_least_recently_used_memories_leave_the_hot_set(remote):
+    memory = tiered(remote, entries=2)
+    memory.add("first memory")
+    memory.add("second memory")
+    memory.get_relevant("first memory", 1)
+    memory.add("third memory")
+    assert sorted(memory.rows) == ["first memory", "third memory"]
+    assert memory.lexical.search("second", 5) == []
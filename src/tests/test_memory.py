@@ -0,0 +1,51 @@
+import pytest
+from typer.testing import CliRunner
+
+import memory
+from configs import Config
+from configs import Singleton
+from memories import base
+
+
+@pytest.fixture
+def cfg(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(base, "_provider", None)
+    Singleton._instances.pop(Config, None)
+    cfg = Config()
+    cfg.embedding_provider = "hashing"
+    cfg.embedding_dimension = 64
+    cfg.memory_dedup = "bump"
+    yield cfg
+    Singleton._instances.pop(Config, None)
+
+
+def migrate(*args):
+    return CliRunner().invoke(memory.app, ["migrate", *args])
+
+
+def test_migrate_between_indexes_of_a_backend(cfg):
+    source = memory.open_memory(cfg, "local", "first")
+    source.add_many(["opened main.py", "searched for cats"])
+    source.close()
+    result = migrate(
+        "--source",
+        "local",
+        "--source-index",
+        "first",
+        "--target",
+        "local",
+        "--target-index",
+        "second",
+    )
+    assert result.exit_code == 0, result.output
+    assert "Migrated 2 memories from local to local (2 stored" in result.output
+    target = memory.open_memory(cfg, "local", "second")
+    assert target.get_relevant("searched for cats", 1) == ["searched for cats"]
+    target.close()
+
+
+def test_migrate_rejects_the_same_index(cfg):
+    result = migrate("--source", "local", "--target", "local")
+    assert result.exit_code == 2
+    assert f"source and target are both local:{cfg.memory_index}" in result.output
@@ -0,0 +1,192 @@
+"""
+Startup budget of the CLI.
+
+The memory tests import modules in a fresh interpreter with -X importtime,
+which reports on stderr how long every import took with its dependencies, and
+check that no optional integration is loaded before its first use. The command
+modules build the config when they are imported, so their module-level imports
+are checked in the source instead, following the imports of the project.
+"""
+import ast
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+# module -> the most milliseconds its import may take, dependencies included
+BUDGETS_MS = {
+    "memories": 50,
+    "memories.local": 500,
+}
+# clients of the optional integrations, imported at first use
+OPTIONAL = {
+    "bs4",
+    "docker",
+    "dotenv",
+    "duckduckgo_search",
+    "googleapiclient",
+    "gtts",
+    "openai",
+    "PIL",
+    "pinecone",
+    "playsound",
+    "redis",
+    "tiktoken",
+}
+SRC = Path(__file__).resolve().parents[1]
+MISSING = re.compile(r"ModuleNotFoundError: No module named '([\w.]+)'")
+
+
+def run(statement):
+    """
+    Runs a statement in a fresh interpreter with -X importtime. Skips the test
+    if an optional integration is not installed, fails on any other error.
+
+    Returns: The completed process.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+    )
+    if result.returncode:
+        errors = [line for line in result.stderr.splitlines() if "time:" not in line]
+        missing = MISSING.search(errors[-1]) if errors else None
+        if missing and missing.group(1).split(".")[0] in OPTIONAL:
+            pytest.skip(f"{statement!r} needs {missing.group(1)}")
+        pytest.fail(f"{statement!r} failed:\n" + "\n".join(errors))
+    return result
+
+
+def import_times(statement):
+    """
+    Returns: The cumulative milliseconds of every module a statement imported.
+    """
+    times = {}
+    for line in run(statement).stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+
+def loaded(times, packages):
+    return sorted({name.split(".")[0] for name in times} & set(packages))
+
+
+def test_importing_memories_loads_no_backend():
+    times = import_times("import memories")
+    assert loaded(times, OPTIONAL | {"numpy", "orjson"}) == []
+    assert not [name for name in times if name.startswith("memories.")]
+    assert times["memories"] <= BUDGETS_MS["memories"]
+
+
+def test_local_memory_loads_no_remote_client():
+    times = import_times("import memories.local")
+    assert loaded(times, OPTIONAL) == []
+    assert times["memories.local"] <= BUDGETS_MS["memories.local"]
+
+
+def test_backends_are_imported_when_selected():
+    # importlib.import_module is not reported by -X importtime
+    modules = run(
+        "import sys, memories; memories.SQLiteMemory; print(*sys.modules)"
+    ).stdout.split()
+    assert "memories.sqlitemem" in modules
+    assert "memories.redismem" not in modules
+    assert "memories.pinecone" not in modules
+
+
+def source_path(module):
+    """
+    Returns: The file of a module of the project, None for other modules.
+    """
+    path = SRC.joinpath(*module.split("."))
+    for candidate in (path.with_suffix(".py"), path / "__init__.py"):
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+class ImportVisitor(ast.NodeVisitor):
+    """Collects the imports of a module, apart from the ones in functions."""
+
+    def __init__(self, package):
+        self.package = package
+        self.depth = 0
+        self.top = set()
+        self.deferred = set()
+
+    def visit_FunctionDef(self, node):
+        self.depth += 1
+        self.generic_visit(node)
+        self.depth -= 1
+
+    visit_AsyncFunctionDef = visit_Lambda = visit_FunctionDef
+
+    def add(self, names):
+        (self.deferred if self.depth else self.top).update(names)
+
+    def visit_Import(self, node):
+        self.add(alias.name for alias in node.names)
+
+    def visit_ImportFrom(self, node):
+        base = node.module or ""
+        if node.level:
+            parent = self.package.rsplit(".", node.level - 1)[0]
+            base = f"{parent}.{base}".strip(".")
+        self.add([base] + [f"{base}.{alias.name}" for alias in node.names])
+
+
+def imported_modules(path, module):
+    """
+    Returns: The modules a source file imports, split into the ones imported
+        with it and the ones imported in functions, at first use.
+    """
+    package = module if path.name == "__init__.py" else module.rpartition(".")[0]
+    visitor = ImportVisitor(package)
+    visitor.visit(ast.parse(path.read_text(), str(path)))
+    return visitor.top, visitor.deferred
+
+
+def loaded_at_import(module):
+    """
+    Returns: The top-level packages importing a module of the project loads,
+        following its module-level imports of other modules of the project.
+    """
+    packages, seen, queue = set(), set(), [module]
+    while queue:
+        name = queue.pop()
+        path = source_path(name)
+        if path is None or path in seen:
+            continue
+        seen.add(path)
+        top, _ = imported_modules(path, name)
+        for imported in top:
+            if source_path(imported) is not None:
+                queue.append(imported)
+            elif source_path(imported.split(".")[0]) is None:
+                packages.add(imported.split(".")[0])
+    return packages
+
+
+@pytest.mark.parametrize(
+    "module, clients",
+    [
+        ("commands.google", {"duckduckgo_search", "googleapiclient"}),
+        ("functions.browse", {"bs4"}),
+        ("functions.execute_code", {"docker"}),
+        ("functions.image_gen", {"PIL"}),
+        ("functions.speak", {"gtts", "playsound"}),
+    ],
+)
+def test_commands_load_their_integration_at_first_use(module, clients):
+    assert sorted(loaded_at_import(module) & (OPTIONAL - {"openai"})) == []
+    _, deferred = imported_modules(source_path(module), module)
+    assert clients <= {name.split(".")[0] for name in deferred}